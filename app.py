@@ -2,26 +2,41 @@ from flask import Flask, request, jsonify, render_template_string, send_from_dir
 from flask_cors import CORS
 import os
 import traceback
-from kb_rag import ask, load_index, ask_stream
+from kb_rag import (ask, ask_stream, get_index_manager, get_kb_registry, get_snapshot, prepare_question,
+                    hits_to_results, readiness, start_warm_up, warm_up, KBNotFoundError)
 
 app = Flask(__name__)
 # 啟用 CORS 以支援跨域請求
 CORS(app)
 
-# 全域變數來快取索引
-_index = None
-_chunks = None
+# 索引與切塊由 IndexManager 以不可變快照持有（執行緒安全、支援熱更新）
+# 請求帶 kb 參數時改查 KB_ROOT/<kb>/ 的知識庫（第一次使用時載入，LRU 保留）
+_manager = get_index_manager()
 
-def init_rag():
+def _snapshot(kb_id=None):
+    return get_snapshot(kb_id) if kb_id else _manager.current()
+
+def init_rag(kb_id=None):
     """初始化 RAG 系統"""
-    global _index, _chunks
     try:
-        _index, _chunks = load_index()
+        _snapshot(kb_id)
         return True
     except Exception as e:
         print(f"[ERROR] RAG 初始化失敗: {e}")
         return False
 
+def check_kb(kb_id):
+    """檢查 kb 參數；不合法回傳 400、不存在回傳 404，沒問題時回傳 None"""
+    if not kb_id:
+        return None
+    try:
+        get_kb_registry().manager(kb_id)
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    except KBNotFoundError as e:
+        return jsonify({'success': False, 'error': str(e)}), 404
+    return None
+
 
 @app.route('/')
 def index():
@@ -31,15 +46,17 @@ def index():
 
 @app.route('/api/status')
 def status():
-    """檢查系統狀態"""
+    """檢查系統狀態（?kb=<id> 檢查指定知識庫）"""
     try:
-        if _index is None:
-            init_success = init_rag()
-            if not init_success:
-                return jsonify({
-                    'status': 'error',
-                    'message': '知識庫索引未建立，請先執行 python kb_rag.py build --folder knowledge_docs'
-                })
+        kb_id = request.args.get('kb')
+        error = check_kb(kb_id)
+        if error:
+            return error
+        if not init_rag(kb_id):
+            return jsonify({
+                'status': 'error',
+                'message': '知識庫索引未建立，請先執行 python kb_rag.py build --folder knowledge_docs'
+            })
         
         return jsonify({
             'status': 'ready',
@@ -69,15 +86,17 @@ def api_ask():
                 'success': False,
                 'error': '問題不能為空'
             }), 400
+        kb_id = data.get('kb')
+        error = check_kb(kb_id)
+        if error:
+            return error
         
         # 確保 RAG 系統已初始化
-        if _index is None:
-            init_success = init_rag()
-            if not init_success:
-                return jsonify({
-                    'success': False,
-                    'error': '知識庫索引未建立，請先執行 python kb_rag.py build --folder knowledge_docs'
-                }), 500
+        if not init_rag(kb_id):
+            return jsonify({
+                'success': False,
+                'error': '知識庫索引未建立，請先執行 python kb_rag.py build --folder knowledge_docs'
+            }), 500
         
         # 是否使用串流
         stream_flag = False
@@ -90,13 +109,18 @@ def api_ask():
             q = request.args.get('stream', '')
             stream_flag = str(q).lower() in ['1', 'true', 'yes']
 
+        # 語意答案快取：相近問題且索引版本相同時，直接回傳先前的答案（嵌入與快取比對只做一次，結果交給 ask）
+        prepared = prepare_question(question, kb_id)
+        cached = prepared.cached is not None
+
         if not stream_flag:
             # 非串流：直接回傳完整答案
-            answer = ask(question)
+            answer = ask(question, kb_id, prepared)
             return jsonify({
                 'success': True,
                 'answer': answer,
-                'question': question
+                'question': question,
+                'cached': cached
             })
         else:
             # 串流：以 NDJSON 逐步回傳
@@ -106,12 +130,13 @@ def api_ask():
                 start_obj = {
                     'success': True,
                     'type': 'start',
-                    'question': question
+                    'question': question,
+                    'cached': cached
                 }
                 yield json.dumps(start_obj, ensure_ascii=False) + "\n"
 
                 try:
-                    for delta in ask_stream(question):
+                    for delta in ask_stream(question, kb_id, prepared):
                         if not delta:
                             continue
                         yield json.dumps({'type': 'delta', 'content': delta}, ensure_ascii=False) + "\n"
@@ -161,35 +186,47 @@ def api_search():
                 'error': '查詢不能為空'
             }), 400
         
+        from kb_rag import search, pack_context, SearchOptions, SEARCH_MODE, SEARCH_MODES
+        mode = data.get('mode')
+        if mode and str(mode).lower() not in SEARCH_MODES:
+            return jsonify({
+                'success': False,
+                'error': f"不支援的檢索模式：{mode}（可用 {' / '.join(SEARCH_MODES)}）"
+            }), 400
+        # 自適應 top-k：min_score / max_gap / max_k / mmr（未提供時依環境變數預設）
+        try:
+            opts = SearchOptions.from_dict(data)
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+        kb_id = data.get('kb')
+        error = check_kb(kb_id)
+        if error:
+            return error
+        
         # 確保 RAG 系統已初始化
-        if _index is None:
-            init_success = init_rag()
-            if not init_success:
-                return jsonify({
-                    'success': False,
-                    'error': '知識庫索引未建立，請先執行 python kb_rag.py build --folder knowledge_docs'
-                }), 500
-        
-        # 執行向量搜尋
-        from kb_rag import search, format_context
-        hits = search(_index, query, k=10)  # 使用 TOP_K=5
-        context = format_context(hits)
+        if not init_rag(kb_id):
+            return jsonify({
+                'success': False,
+                'error': '知識庫索引未建立，請先執行 python kb_rag.py build --folder knowledge_docs'
+            }), 500
+        
+        # 執行檢索
+        snap = _snapshot(kb_id)
+        # mode：vector / lexical / hybrid（預設依 KB_SEARCH_MODE）
+        hits = search(snap.index, query, k=10, store=snap.store, lexical=snap.lexical,
+                      mode=mode, opts=opts)
+        packed = pack_context(hits)
         
         # 回傳搜尋結果
-        results = []
-        for rank, (chunk, score) in enumerate(hits, 1):
-            results.append({
-                'rank': rank,
-                'score': float(score),
-                'source': chunk.source,
-                'text': chunk.text,
-                'chunk_id': f"chunk_{rank}"  # 添加唯一 ID
-            })
+        results = hits_to_results(hits)
         
         return jsonify({
             'success': True,
             'query': query,
-            'context': context,
+            'kb': kb_id,
+            'mode': (mode or SEARCH_MODE).lower() if snap.lexical is not None else 'vector',
+            'context': packed.text,
+            'context_tokens': packed.tokens,
             'results': results,
             'chunks': results,  # 添加 chunks 欄位，與 results 相同
             'total_chunks': len(results)
@@ -203,6 +240,96 @@ def api_search():
             'error': f'向量搜尋錯誤：{str(e)}'
         }), 500
 
+MAX_BATCH_QUERIES = int(os.getenv('KB_MAX_BATCH_QUERIES', '1000'))
+MAX_BATCH_K = int(os.getenv('KB_MAX_BATCH_K', '100'))   # 批次搜尋每個查詢回傳數上限（FAISS 結果陣列為 查詢數 x k）
+
+def parse_batch_k(value):
+    """批次搜尋的 k：須為正整數，超過 MAX_BATCH_K 時以上限計；格式錯誤回傳 None"""
+    if isinstance(value, bool) or not isinstance(value, (int, str)) or not str(value).strip().isdigit():
+        return None
+    k = int(value)
+    return min(k, MAX_BATCH_K) if k >= 1 else None
+
+@app.route('/api/search/batch', methods=['POST'])
+def api_search_batch():
+    """批次搜尋 API 端點：{"queries": [...], "k": 10, "mode": "hybrid"}"""
+    try:
+        data = request.get_json()
+        queries = data.get('queries') if data else None
+        if not isinstance(queries, list) or not queries:
+            return jsonify({
+                'success': False,
+                'error': '請提供查詢清單 queries'
+            }), 400
+        if len(queries) > MAX_BATCH_QUERIES:
+            return jsonify({
+                'success': False,
+                'error': f'單次最多 {MAX_BATCH_QUERIES} 筆查詢'
+            }), 400
+        queries = [str(q).strip() for q in queries]
+        k = parse_batch_k(data.get('k', 10))
+        if k is None:
+            return jsonify({
+                'success': False,
+                'error': f"參數 k 必須為正整數：{data.get('k')}"
+            }), 400
+        
+        from kb_rag import search_many, SearchOptions, SEARCH_MODE, SEARCH_MODES
+        mode = data.get('mode')
+        if mode and str(mode).lower() not in SEARCH_MODES:
+            return jsonify({
+                'success': False,
+                'error': f"不支援的檢索模式：{mode}（可用 {' / '.join(SEARCH_MODES)}）"
+            }), 400
+        # 自適應 top-k：min_score / max_gap / max_k / mmr（未提供時依環境變數預設）
+        try:
+            # max_k 取代 k，批次上限同樣套用
+            opts = SearchOptions.from_dict(data).capped(MAX_BATCH_K)
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+        kb_id = data.get('kb')
+        error = check_kb(kb_id)
+        if error:
+            return error
+        
+        if not init_rag(kb_id):
+            return jsonify({
+                'success': False,
+                'error': '知識庫索引未建立，請先執行 python kb_rag.py build --folder knowledge_docs'
+            }), 500
+        
+        snap = _snapshot(kb_id)
+        batch = search_many(snap.index, queries, k=k, store=snap.store, lexical=snap.lexical,
+                            mode=mode, opts=opts)
+        return jsonify({
+            'success': True,
+            'kb': kb_id,
+            'mode': (mode or SEARCH_MODE).lower() if snap.lexical is not None else 'vector',
+            'results': [
+                {'query': q, 'results': hits_to_results(hits)}
+                for q, hits in zip(queries, batch)
+            ],
+            'total_queries': len(queries)
+        })
+        
+    except Exception as e:
+        print(f"[ERROR] 批次搜尋 API 錯誤: {e}")
+        print(traceback.format_exc())
+        return jsonify({
+            'success': False,
+            'error': f'批次搜尋錯誤：{str(e)}'
+        }), 500
+
+@app.route('/api/kbs')
+def list_kbs():
+    """列出可用的知識庫與目前已載入者"""
+    registry = get_kb_registry()
+    return jsonify({
+        'success': True,
+        'kbs': registry.available(),
+        'loaded': registry.stats()
+    })
+
 @app.route('/api/health')
 def health():
     """健康檢查端點"""
@@ -211,6 +338,13 @@ def health():
         'service': '知識庫問答系統'
     })
 
+@app.route('/api/ready')
+def ready():
+    """readiness 檢查：索引載入並預熱完成後才回 200，之前回 503（負載平衡器據此導入流量）"""
+    start_warm_up()   # 未經 gunicorn.conf.py 啟動時，第一次檢查即開始預熱
+    state = readiness()
+    return jsonify(state), (200 if state['ready'] else 503)
+
 if __name__ == '__main__':
     print("=== 知識庫問答系統啟動中 ===")
     print("系統檢查...")
@@ -222,8 +356,12 @@ if __name__ == '__main__':
     if missing_files:
         print(f"[WARNING] 缺少檔案: {missing_files}")
     
-    # 嘗試初始化 RAG 系統
-    if init_rag():
+    # 預先建立到 LLM Proxy 的連線，第一批請求不必等待 TLS 握手
+    from llm_client import prewarm
+    prewarm()
+    
+    # 嘗試初始化 RAG 系統（載入並預熱索引，完成後 /api/ready 回報 ready）
+    if warm_up()['ready']:
         print("[OK] RAG 系統初始化成功")
     else:
         print("[WARNING] RAG 系統初始化失敗，需要先建立知識庫索引")
@@ -234,8 +372,10 @@ if __name__ == '__main__':
     print("API 文件:")
     print("  - GET  /              : 主頁面")
     print("  - GET  /api/status    : 系統狀態")
-    print("  - POST /api/ask       : 問答 API")
+    print("  - POST /api/ask       : 問答 API（kb 參數指定知識庫）")
+    print("  - GET  /api/kbs       : 知識庫列表")
     print("  - GET  /api/health    : 健康檢查")
+    print("  - GET  /api/ready     : 索引預熱完成才回 200")
     print("\n按 Ctrl+C 停止伺服器")
     
     app.run(debug=True, host='0.0.0.0', port=5002)
@@ -0,0 +1,342 @@
+"""
+知識庫問答系統的 ASGI 版本
+
+路由與回應格式（含 /api/ask 的 NDJSON 串流）與 app.py 相同，
+但問答與檢索走 kb_rag 的非同步函式：等待 LLM 串流時不占用執行緒，
+單一行程即可同時服務大量長時間的串流連線。
+
+啟動：
+    uvicorn asgi_app:app --host 0.0.0.0 --port 5002
+    KB_ASGI=1 gunicorn -c gunicorn.conf.py          # 多 worker（prefork，索引記憶體映射共用）
+"""
+
+import os
+import json
+import traceback
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs
+
+from llm_client import aprewarm
+from kb_rag import (aask, aask_stream, aprepare_question, aget_snapshot, asearch, asearch_many,
+                    get_kb_registry, pack_context, hits_to_results, readiness, start_warm_up,
+                    KBNotFoundError,
+                    SearchOptions, SEARCH_MODE, SEARCH_MODES)
+
+MAX_BATCH_QUERIES = int(os.getenv('KB_MAX_BATCH_QUERIES', '1000'))
+MAX_BATCH_K = int(os.getenv('KB_MAX_BATCH_K', '100'))   # 批次搜尋每個查詢回傳數上限（FAISS 結果陣列為 查詢數 x k）
+NOT_BUILT_ERROR = '知識庫索引未建立，請先執行 python kb_rag.py build --folder knowledge_docs'
+
+# 與 flask-cors 預設相同：允許任意來源跨域請求
+CORS_HEADERS = [
+    (b'access-control-allow-origin', b'*'),
+]
+PREFLIGHT_HEADERS = CORS_HEADERS + [
+    (b'access-control-allow-methods', b'GET, POST, OPTIONS'),
+    (b'access-control-allow-headers', b'Content-Type'),
+]
+
+
+class HTTPError(Exception):
+    def __init__(self, status: int, body: Dict):
+        self.status = status
+        self.body = body
+
+
+# === 回應工具 ===============================================
+async def _send_json(send, obj: Dict, status: int = 200):
+    body = json.dumps(obj, ensure_ascii=False).encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json; charset=utf-8'),
+                    (b'content-length', str(len(body)).encode())] + CORS_HEADERS,
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def _send_ndjson(send, events):
+    """逐行送出 NDJSON；events 為 async generator，連線中斷時會被關閉（停止 LLM 串流）"""
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [(b'content-type', b'application/x-ndjson; charset=utf-8'),
+                    (b'cache-control', b'no-cache'),
+                    (b'x-accel-buffering', b'no')] + CORS_HEADERS,
+    })
+    try:
+        async for obj in events:
+            line = (json.dumps(obj, ensure_ascii=False) + "\n").encode('utf-8')
+            await send({'type': 'http.response.body', 'body': line, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        await events.aclose()
+
+
+async def _read_json(receive) -> Optional[Dict]:
+    chunks = []
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            break
+    body = b''.join(chunks)
+    if not body:
+        return None
+    try:
+        return json.loads(body)
+    except ValueError:
+        return None
+
+
+def _search_options(data: Dict) -> SearchOptions:
+    try:
+        return SearchOptions.from_dict(data)
+    except ValueError as e:
+        raise HTTPError(400, {'success': False, 'error': str(e)})
+
+
+def _check_mode(mode) -> Optional[str]:
+    if mode and str(mode).lower() not in SEARCH_MODES:
+        raise HTTPError(400, {
+            'success': False,
+            'error': f"不支援的檢索模式：{mode}（可用 {' / '.join(SEARCH_MODES)}）"
+        })
+    return mode
+
+
+def _batch_k(value) -> int:
+    """批次搜尋的 k：須為正整數（否則 400），超過 MAX_BATCH_K 時以上限計"""
+    if isinstance(value, bool) or not isinstance(value, (int, str)) or not str(value).strip().isdigit() \
+            or int(value) < 1:
+        raise HTTPError(400, {'success': False, 'error': f'參數 k 必須為正整數：{value}'})
+    return min(int(value), MAX_BATCH_K)
+
+
+def _check_kb(kb_id) -> Optional[str]:
+    """kb 參數不合法回傳 400、知識庫不存在回傳 404"""
+    if not kb_id:
+        return None
+    try:
+        get_kb_registry().manager(kb_id)
+    except ValueError as e:
+        raise HTTPError(400, {'success': False, 'error': str(e)})
+    except KBNotFoundError as e:
+        raise HTTPError(404, {'success': False, 'error': str(e)})
+    return kb_id
+
+
+def _query_param(scope, name: str) -> str:
+    return parse_qs(scope.get('query_string', b'').decode()).get(name, [''])[0]
+
+
+async def _snapshot_or_error(kb_id: Optional[str] = None):
+    """取得索引快照；索引未建立時回傳 500（對應 app.py 的 init_rag 檢查）"""
+    try:
+        return await aget_snapshot(kb_id)
+    except Exception as e:
+        print(f"[ERROR] RAG 初始化失敗: {e}")
+        raise HTTPError(500, {'success': False, 'error': NOT_BUILT_ERROR})
+
+
+# === 路由 ===================================================
+async def index(scope, receive, send):
+    """主頁面 - 回傳獨立的 HTML 檔案"""
+    if not os.path.exists('index.html'):
+        raise HTTPError(404, {'success': False, 'error': 'Not Found'})
+    with open('index.html', 'rb') as f:
+        body = f.read()
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [(b'content-type', b'text/html; charset=utf-8'),
+                    (b'content-length', str(len(body)).encode())],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def status(scope, receive, send):
+    """檢查系統狀態（?kb=<id> 檢查指定知識庫）"""
+    kb_id = _check_kb(_query_param(scope, 'kb'))
+    try:
+        await aget_snapshot(kb_id)
+    except Exception as e:
+        print(f"[ERROR] RAG 初始化失敗: {e}")
+        return await _send_json(send, {'status': 'error', 'message': NOT_BUILT_ERROR})
+    await _send_json(send, {'status': 'ready', 'message': '系統正常運行'})
+
+
+async def health(scope, receive, send):
+    """健康檢查端點"""
+    await _send_json(send, {'status': 'healthy', 'service': '知識庫問答系統'})
+
+
+async def ready(scope, receive, send):
+    """readiness 檢查：索引載入並預熱完成後才回 200，之前回 503"""
+    start_warm_up()
+    state = readiness()
+    await _send_json(send, state, status=200 if state['ready'] else 503)
+
+
+async def list_kbs(scope, receive, send):
+    """列出可用的知識庫與目前已載入者"""
+    registry = get_kb_registry()
+    await _send_json(send, {'success': True, 'kbs': registry.available(), 'loaded': registry.stats()})
+
+
+async def api_ask(scope, receive, send):
+    """問答 API 端點（stream=true 時以 NDJSON 逐步回傳）"""
+    data = await _read_json(receive)
+    if not data or 'question' not in data:
+        raise HTTPError(400, {'success': False, 'error': '請提供問題內容'})
+    question = data['question'].strip()
+    if not question:
+        raise HTTPError(400, {'success': False, 'error': '問題不能為空'})
+    kb_id = _check_kb(data.get('kb'))
+    await _snapshot_or_error(kb_id)
+
+    stream_flag = bool(data.get('stream', False))
+    if not stream_flag:
+        stream_flag = _query_param(scope, 'stream').lower() in ['1', 'true', 'yes']
+
+    # 語意答案快取：相近問題且索引版本相同時，直接回傳先前的答案（嵌入與快取比對只做一次，結果交給 aask）
+    prepared = await aprepare_question(question, kb_id)
+    cached = prepared.cached is not None
+
+    if not stream_flag:
+        answer = await aask(question, kb_id, prepared)
+        return await _send_json(send, {
+            'success': True,
+            'answer': answer,
+            'question': question,
+            'cached': cached
+        })
+
+    async def events():
+        yield {'success': True, 'type': 'start', 'question': question, 'cached': cached}
+        deltas = aask_stream(question, kb_id, prepared)
+        try:
+            async for delta in deltas:
+                if delta:
+                    yield {'type': 'delta', 'content': delta}
+            yield {'type': 'end'}
+        except Exception as e:
+            yield {'success': False, 'type': 'error', 'error': str(e)}
+        finally:
+            await deltas.aclose()
+
+    await _send_ndjson(send, events())
+
+
+async def api_search(scope, receive, send):
+    """搜尋 API 端點"""
+    data = await _read_json(receive)
+    if not data or 'query' not in data:
+        raise HTTPError(400, {'success': False, 'error': '請提供查詢內容'})
+    today_str = datetime.now().strftime('%Y-%m-%d')
+    query = f"{data['query'].strip()} #Today: {today_str}"
+    mode = _check_mode(data.get('mode'))
+    opts = _search_options(data)
+    kb_id = _check_kb(data.get('kb'))
+    snap = await _snapshot_or_error(kb_id)
+
+    hits = await asearch(snap.index, query, k=10, store=snap.store, lexical=snap.lexical, mode=mode, opts=opts)
+    results = hits_to_results(hits)
+    packed = pack_context(hits)
+    await _send_json(send, {
+        'success': True,
+        'query': query,
+        'kb': kb_id,
+        'mode': (mode or SEARCH_MODE).lower() if snap.lexical is not None else 'vector',
+        'context': packed.text,
+        'context_tokens': packed.tokens,
+        'results': results,
+        'chunks': results,
+        'total_chunks': len(results)
+    })
+
+
+async def api_search_batch(scope, receive, send):
+    """批次搜尋 API 端點：{"queries": [...], "k": 10, "mode": "hybrid"}"""
+    data = await _read_json(receive)
+    queries = data.get('queries') if data else None
+    if not isinstance(queries, list) or not queries:
+        raise HTTPError(400, {'success': False, 'error': '請提供查詢清單 queries'})
+    if len(queries) > MAX_BATCH_QUERIES:
+        raise HTTPError(400, {'success': False, 'error': f'單次最多 {MAX_BATCH_QUERIES} 筆查詢'})
+    queries = [str(q).strip() for q in queries]
+    k = _batch_k(data.get('k', 10))
+    mode = _check_mode(data.get('mode'))
+    opts = _search_options(data).capped(MAX_BATCH_K)   # max_k 取代 k，批次上限同樣套用
+    kb_id = _check_kb(data.get('kb'))
+    snap = await _snapshot_or_error(kb_id)
+
+    batch = await asearch_many(snap.index, queries, k=k, store=snap.store, lexical=snap.lexical,
+                               mode=mode, opts=opts)
+    await _send_json(send, {
+        'success': True,
+        'kb': kb_id,
+        'mode': (mode or SEARCH_MODE).lower() if snap.lexical is not None else 'vector',
+        'results': [{'query': q, 'results': hits_to_results(hits)} for q, hits in zip(queries, batch)],
+        'total_queries': len(queries)
+    })
+
+
+ROUTES: Dict[Tuple[str, str], object] = {
+    ('GET', '/'): index,
+    ('GET', '/api/status'): status,
+    ('GET', '/api/health'): health,
+    ('GET', '/api/ready'): ready,
+    ('GET', '/api/kbs'): list_kbs,
+    ('POST', '/api/ask'): api_ask,
+    ('POST', '/api/search'): api_search,
+    ('POST', '/api/search/batch'): api_search_batch,
+}
+ALLOWED_PATHS: List[str] = sorted({path for _, path in ROUTES})
+
+
+# === ASGI 進入點 ============================================
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                # 預先建立到 LLM Proxy 的連線，第一批請求不必等待 TLS 握手
+                await aprewarm()
+                start_warm_up()   # 背景預熱索引，不阻塞啟動；完成前 /api/ready 回 503
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+    if scope['type'] != 'http':
+        return
+
+    method, path = scope['method'], scope['path']
+    if method == 'OPTIONS' and path in ALLOWED_PATHS:
+        await send({'type': 'http.response.start', 'status': 204, 'headers': PREFLIGHT_HEADERS})
+        await send({'type': 'http.response.body', 'body': b''})
+        return
+    handler = ROUTES.get((method, path))
+    if handler is None:
+        status_code = 405 if path in ALLOWED_PATHS else 404
+        await _send_json(send, {'success': False, 'error': 'Not Found' if status_code == 404 else 'Method Not Allowed'},
+                         status=status_code)
+        return
+
+    try:
+        await handler(scope, receive, send)
+    except HTTPError as e:
+        await _send_json(send, e.body, status=e.status)
+    except FileNotFoundError:
+        await _send_json(send, {'success': False, 'error': '知識庫索引檔案不存在，請先建立索引'}, status=500)
+    except Exception as e:
+        print(f"[ERROR] API 錯誤: {e}")
+        print(traceback.format_exc())
+        await _send_json(send, {'success': False, 'error': f'系統錯誤：{str(e)}'}, status=500)
+
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run('asgi_app:app', host='0.0.0.0', port=5002)
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+切塊效能基準：舊版 chunk_text（字串串接 + 二次切分）vs 一次掃描版
+
+用法：
+    python bench_chunking.py                                  # 以 knowledge_docs/cubeapp上線記錄.md 放大成 8 MB 測試
+    python bench_chunking.py --file knowledge_docs/cubeapp上線記錄.md --mb 16
+"""
+
+import os
+import sys
+import time
+import argparse
+from typing import List
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import kb_chunker
+from kb_chunker import CHUNK_SIZE, CHUNK_OVERLAP, SECTION_JOINER, chunk_text
+
+DEFAULT_FILE = os.path.join("knowledge_docs", "cubeapp上線記錄.md")
+
+
+def legacy_chunk_text(text: str, size=CHUNK_SIZE, overlap=CHUNK_OVERLAP) -> List[str]:
+    """舊版實作（保留作為正確性與效能比較基準）"""
+    text = text.strip().replace("\r\n", "\n")
+    sections = text.split("---")
+    chunks = []
+    current_chunk = ""
+    for section in sections:
+        section = section.strip()
+        if not section:
+            continue
+        if current_chunk and len(current_chunk) + len(section) + 5 > size:
+            chunks.append(current_chunk.strip())
+            current_chunk = section
+        else:
+            if current_chunk:
+                current_chunk += "\n---\n" + section
+            else:
+                current_chunk = section
+    if current_chunk:
+        chunks.append(current_chunk.strip())
+
+    final_chunks = []
+    for chunk in chunks:
+        if len(chunk) <= size or "---" not in chunk:
+            final_chunks.append(chunk)
+            continue
+        temp_chunk = ""
+        for sub_section in chunk.split("---"):
+            sub_section = sub_section.strip()
+            if not sub_section:
+                continue
+            if temp_chunk and len(temp_chunk) + len(sub_section) + 5 > size:
+                final_chunks.append(temp_chunk.strip())
+                temp_chunk = sub_section
+            else:
+                temp_chunk = temp_chunk + "\n---\n" + sub_section if temp_chunk else sub_section
+        if temp_chunk:
+            if len(temp_chunk) <= size:
+                final_chunks.append(temp_chunk.strip())
+            else:
+                start = 0
+                while start < len(temp_chunk):
+                    end = min(start + size, len(temp_chunk))
+                    final_chunks.append(temp_chunk[start:end])
+                    if end == len(temp_chunk):
+                        break
+                    start = max(0, end - overlap)
+    return final_chunks
+
+
+def _timeit(fn, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def main():
+    ap = argparse.ArgumentParser(description="切塊效能基準")
+    ap.add_argument("--file", default=DEFAULT_FILE, help="作為內容來源的 .md 檔")
+    ap.add_argument("--mb", type=float, default=8.0, help="每份測試文件放大到的大小（MB）")
+    ap.add_argument("--repeat", type=int, default=3)
+    args = ap.parse_args()
+
+    with open(args.file, "r", encoding="utf-8") as f:
+        base = f.read()
+    target = int(args.mb * 1024 * 1024)
+    text = base * max(1, target // len(base.encode("utf-8")))
+    print(f"[INFO] 測試文件：{args.file} 放大為 {len(text.encode('utf-8')) / 1024 / 1024:.1f} MB（{len(text)} 字元）")
+
+    old = legacy_chunk_text(text)
+    new = chunk_text(text)
+    if old != new:
+        print("[ERROR] 新舊切塊結果不一致")
+        sys.exit(1)
+    print(f"[OK] 新舊切塊結果一致，共 {len(new)} 個切塊")
+
+    # 另以同樣大小、全是短段落的文件測試（每段都要判斷是否合併，最能反映逐段處理的成本）
+    short = SECTION_JOINER.join(f"item {i}" for i in range(len(text) // 16))
+    for label, doc in (("單檔", text), ("短段落", short)):
+        t_old = _timeit(lambda: legacy_chunk_text(doc), args.repeat)
+        t_new = _timeit(lambda: chunk_text(doc), args.repeat)
+        t_spans = _timeit(lambda: kb_chunker.chunk_spans(doc), args.repeat)
+        print(f"[REPORT] {label}  舊版 {t_old * 1000:.1f} ms｜一次掃描 {t_new * 1000:.1f} ms"
+              f"（{t_old / t_new:.2f}x）｜只算位移 {t_spans * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,14 +2,14 @@ import os
 import argparse
 import json
 from typing import Optional, List, Dict
-from openai import OpenAI
+from llm_client import get_client
 
 # === 環境設定（指向 LiteLLM Proxy） =========================
 BASE_URL = os.getenv("LITELLM_BASE", "https://llm.cubeapp945566.work")
 API_KEY = os.getenv("LITELLM_API_KEY", "sk-GhYWCOAf9uCrYTioB_mohQ")
 CHAT_MODEL = "gpt-oss-120b"
 
-client = OpenAI(api_key=API_KEY, base_url=BASE_URL)
+client = get_client(BASE_URL, API_KEY)
 
 # === 工具函數 ===============================================
 def read_code_file(file_path: str) -> str:
@@ -0,0 +1,33 @@
+"""
+gunicorn 設定：prefork 多 worker 部署
+
+    gunicorn -c gunicorn.conf.py                  # Flask（app:app），gthread worker
+    KB_ASGI=1 gunicorn -c gunicorn.conf.py        # ASGI（asgi_app:app），uvicorn worker
+
+索引、切塊檔與關鍵字索引皆以唯讀記憶體映射開啟（KB_INDEX_MMAP=1），
+資料頁由作業系統的 page cache 提供、所有 worker 共用，記憶體不會隨 worker 數倍增。
+每個 worker 啟動後於背景預熱（讀過索引檔並執行一次查詢），/api/ready 在預熱完成前回 503。
+"""
+
+import os
+
+# 需在 worker 匯入 kb_rag 之前設定
+os.environ.setdefault("KB_INDEX_MMAP", "1")
+
+_asgi = os.getenv("KB_ASGI", "0") == "1"
+
+wsgi_app = "asgi_app:app" if _asgi else "app:app"
+worker_class = "uvicorn.workers.UvicornWorker" if _asgi else "gthread"
+bind = os.getenv("KB_BIND", "0.0.0.0:5002")
+workers = int(os.getenv("KB_WORKERS", str(os.cpu_count() or 1)))
+threads = int(os.getenv("KB_THREADS", "8"))              # gthread：每個 worker 的執行緒數（串流問答各占一條）
+timeout = int(os.getenv("KB_WORKER_TIMEOUT", "300"))     # 長時間的串流問答不應被當成卡住的 worker
+graceful_timeout = 30
+# 不在 master 預先載入應用程式：LLM 連線池不可跨 fork 共用，由各 worker 自行建立；
+# 索引以記憶體映射開啟，資料頁本來就由所有 worker 共用，preload 省不到記憶體
+preload_app = False
+
+
+def post_worker_init(worker):
+    from kb_rag import start_warm_up
+    start_warm_up()
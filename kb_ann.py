@@ -0,0 +1,422 @@
+from __future__ import annotations
+
+import os
+import re
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+from kb_lazy import lazy_import
+
+faiss = lazy_import("faiss")
+np = lazy_import("numpy")
+
+# === ANN 索引類型 ===========================================
+# 支援的索引規格（不分大小寫）：
+#   flat                 暴力內積搜尋（預設，recall = 1）
+#   ivf[nlist]           IVF-Flat，例如 ivf1024
+#   hnsw[M]              HNSW 圖索引，例如 hnsw32
+#   ivf[nlist],pq[m]     IVF-PQ 乘積量化，例如 ivf1024,pq64（m 需整除向量維度）
+# flat / ivf / hnsw 可再加上純量量化的向量儲存格式（省記憶體，分數為近似值）：
+#   ,fp16                半精度，每維 2 bytes，例如 flat,fp16、hnsw32,fp16
+#   ,sq8（或 ,int8）     8-bit 純量量化，每維 1 byte（需訓練各維範圍），例如 flat,sq8、ivf1024,sq8
+# 有損的儲存格式（fp16 / sq8 / pq）build 時另存全精度向量，搜尋時可重新評分（見 RescoringIndex）
+DEFAULT_INDEX_SPEC = "flat"
+DEFAULT_NLIST = 1024
+DEFAULT_HNSW_M = 32
+DEFAULT_PQ_M = 64
+TRAIN_SAMPLE_MAX = 100_000        # 訓練 IVF/PQ 時最多使用的向量數
+MIN_POINTS_PER_CENTROID = 39      # faiss k-means 建議每個中心至少 39 個點
+TUNE_TARGET_RECALL = 0.95         # 自動調整 nprobe/efSearch 時的目標 recall@k
+EF_SEARCH_CANDIDATES = [16, 32, 64, 128, 256, 512]
+CODECS = {"fp16": "fp16", "sqfp16": "fp16", "sq8": "sq8", "int8": "sq8"}
+_CODEC_FACTORY = {"": "Flat", "fp16": "SQfp16", "sq8": "SQ8"}
+RESCORE = os.getenv("KB_RESCORE", "1") != "0"                  # 量化索引是否以全精度向量重新評分
+RESCORE_FACTOR = int(os.getenv("KB_RESCORE_FACTOR", "4"))     # 重新評分時先取 k 的幾倍候選
+RESCORE_BLOCK_BYTES = 16 * 1024 ** 2                             # 批次查詢分段重新評分，每段候選向量的暫存上限
+
+
+@dataclass(frozen=True)
+class IndexSpec:
+    kind: str           # flat | ivf | hnsw | ivfpq
+    nlist: int = 0
+    m: int = 0          # HNSW 的 M，或 PQ 的子向量數
+    codec: str = ""     # 向量儲存格式："" = float32 | fp16 | sq8（ivfpq 不適用）
+
+    def __str__(self) -> str:
+        if self.kind == "flat":
+            base = "flat"
+        elif self.kind == "hnsw":
+            base = f"hnsw{self.m}"
+        elif self.kind == "ivf":
+            base = f"ivf{self.nlist}"
+        else:
+            return f"ivf{self.nlist},pq{self.m}"
+        return f"{base},{self.codec}" if self.codec else base
+
+    @property
+    def needs_training(self) -> bool:
+        # sq8 需以訓練資料決定各維的數值範圍；fp16 不需訓練
+        return self.kind in ("ivf", "ivfpq") or self.codec == "sq8"
+
+    @property
+    def quantized(self) -> bool:
+        """向量以有損格式儲存（搜尋分數為近似值，build 需另存全精度向量供重新評分）"""
+        return bool(self.codec) or self.kind == "ivfpq"
+
+    @property
+    def supports_remove(self) -> bool:
+        # HNSW 圖無法刪除節點，增量 build 遇到刪除/變更時需完整重建
+        return self.kind != "hnsw"
+
+    def factory_string(self, nlist: Optional[int] = None) -> str:
+        nlist = nlist or self.nlist
+        storage = _CODEC_FACTORY[self.codec]
+        if self.kind == "flat":
+            return f"IDMap2,{storage}"
+        if self.kind == "hnsw":
+            return f"IDMap2,HNSW{self.m}" + (f"_{storage}" if self.codec else "")
+        if self.kind == "ivf":
+            return f"IVF{nlist},{storage}"
+        return f"IVF{nlist},PQ{self.m}"
+
+
+def _parse_base_spec(s: str) -> Optional[IndexSpec]:
+    if s in ("", "flat"):
+        return IndexSpec("flat")
+    m = re.fullmatch(r"hnsw(\d+)?", s)
+    if m:
+        return IndexSpec("hnsw", m=int(m.group(1) or DEFAULT_HNSW_M))
+    m = re.fullmatch(r"ivf(\d+)?(?:[,_-]?flat)?", s)
+    if m:
+        return IndexSpec("ivf", nlist=int(m.group(1) or DEFAULT_NLIST))
+    m = re.fullmatch(r"ivf(\d+)?[,_-]?pq(\d+)?", s)
+    if m:
+        return IndexSpec("ivfpq", nlist=int(m.group(1) or DEFAULT_NLIST), m=int(m.group(2) or DEFAULT_PQ_M))
+    return None
+
+
+def parse_index_spec(spec: str) -> IndexSpec:
+    s = spec.strip().lower().replace(" ", "")
+    codec = ""
+    m = re.fullmatch(r"(.*?)[,_-]?(sqfp16|fp16|sq8|int8)", s)
+    if m:
+        s, codec = m.group(1), CODECS[m.group(2)]
+    parsed = _parse_base_spec(s)
+    if parsed is None or (codec and parsed.kind == "ivfpq"):
+        raise ValueError(f"不支援的索引規格：{spec}（可用 flat / ivf<nlist> / hnsw<M> / ivf<nlist>,pq<m>，"
+                         f"前三者可加 ,fp16 或 ,sq8，例如 flat,sq8）")
+    return IndexSpec(parsed.kind, nlist=parsed.nlist, m=parsed.m, codec=codec)
+
+
+def create_index(spec: IndexSpec, dim: int, n_train: Optional[int] = None) -> faiss.Index:
+    """依規格建立內積索引；需要訓練的類型會依訓練資料量調降 nlist"""
+    nlist = spec.nlist
+    if spec.needs_training and n_train is not None:
+        max_nlist = max(1, n_train // MIN_POINTS_PER_CENTROID)
+        if nlist > max_nlist:
+            print(f"[WARN] 訓練向量僅 {n_train} 筆，nlist 由 {nlist} 調降為 {max_nlist}")
+            nlist = max_nlist
+    if spec.kind == "ivfpq":
+        if dim % spec.m != 0:
+            raise ValueError(f"PQ 子向量數 {spec.m} 必須整除向量維度 {dim}")
+        if n_train is not None and n_train < 256:
+            raise ValueError(f"IVF-PQ 至少需要 256 筆訓練向量（目前 {n_train}），請改用 flat 或 ivf")
+    return faiss.index_factory(dim, spec.factory_string(nlist), faiss.METRIC_INNER_PRODUCT)
+
+
+def train_sample(vecs: np.ndarray, exclude: Optional[np.ndarray] = None, seed: int = 0) -> np.ndarray:
+    """從向量中抽取訓練樣本（排除保留作評估的查詢）"""
+    pool = np.arange(len(vecs))
+    if exclude is not None and len(exclude) < len(vecs):
+        pool = np.setdiff1d(pool, exclude)
+    if len(pool) > TRAIN_SAMPLE_MAX:
+        pool = np.random.default_rng(seed).choice(pool, TRAIN_SAMPLE_MAX, replace=False)
+    return np.ascontiguousarray(vecs[np.sort(pool)])
+
+
+def set_search_params(index: faiss.Index, params: Dict[str, int]):
+    """套用搜尋參數（nprobe / efSearch），可穿透 IDMap 等外層包裝"""
+    if not params:
+        return
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None and "nprobe" in params:
+        ivf.nprobe = int(params["nprobe"])
+    hnsw = _extract_hnsw(index)
+    if hnsw is not None and "efSearch" in params:
+        hnsw.hnsw.efSearch = int(params["efSearch"])
+
+
+def get_search_params(index: faiss.Index) -> Dict[str, int]:
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        return {"nprobe": int(ivf.nprobe)}
+    hnsw = _extract_hnsw(index)
+    if hnsw is not None:
+        return {"efSearch": int(hnsw.hnsw.efSearch)}
+    return {}
+
+
+def _extract_hnsw(index: faiss.Index):
+    idx = index
+    while idx is not None:
+        idx = faiss.downcast_index(idx)
+        if isinstance(idx, faiss.IndexHNSW):
+            return idx
+        idx = getattr(idx, "index", None)
+    return None
+
+
+def read_index(path: str, mmap: bool = False) -> faiss.Index:
+    """讀取索引檔；mmap=True 時以唯讀記憶體映射開啟
+
+    映射開啟時向量資料留在作業系統的 page cache，不複製到行程的 heap，
+    同一台機器上的多個 worker 行程共用同一份實體記憶體。
+    """
+    if not mmap:
+        return faiss.read_index(path)
+    # faiss 1.10 起 Flat/SQ 等編碼陣列也可直接映射（IO_FLAG_MMAP_IFC），舊版只映射 IVF 倒排表
+    flags = getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP) | faiss.IO_FLAG_READ_ONLY
+    return faiss.read_index(path, flags)
+
+
+def enable_reconstruct(index: faiss.Index):
+    """讓索引可依 chunk id 取回向量（MMR 需要候選向量）
+
+    Flat/HNSW 本身即可 reconstruct；IVF 需要 id → 位置的 direct map，
+    chunk id 不連續，因此使用 Hashtable 形式（每個向量約多 16 bytes）。
+    """
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None and ivf.direct_map.type == faiss.DirectMap.NoMap:
+        ivf.set_direct_map_type(faiss.DirectMap.Hashtable)
+
+
+def supports_stable_ids(index: faiss.Index) -> bool:
+    """索引是否以 chunk id（而非位置）回傳結果"""
+    return isinstance(index, faiss.IndexIDMap2) or faiss.try_extract_index_ivf(index) is not None
+
+
+# === 全精度向量與重新評分 ==================================
+class FullVectors:
+    """依 chunk id 取回全精度（float32）向量
+
+    量化索引 build 時另存的向量檔為 float32 逐列相接的原始檔（不含標頭），id 另存於 .npy；
+    服務端以 np.memmap 映射，重新評分只讀取候選的那幾列，不會把整份向量載入記憶體。
+    """
+
+    def __init__(self, ids: np.ndarray, vecs: np.ndarray):
+        self.vecs = vecs
+        self._order = np.argsort(ids, kind="stable")
+        self._sorted_ids = np.asarray(ids, dtype="int64")[self._order]
+
+    @classmethod
+    def open(cls, path: str, ids_path: str, dim: int) -> "FullVectors":
+        ids = np.load(ids_path)
+        if len(ids) == 0:
+            return cls(ids, np.zeros((0, dim), dtype="float32"))
+        return cls(ids, np.memmap(path, dtype="float32", mode="r", shape=(len(ids), dim)))
+
+    def __len__(self) -> int:
+        return len(self._sorted_ids)
+
+    def get(self, ids: np.ndarray) -> np.ndarray:
+        """回傳 ids 對應的向量（n x dim）；有不存在的 id 時丟出 KeyError"""
+        ids = np.asarray(ids, dtype="int64").reshape(-1)
+        pos = np.searchsorted(self._sorted_ids, ids)
+        pos = np.minimum(pos, max(0, len(self._sorted_ids) - 1))
+        if len(ids) and (len(self._sorted_ids) == 0 or not np.array_equal(self._sorted_ids[pos], ids)):
+            raise KeyError("全精度向量檔缺少部分 chunk id")
+        return np.asarray(self.vecs[self._order[pos]], dtype="float32")
+
+
+class FullVectorWriter:
+    """逐批附加寫入全精度向量檔（build 管線收到一批就寫一批，不在記憶體中累積）"""
+
+    COPY_BATCH = 65536
+
+    def __init__(self, path: str, ids_path: str):
+        self.path = path
+        self.ids_path = ids_path
+        self._f = open(path, "wb")
+        self._ids: List[np.ndarray] = []
+
+    def append(self, ids: np.ndarray, vecs: np.ndarray):
+        self._f.write(np.ascontiguousarray(vecs, dtype="float32").tobytes())
+        self._ids.append(np.asarray(ids, dtype="int64"))
+
+    def copy_from(self, src: FullVectors, ids: np.ndarray):
+        """增量 build：從上一版向量檔複製沿用的 chunk 向量"""
+        for start in range(0, len(ids), self.COPY_BATCH):
+            part = ids[start:start + self.COPY_BATCH]
+            self.append(part, src.get(part))
+
+    def close(self):
+        self._f.close()
+        ids = np.concatenate(self._ids) if self._ids else np.zeros(0, dtype="int64")
+        with open(self.ids_path, "wb") as f:   # 以檔案物件寫入，np.save 不會自動加上 .npy
+            np.save(f, ids)
+
+    def abort(self):
+        self._f.close()
+        for p in (self.path, self.ids_path):
+            if os.path.exists(p):
+                os.remove(p)
+
+
+class RescoringIndex:
+    """量化索引的外層：先以近似分數取 k * factor 個候選，再以全精度向量重新計算內積並排序
+
+    回傳的分數即為 float32 向量的精確內積（cosine），分數門檻與答案快取的相似度判斷不受量化誤差影響。
+    reconstruct_batch 改為回傳全精度向量（MMR 使用）；其餘屬性（ntotal、d 等）直接轉給內層索引。
+    """
+
+    def __init__(self, index: faiss.Index, vectors: FullVectors, factor: int = RESCORE_FACTOR):
+        self.index = index
+        self.vectors = vectors
+        self.factor = max(1, factor)
+
+    def __getattr__(self, name):
+        return getattr(self.index, name)
+
+    def search(self, x: np.ndarray, k: int):
+        """候選向量依查詢分段取回與計分（每段不超過 RESCORE_BLOCK_BYTES），大批查詢不會一次配置 n x k x d 的陣列"""
+        _, cand = self.index.search(x, k * self.factor)
+        rows = max(1, RESCORE_BLOCK_BYTES // (cand.shape[1] * x.shape[1] * 4))
+        scores = np.empty((len(x), k), dtype="float32")
+        labels = np.empty((len(x), k), dtype="int64")
+        for start in range(0, len(x), rows):
+            end = start + rows
+            scores[start:end], labels[start:end] = self._rescore(x[start:end], cand[start:end], k)
+        return scores, labels
+
+    def _rescore(self, x: np.ndarray, cand: np.ndarray, k: int):
+        valid = cand >= 0
+        vecs = np.zeros(cand.shape + (x.shape[1],), dtype="float32")
+        vecs[valid] = self.vectors.get(cand[valid])
+        scores = np.einsum("nkd,nd->nk", vecs, x)
+        scores[~valid] = -np.inf
+        order = np.argsort(-scores, axis=1, kind="stable")[:, :k]
+        scores = np.take_along_axis(scores, order, axis=1)
+        labels = np.take_along_axis(cand, order, axis=1)
+        missing = np.isneginf(scores)
+        scores[missing] = -np.finfo("float32").max    # 與 faiss 內積索引無結果時的填充值相同
+        return scores.astype("float32"), np.where(missing, -1, labels)
+
+    def reconstruct_batch(self, ids: np.ndarray) -> np.ndarray:
+        return self.vectors.get(ids)
+
+
+def index_bytes(index: faiss.Index) -> int:
+    """索引序列化後的大小（約等於載入後的常駐記憶體）"""
+    return int(faiss.serialize_index(index).size)
+
+
+# === recall / latency 報告 ==================================
+def pick_queries(n: int, n_queries: int, seed: int = 1) -> np.ndarray:
+    """保留作評估的查詢位置（不參與訓練）"""
+    n_queries = min(n_queries, n)
+    return np.sort(np.random.default_rng(seed).choice(n, n_queries, replace=False))
+
+
+def _recall_at_k(index: faiss.Index, queries: np.ndarray, truth: np.ndarray, k: int) -> float:
+    _, got = index.search(queries, k)
+    hits = sum(len(set(g[g >= 0]) & set(t[t >= 0])) for g, t in zip(got, truth))
+    return hits / float(truth.shape[0] * k)
+
+
+def _latency_ms(index: faiss.Index, queries: np.ndarray, k: int) -> Dict[str, float]:
+    # 服務端一次只查一筆，量測單筆查詢延遲
+    times = []
+    for q in queries:
+        t0 = time.perf_counter()
+        index.search(q.reshape(1, -1), k)
+        times.append((time.perf_counter() - t0) * 1000.0)
+    times.sort()
+    return {"p50_ms": times[len(times) // 2], "p95_ms": times[min(len(times) - 1, int(len(times) * 0.95))]}
+
+
+def _sweep_values(index: faiss.Index) -> List[Dict[str, int]]:
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        values, p = [], 1
+        while p < ivf.nlist:
+            values.append(p)
+            p *= 2
+        values.append(int(ivf.nlist))
+        return [{"nprobe": v} for v in values]
+    if _extract_hnsw(index) is not None:
+        return [{"efSearch": v} for v in EF_SEARCH_CANDIDATES]
+    return []
+
+
+def evaluate_index(index: faiss.Index, vecs: np.ndarray, ids: np.ndarray, query_pos: np.ndarray,
+                   k: int, tune: bool = True, fixed_params: Optional[Dict[str, int]] = None,
+                   rescore_factor: Optional[int] = None) -> Dict:
+    """以 flat 索引為基準量測 recall@k、查詢延遲與索引大小
+
+    tune=True 時掃描 nprobe/efSearch，選出達到 TUNE_TARGET_RECALL 的最小值並套用到 index；
+    fixed_params 指定的參數則直接使用、不掃描。
+    rescore_factor 指定時另外量測以全精度向量重新評分（RescoringIndex）後的 recall 與延遲，
+    大小一併計入重新評分用的全精度向量檔（float32 向量 + int64 id）。
+    """
+    queries = np.ascontiguousarray(vecs[query_pos])
+    k = min(k, len(vecs))
+    flat = faiss.IndexFlatIP(vecs.shape[1])
+    flat.add(vecs)
+    _, truth_pos = flat.search(queries, k)
+    truth = np.where(truth_pos >= 0, ids[truth_pos], -1)
+
+    report = {"k": k, "queries": int(len(queries)), "flat": _latency_ms(flat, queries, k), "sweep": []}
+    candidates = [] if fixed_params else _sweep_values(index)
+    chosen = dict(fixed_params or {})
+    if tune and candidates:
+        for params in candidates:
+            set_search_params(index, params)
+            row = {"params": params, "recall": _recall_at_k(index, queries, truth, k)}
+            row.update(_latency_ms(index, queries, k))
+            report["sweep"].append(row)
+        good = [r for r in report["sweep"] if r["recall"] >= TUNE_TARGET_RECALL]
+        chosen = (good[0] if good else report["sweep"][-1])["params"]
+    set_search_params(index, chosen)
+    report["params"] = get_search_params(index)
+    report["recall"] = _recall_at_k(index, queries, truth, k)
+    report.update(_latency_ms(index, queries, k))
+    # float32 flat 基準：每向量 dim * 4 bytes + 8 bytes id（IDMap2）
+    report["vectors"] = int(index.ntotal)
+    report["bytes_per_vector"] = index_bytes(index) / max(1, index.ntotal)
+    report["flat_bytes_per_vector"] = float(vecs.shape[1] * 4 + 8)
+    if rescore_factor:
+        rescored = RescoringIndex(index, FullVectors(ids, vecs), rescore_factor)
+        row = {"factor": int(rescore_factor), "recall": _recall_at_k(rescored, queries, truth, k)}
+        row.update(_latency_ms(rescored, queries, k))
+        report["rescore"] = row
+        report["full_bytes_per_vector"] = float(vecs.shape[1] * 4 + 8)
+    return report
+
+
+def print_report(spec: IndexSpec, report: Dict):
+    flat = report["flat"]
+    print(f"[REPORT] 索引類型：{spec}，評估查詢 {report['queries']} 筆（保留不參與訓練），k={report['k']}")
+    for row in report["sweep"]:
+        print(f"  - {row['params']}: recall@{report['k']}={row['recall']:.4f}  "
+              f"p50={row['p50_ms']:.3f}ms  p95={row['p95_ms']:.3f}ms")
+    print(f"[REPORT] 採用參數：{report['params'] or '（無）'}")
+    print(f"[REPORT] recall@{report['k']}={report['recall']:.4f}  "
+          f"p50={report['p50_ms']:.3f}ms  p95={report['p95_ms']:.3f}ms  "
+          f"（flat 基準 p50={flat['p50_ms']:.3f}ms  p95={flat['p95_ms']:.3f}ms）")
+    if "bytes_per_vector" in report:
+        size, base, n = report["bytes_per_vector"], report["flat_bytes_per_vector"], report["vectors"]
+        full = report.get("full_bytes_per_vector", 0.0)
+        if full:
+            # 重新評分時全精度向量檔與索引一起發佈、記憶體映射，磁碟與 page cache 用量為兩者合計
+            print(f"[REPORT] 索引檔：每向量 {size:.1f} bytes；全精度向量檔（重新評分用）：每向量 {full:.0f} bytes")
+        total = size + full
+        print(f"[REPORT] {'發佈檔案合計' if full else '索引大小'}：每向量 {total:.1f} bytes"
+              f"（float32 flat {base:.0f} bytes），共 {total * n / 1024 ** 2:.1f} MB（flat {base * n / 1024 ** 2:.1f} MB），"
+              f"為 flat 的 {total / base:.2f} 倍")
+    print(f"[REPORT] recall 相對 flat：{report['recall'] - 1.0:+.4f}")
+    rescore = report.get("rescore")
+    if rescore:
+        print(f"[REPORT] 全精度重新評分（候選 {rescore['factor']}×k）：recall@{report['k']}={rescore['recall']:.4f}"
+              f"（相對 flat {rescore['recall'] - 1.0:+.4f}，相對未重新評分 {rescore['recall'] - report['recall']:+.4f}）  "
+              f"p50={rescore['p50_ms']:.3f}ms  p95={rescore['p95_ms']:.3f}ms")
@@ -0,0 +1,316 @@
+from __future__ import annotations
+
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Dict, Hashable, List, Optional
+
+from kb_lazy import lazy_import
+
+np = lazy_import("numpy")
+
+
+# === Embedding 快取（內容定址、磁碟持久化） ==================
+class EmbeddingCache:
+    """以（embedding 模型, 輸入文字 hash）為 key 的向量快取
+
+    - 存放於 SQLite，向量以 float32 原始位元組（BLOB）儲存，不經 JSON 轉換
+    - 記錄最後存取時間，總大小超過 max_bytes 時依 LRU 淘汰
+    - build 重嵌入未變更的 chunk、或重複的查詢，都可直接命中而不打遠端
+    - 命中時的存取時間先記在記憶體，每 ATIME_FLUSH_SECONDS 秒或累積 ATIME_FLUSH_KEYS 筆才寫回一次
+      （查詢路徑不必每次命中都做一次 SQLite 寫入與 commit；淘汰前、寫入新向量與關閉時也會一併寫回）
+    """
+
+    ATIME_FLUSH_SECONDS = 60.0
+    ATIME_FLUSH_KEYS = 1024
+
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._touched: Dict[bytes, float] = {}
+        self._flushed_at = time.monotonic()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS vectors ("
+            " key BLOB PRIMARY KEY,"
+            " dim INTEGER NOT NULL,"
+            " vec BLOB NOT NULL,"
+            " atime REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS vectors_atime ON vectors(atime)")
+        self._conn.commit()
+        row = self._conn.execute("SELECT COALESCE(SUM(LENGTH(vec)), 0) FROM vectors").fetchone()
+        self._bytes = int(row[0])
+
+    @staticmethod
+    def make_key(model: str, text: str) -> bytes:
+        h = hashlib.sha256()
+        h.update(model.encode("utf-8"))
+        h.update(b"\0")
+        h.update(text.encode("utf-8"))
+        return h.digest()
+
+    def get_many(self, model: str, texts: List[str]) -> List[Optional[np.ndarray]]:
+        keys = [self.make_key(model, t) for t in texts]
+        found = {}
+        with self._lock:
+            # SQLite 參數上限預設 999，分批查詢
+            for i in range(0, len(keys), 500):
+                part = keys[i:i + 500]
+                marks = ",".join("?" * len(part))
+                rows = self._conn.execute(
+                    f"SELECT key, vec FROM vectors WHERE key IN ({marks})", part
+                ).fetchall()
+                for k, vec in rows:
+                    found[bytes(k)] = np.frombuffer(vec, dtype="float32")
+            if found:
+                now = time.time()
+                self._touched.update((k, now) for k in found)
+                if (len(self._touched) >= self.ATIME_FLUSH_KEYS
+                        or time.monotonic() - self._flushed_at >= self.ATIME_FLUSH_SECONDS):
+                    self._flush_atime()
+                    self._conn.commit()
+        return [found.get(k) for k in keys]
+
+    def _flush_atime(self):
+        """把記憶體中的存取時間寫回（呼叫端持有 lock，並負責 commit）"""
+        if self._touched:
+            self._conn.executemany("UPDATE vectors SET atime = ? WHERE key = ?",
+                                   [(t, k) for k, t in self._touched.items()])
+            self._touched.clear()
+        self._flushed_at = time.monotonic()
+
+    def put_many(self, model: str, texts: List[str], vecs: np.ndarray):
+        now = time.time()
+        rows = []
+        for t, v in zip(texts, vecs):
+            blob = np.ascontiguousarray(v, dtype="float32").tobytes()
+            rows.append((self.make_key(model, t), int(v.shape[0]), blob, now))
+        with self._lock:
+            for k, _, blob, _ in rows:
+                old = self._conn.execute("SELECT LENGTH(vec) FROM vectors WHERE key = ?", (k,)).fetchone()
+                self._bytes += len(blob) - (old[0] if old else 0)
+            for k, _, _, _ in rows:
+                self._touched.pop(k, None)
+            self._flush_atime()
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO vectors (key, dim, vec, atime) VALUES (?, ?, ?, ?)", rows
+            )
+            self._conn.commit()
+            if self._bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        """刪除最久未使用的向量，直到總大小降到上限的 90%"""
+        target = int(self.max_bytes * 0.9)
+        doomed = []
+        freed = 0
+        for k, size in self._conn.execute("SELECT key, LENGTH(vec) FROM vectors ORDER BY atime"):
+            if self._bytes - freed <= target:
+                break
+            doomed.append((k,))
+            freed += size
+        self._conn.executemany("DELETE FROM vectors WHERE key = ?", doomed)
+        self._conn.commit()
+        self._bytes -= freed
+
+    def size_bytes(self) -> int:
+        return self._bytes
+
+    def close(self):
+        with self._lock:
+            self._flush_atime()
+            self._conn.commit()
+            self._conn.close()
+
+
+# === 摘要快取（內容 hash 為 key、append-only 日誌） ===========
+class SummaryCache:
+    """以內容 hash 為 key 的摘要快取
+
+    - 儲存為 JSONL 日誌，每筆新摘要只追加一行，不再每次重寫整個檔案
+    - 載入時後寫者勝；若日誌中有重複 key 或損毀行，載入後壓縮重寫一次
+    - 多執行緒同時寫入時以 lock 保護
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._data: Dict[str, str] = {}
+        lines = 0
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    lines += 1
+                    try:
+                        obj = json.loads(line)
+                        self._data[obj["k"]] = obj["v"]
+                    except (ValueError, KeyError, TypeError):
+                        continue  # 中斷寫入造成的半行，壓縮時一併清掉
+        if lines != len(self._data):
+            self.compact()
+        self._fh = open(path, "a", encoding="utf-8")
+
+    def compact(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            for k, v in self._data.items():
+                f.write(json.dumps({"k": k, "v": v}, ensure_ascii=False) + "\n")
+        os.replace(tmp, self.path)
+
+    def get(self, key: str) -> Optional[str]:
+        return self._data.get(key)
+
+    def put(self, key: str, value: str):
+        with self._lock:
+            if self._data.get(key) == value:
+                return
+            self._data[key] = value
+            self._fh.write(json.dumps({"k": key, "v": value}, ensure_ascii=False) + "\n")
+            self._fh.flush()
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._data
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def close(self):
+        with self._lock:
+            self._fh.close()
+
+
+# === 行程內 LRU 快取（查詢向量等） ============================
+class LRUCache:
+    """執行緒安全的 LRU 快取，可設定容量與存活時間（TTL，秒；0 表示不過期）"""
+
+    def __init__(self, max_size: int, ttl: float = 0.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            value, expires = item
+            if expires and expires < time.monotonic():
+                del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: Hashable, value):
+        if self.max_size <= 0:
+            return
+        expires = time.monotonic() + self.ttl if self.ttl else 0.0
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+# === 語意答案快取 ============================================
+class AnswerCache:
+    """以查詢向量相似度比對的答案快取
+
+    - 查詢向量（已 L2 normalize）與快取中的向量做內積，最高分 ≥ threshold 且 key 完全相同才視為同一問題
+      （key 由呼叫端決定，例如查詢中的工單號碼、版本號與日期；語意相近但對象不同的問題不會互相命中）
+    - 每筆答案綁定產生時的知識庫（kb）與其索引版本；只命中同一知識庫，該知識庫的索引更新後舊答案不再命中
+    - 依 TTL 過期、容量滿時淘汰最久未使用者
+    向量存放於預先配置的矩陣，查詢只需一次矩陣乘法。
+    """
+
+    def __init__(self, max_entries: int, ttl: float, threshold: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self._vecs: Optional[np.ndarray] = None
+        self._entries: List[Optional[Dict]] = []
+        self._free: List[int] = []
+
+    def _expired(self, entry: Dict, now: float) -> bool:
+        return bool(self.ttl) and now - entry["created"] > self.ttl
+
+    def lookup(self, version: str, qvec: np.ndarray, key: str = "", kb: str = "") -> Optional[str]:
+        if self.max_entries <= 0:
+            return None
+        q = np.asarray(qvec, dtype="float32").reshape(-1)
+        now = time.monotonic()
+        with self._lock:
+            if self._vecs is None or not self._entries or self._vecs.shape[1] != q.shape[0]:
+                return None
+            scores = self._vecs[:len(self._entries)] @ q
+            for slot in np.argsort(-scores):
+                if scores[slot] < self.threshold:
+                    return None
+                entry = self._entries[slot]
+                if entry is None or entry["kb"] != kb or entry["version"] != version or entry["key"] != key:
+                    continue
+                if self._expired(entry, now):
+                    self._drop(int(slot))
+                    continue
+                entry["used"] = now
+                return entry["answer"]
+        return None
+
+    def put(self, version: str, qvec: np.ndarray, query: str, answer: str, key: str = "", kb: str = ""):
+        if self.max_entries <= 0 or not answer:
+            return
+        q = np.asarray(qvec, dtype="float32").reshape(-1)
+        now = time.monotonic()
+        with self._lock:
+            if self._vecs is None or self._vecs.shape[1] != q.shape[0]:
+                self._vecs = np.zeros((self.max_entries, q.shape[0]), dtype="float32")
+                self._entries, self._free = [], []
+            # 優先回收過期或同一知識庫舊版本的位置，再來是空位，最後淘汰最久未使用者
+            for slot, entry in enumerate(self._entries):
+                if entry is not None and ((entry["kb"] == kb and entry["version"] != version)
+                                          or self._expired(entry, now)):
+                    self._drop(slot)
+            if self._free:
+                slot = self._free.pop()
+            elif len(self._entries) < self.max_entries:
+                slot = len(self._entries)
+                self._entries.append(None)
+            else:
+                slot = min(range(len(self._entries)), key=lambda i: self._entries[i]["used"])
+            self._vecs[slot] = q
+            self._entries[slot] = {"kb": kb, "version": version, "key": key, "query": query, "answer": answer,
+                                   "created": now, "used": now}
+
+    def _drop(self, slot: int):
+        self._entries[slot] = None
+        self._vecs[slot] = 0.0
+        self._free.append(slot)
+
+    def clear(self):
+        with self._lock:
+            self._vecs = None
+            self._entries, self._free = [], []
+
+    def __len__(self) -> int:
+        return sum(1 for e in self._entries if e is not None)
@@ -0,0 +1,107 @@
+import os
+import glob
+import hashlib
+from dataclasses import dataclass
+from typing import Iterator, Optional
+
+# === 來源檔案讀取 ===========================================
+# build 時逐檔產出、需要時才讀入內容，不再把整個語料一次讀進記憶體：
+# - 掃描階段只以固定大小的緩衝區串流計算內容 hash（與整份讀入後計算的結果相同，manifest 相容）
+# - 超過 STREAM_FILE_BYTES 的檔案不整份讀入，以緩衝區串流解析 --- 分段後直接切塊
+# - 超過 MAX_FILE_BYTES 的檔案直接略過（避免在小型 CI 機器上 OOM）
+SOURCE_PATTERNS = ("**/*.txt", "**/*.md")
+MAX_FILE_BYTES = int(os.getenv("KB_MAX_FILE_BYTES", str(2 * 1024 ** 3)))          # 單檔大小上限（位元組）；0 = 不限制
+STREAM_FILE_BYTES = int(os.getenv("KB_STREAM_FILE_BYTES", str(32 * 1024 ** 2)))   # 超過此大小改為串流切塊
+READ_BUFFER_CHARS = 1 << 20                # 串流讀取每次讀入的字元數
+SECTION_SEP = "---"
+
+
+@dataclass(frozen=True)
+class SourceFile:
+    path: str
+    hash: str            # 內容 sha256（同 kb_rag.content_hash(整份文字)）
+    size: int            # 檔案大小（位元組）
+
+    @property
+    def streamed(self) -> bool:
+        return self.size > STREAM_FILE_BYTES
+
+    def read_text(self) -> str:
+        with open(self.path, "r", encoding="utf-8") as f:
+            return f.read()
+
+
+def iter_source_paths(folder: str) -> Iterator[str]:
+    for pattern in SOURCE_PATTERNS:
+        yield from glob.iglob(os.path.join(folder, pattern), recursive=True)
+
+
+def read_blocks(path: str, buffer_chars: int = READ_BUFFER_CHARS) -> Iterator[str]:
+    """以文字模式逐塊讀取（換行轉換與整份 read() 相同，\\r\\n 跨區塊時也正確）"""
+    with open(path, "r", encoding="utf-8") as f:
+        while True:
+            block = f.read(buffer_chars)
+            if not block:
+                return
+            yield block
+
+
+def _scan(path: str) -> Optional[SourceFile]:
+    """串流計算內容 hash；空白檔回傳 None"""
+    h = hashlib.sha256()
+    blank = True
+    for block in read_blocks(path):
+        h.update(block.encode("utf-8"))
+        if blank and not block.isspace():
+            blank = False
+    if blank:
+        return None
+    return SourceFile(path=path, hash=h.hexdigest(), size=os.path.getsize(path))
+
+
+def iter_source_files(folder: str, max_bytes: Optional[int] = None) -> Iterator[SourceFile]:
+    """逐一產出資料夾內的 .txt/.md（只含 hash 與大小，內容於處理時才讀入）"""
+    max_bytes = MAX_FILE_BYTES if max_bytes is None else max_bytes
+    for p in iter_source_paths(folder):
+        try:
+            size = os.path.getsize(p)
+            if max_bytes and size > max_bytes:
+                print(f"[WARN] 略過 {p}：檔案大小 {size / 1024 ** 2:.0f} MB 超過上限 "
+                      f"{max_bytes / 1024 ** 2:.0f} MB（KB_MAX_FILE_BYTES）")
+                continue
+            src = _scan(p)
+        except Exception as e:
+            print(f"[WARN] 無法讀取 {p}: {e}")
+            continue
+        if src is not None:
+            yield src
+
+
+def iter_sections(path: str, buffer_chars: int = READ_BUFFER_CHARS) -> Iterator[str]:
+    """串流解析 --- 分段，逐一產出去除前後空白後的非空段落
+
+    與整份讀入後 text.split("---") 的結果相同：每次只保留最後一個（可能未完整的）片段，
+    與下一塊文字接上後再切分，因此跨區塊的分隔符也能正確辨識。
+    單一段落跨越多個區塊時，確定不含分隔符的前段先暫存在清單，不反覆串接。
+    """
+    keep = len(SECTION_SEP) - 1
+    head = []
+    tail = ""
+    for block in read_blocks(path, buffer_chars):
+        parts = (tail + block).split(SECTION_SEP)
+        tail = parts.pop()
+        if not parts:
+            if len(tail) > keep:
+                head.append(tail[:-keep])
+                tail = tail[-keep:]
+            continue
+        if head:
+            parts[0] = "".join(head) + parts[0]
+            head = []
+        for part in parts:
+            part = part.strip()
+            if part:
+                yield part
+    tail = ("".join(head) + tail).strip()
+    if tail:
+        yield tail
@@ -0,0 +1,45 @@
+import importlib
+import sys
+import threading
+import types
+
+# === 延遲匯入 ===============================================
+# faiss / numpy 等較重的模組在第一次使用時才匯入，匯入 kb_rag（app.py、CLI）時不必先付出載入成本。
+# 各模組以 np = lazy_import("numpy") 取代 import numpy as np，用法不變；
+# 型別註記須搭配 from __future__ import annotations，避免定義函式時就存取模組屬性。
+
+
+class LazyModule(types.ModuleType):
+    """第一次存取屬性時才匯入真正模組的代理
+
+    匯入以鎖保護，多個執行緒同時第一次使用也只會匯入一次；
+    匯入後把真正模組的屬性複製到代理上，之後的存取不再經過 __getattr__。
+    """
+
+    def __init__(self, name: str):
+        super().__init__(name)
+        self._lazy_lock = threading.Lock()
+        self._lazy_module = None
+
+    def _load(self) -> types.ModuleType:
+        if self._lazy_module is None:
+            with self._lazy_lock:
+                if self._lazy_module is None:
+                    module = importlib.import_module(self.__name__)
+                    self.__dict__.update(module.__dict__)
+                    self._lazy_module = module
+        return self._lazy_module
+
+    def __getattr__(self, attr: str):
+        return getattr(self._load(), attr)
+
+    def __dir__(self):
+        return dir(self._load())
+
+
+def lazy_import(name: str) -> types.ModuleType:
+    """回傳模組（已匯入時直接回傳本體，否則回傳 LazyModule 代理）"""
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    return LazyModule(name)
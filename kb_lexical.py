@@ -0,0 +1,197 @@
+from __future__ import annotations
+
+import re
+import struct
+import zipfile
+import unicodedata
+from array import array
+from typing import Dict, Iterable, List, Tuple
+
+from kb_lazy import lazy_import
+
+np = lazy_import("numpy")
+
+# === 斷詞 ===================================================
+# 中日韓文字以字元 bigram 切分（單字的詞保留 unigram），
+# 其他文字以英數詞切分並轉小寫；帶連字號/底線/點的詞（如 CUBE-1234、v2.3）
+# 同時保留整詞與各段，讓工單號碼、版本號可整串精確命中
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+_TOKEN_RE = re.compile(
+    r"[㐀-䶿一-鿿豈-﫿぀-ヿ가-힯]+"
+    r"|[0-9a-z]+(?:[-_.][0-9a-z]+)*"
+)
+_CJK_RE = re.compile(r"[㐀-䶿一-鿿豈-﫿぀-ヿ가-힯]")
+_PART_RE = re.compile(r"[-_.]")
+
+
+def tokenize(text: str) -> List[str]:
+    text = unicodedata.normalize("NFKC", text).lower()
+    tokens: List[str] = []
+    for m in _TOKEN_RE.finditer(text):
+        tok = m.group(0)
+        if _CJK_RE.match(tok):
+            if len(tok) == 1:
+                tokens.append(tok)
+            else:
+                tokens.extend(tok[i:i + 2] for i in range(len(tok) - 1))
+        else:
+            tokens.append(tok)
+            parts = _PART_RE.split(tok)
+            if len(parts) > 1:
+                tokens.extend(p for p in parts if p)
+    return tokens
+
+
+# === BM25 倒排索引 ==========================================
+class LexicalIndex:
+    """以 CSR 陣列儲存的 BM25 倒排索引
+
+    term_ptr[t]:term_ptr[t+1] 為詞 t 的 posting 區段，post_doc 為文件列號、post_tf 為詞頻；
+    文件列號對應 ids（chunk id）。查詢全在行程內完成，不需任何遠端呼叫。
+    """
+
+    def __init__(self, vocab: List[str], term_ptr: np.ndarray, post_doc: np.ndarray,
+                 post_tf: np.ndarray, doc_len: np.ndarray, ids: np.ndarray):
+        self.vocab = {t: i for i, t in enumerate(vocab)}
+        self.term_ptr = term_ptr
+        self.post_doc = post_doc
+        self.post_tf = post_tf
+        self.doc_len = doc_len
+        self.ids = ids
+        n = len(ids)
+        df = np.diff(term_ptr).astype("float64")
+        self._idf = np.log1p((n - df + 0.5) / (df + 0.5)).astype("float32")
+        avg = float(doc_len.mean()) if n else 0.0
+        # 每份文件的長度正規化項：k1 * (1 - b + b * len / avgdl)
+        self._norm = (BM25_K1 * (1.0 - BM25_B + BM25_B * doc_len / (avg or 1.0))).astype("float32")
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @classmethod
+    def build(cls, docs: Iterable[Tuple[int, str]]) -> "LexicalIndex":
+        """由 (chunk id, 文字) 建立索引"""
+        builder = LexicalIndexBuilder()
+        for cid, text in docs:
+            builder.add(cid, text)
+        return builder.build()
+
+    def search(self, query: str, k: int) -> List[Tuple[int, float]]:
+        """回傳 [(chunk id, BM25 分數)]，依分數由高到低"""
+        terms = [self.vocab[t] for t in set(tokenize(query)) if t in self.vocab]
+        if not terms or k <= 0:
+            return []
+        scores = np.zeros(len(self.ids), dtype="float32")
+        for t in terms:
+            lo, hi = self.term_ptr[t], self.term_ptr[t + 1]
+            docs = self.post_doc[lo:hi]
+            tf = self.post_tf[lo:hi]
+            # 同一詞在一份文件只有一筆 posting，可直接以索引累加
+            scores[docs] += self._idf[t] * tf * (BM25_K1 + 1.0) / (tf + self._norm[docs])
+        nz = np.flatnonzero(scores)
+        if len(nz) > k:
+            nz = nz[np.argpartition(-scores[nz], k - 1)[:k]]
+        order = nz[np.argsort(-scores[nz], kind="stable")]
+        return [(int(self.ids[r]), float(scores[r])) for r in order]
+
+    def save(self, f):
+        """寫入 .npz（f 可為路徑或檔案物件；不使用 pickle）"""
+        vocab = sorted(self.vocab, key=self.vocab.get)
+        np.savez(f, vocab=np.asarray(vocab, dtype=str), term_ptr=self.term_ptr, post_doc=self.post_doc,
+                 post_tf=self.post_tf, doc_len=self.doc_len, ids=self.ids)
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = False) -> "LexicalIndex":
+        """讀取 .npz；mmap=True 時 posting 等數值陣列以唯讀記憶體映射開啟（多個行程共用 page cache）"""
+        names = ("term_ptr", "post_doc", "post_tf", "doc_len", "ids")
+        with np.load(path, allow_pickle=False) as z:
+            vocab = z["vocab"].tolist()
+            arrays = _memmap_npz(path, names) if mmap else {name: z[name] for name in names}
+        return cls(vocab, *(arrays[name] for name in names))
+
+
+class LexicalIndexBuilder:
+    """逐筆加入切塊、最後產生 LexicalIndex（build 管線邊切塊邊建索引，不保留切塊文字）
+
+    每個詞的 posting 以（列號, 詞頻）交錯存放在 array 中，比 tuple 串列省記憶體。
+    """
+
+    def __init__(self):
+        self._postings: Dict[str, array] = {}
+        self._ids = array("q")
+        self._doc_len = array("q")
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def add(self, cid: int, text: str):
+        row = len(self._ids)
+        tokens = tokenize(text)
+        self._ids.append(int(cid))
+        self._doc_len.append(len(tokens))
+        tf: Dict[str, int] = {}
+        for t in tokens:
+            tf[t] = tf.get(t, 0) + 1
+        for t, c in tf.items():
+            plist = self._postings.get(t)
+            if plist is None:
+                plist = self._postings[t] = array("q")
+            plist.append(row)
+            plist.append(c)
+
+    def build(self) -> LexicalIndex:
+        vocab = sorted(self._postings)
+        term_ptr = np.zeros(len(vocab) + 1, dtype="int64")
+        np.cumsum([len(self._postings[t]) // 2 for t in vocab], out=term_ptr[1:])
+        post_doc = np.empty(int(term_ptr[-1]), dtype="int32")
+        post_tf = np.empty(int(term_ptr[-1]), dtype="float32")
+        for i, t in enumerate(vocab):
+            pairs = np.frombuffer(self._postings[t], dtype="int64")
+            post_doc[term_ptr[i]:term_ptr[i + 1]] = pairs[0::2]
+            post_tf[term_ptr[i]:term_ptr[i + 1]] = pairs[1::2]
+        return LexicalIndex(vocab, term_ptr, post_doc, post_tf,
+                            np.frombuffer(self._doc_len, dtype="int64").astype("float32"),
+                            np.array(self._ids, dtype="int64"))
+
+
+_ZIP_LOCAL_HEADER = struct.Struct("<IHHHHHIIIHH")
+
+
+def _memmap_npz(path: str, names: Iterable[str]) -> Dict[str, np.ndarray]:
+    """以記憶體映射取出未壓縮 .npz（np.savez）中的陣列；壓縮過的成員改為直接讀入"""
+    out: Dict[str, np.ndarray] = {}
+    with zipfile.ZipFile(path) as zf, open(path, "rb") as f:
+        for name in names:
+            info = zf.getinfo(name + ".npy")
+            if info.compress_type != zipfile.ZIP_STORED:
+                with zf.open(info) as member:
+                    out[name] = np.lib.format.read_array(member, allow_pickle=False)
+                continue
+            f.seek(info.header_offset)
+            fields = _ZIP_LOCAL_HEADER.unpack(f.read(_ZIP_LOCAL_HEADER.size))
+            f.seek(fields[-2] + fields[-1], 1)          # 略過檔名與 extra 欄位
+            version = np.lib.format.read_magic(f)
+            read_header = (np.lib.format.read_array_header_1_0 if version == (1, 0)
+                           else np.lib.format.read_array_header_2_0)
+            shape, fortran, dtype = read_header(f)
+            if int(np.prod(shape)) == 0:
+                out[name] = np.zeros(shape, dtype=dtype)
+                continue
+            out[name] = np.memmap(path, dtype=dtype, mode="r", offset=f.tell(), shape=shape,
+                                  order="F" if fortran else "C")
+    return out
+
+
+# === 排名融合 ===============================================
+RRF_K = 60   # Reciprocal Rank Fusion 常數，越大越平均看待各排名
+
+
+def rrf_fuse(rankings: List[List[int]], k: int, rrf_k: int = RRF_K) -> List[Tuple[int, float]]:
+    """以 RRF 融合多組 chunk id 排名：score = Σ 1 / (rrf_k + rank)"""
+    fused: Dict[int, float] = {}
+    for ranking in rankings:
+        for rank, cid in enumerate(ranking, 1):
+            fused[cid] = fused.get(cid, 0.0) + 1.0 / (rrf_k + rank)
+    return sorted(fused.items(), key=lambda x: -x[1])[:k]
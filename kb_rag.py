@@ -1,13 +1,38 @@
+from __future__ import annotations
+
 import os
 import json
-import glob
-import faiss
 import argparse
-from typing import List, Tuple, Dict
-from dataclasses import dataclass
+import time
+import uuid
+import queue
+import re
+import shutil
+import hashlib
+import unicodedata
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Iterator, List, Tuple, Dict, Optional, Union
+from dataclasses import dataclass, replace
+
+from kb_lazy import lazy_import
+from llm_client import get_client, get_async_client
+from kb_chunker import chunk_text, pack_sections
+from kb_ingest import SourceFile, iter_source_files, iter_sections, read_blocks
+from kb_cache import EmbeddingCache, SummaryCache, LRUCache, AnswerCache
+from kb_store import (DocChunk, ChunkStore, MappedChunkStore, BinaryStoreWriter, open_store, read_all_chunks,
+                      write_binary_store)
+import kb_ann
+from kb_lexical import LexicalIndex, LexicalIndexBuilder, rrf_fuse, tokenize
+from kb_tokens import estimate_tokens, truncate_to_tokens, chars_within_tokens
+from kb_ann import IndexSpec, parse_index_spec
 
-import numpy as np
-from openai import OpenAI
+# faiss / numpy 於第一次使用時才匯入（見 kb_lazy.py），LLM 客戶端也在第一次呼叫時才建立，
+# 匯入本模組（app.py、CLI 啟動）只需載入標準函式庫與本專案的小模組
+faiss = lazy_import("faiss")
+np = lazy_import("numpy")
+asyncio = lazy_import("asyncio")   # 只有 ASGI 服務（已載入 asyncio）會用到
 
 # === 環境設定（指向 LiteLLM Proxy） =========================
 # export LITELLM_BASE=https://llm.cubeapp945566.work
@@ -20,20 +45,90 @@ EMBEDDING_MODEL = "intfloat-multilingual-e5-large"
 # EMBEDDING_MODEL = "embeddinggemma"
 CHAT_MODEL      = "gpt-oss-120b"
 
-client = OpenAI(api_key=API_KEY, base_url=BASE_URL)
+# 共用連線池、逾時與重試設定見 llm_client.py
+# client / aclient（ASGI 服務使用）於第一次存取時才建立，見 __getattr__
+def _client():
+    c = globals().get("client")
+    if c is None:
+        c = globals()["client"] = get_client(BASE_URL, API_KEY)
+    return c
+
+def _aclient():
+    c = globals().get("aclient")
+    if c is None:
+        c = globals()["aclient"] = get_async_client(BASE_URL, API_KEY)
+    return c
+
+def __getattr__(name: str):
+    if name == "client":
+        return _client()
+    if name == "aclient":
+        return _aclient()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 # === 參數建議 ==============================================
-CHUNK_SIZE = 384
-CHUNK_OVERLAP = 64
+# 切塊大小 CHUNK_SIZE / CHUNK_OVERLAP 見 kb_chunker.py
 TOP_K = 10
+EMBED_BATCH = 64
+EMBED_WORKERS = int(os.getenv("KB_EMBED_WORKERS", "2"))   # build 時同時進行的 embedding 批次數
+PIPELINE_QUEUE_SIZE = 8                                    # build 管線各階段之間的佇列上限
 INDEX_PATH = "kb.index"
-STORE_PATH = "kb_store.jsonl"
-SUMMARY_CACHE_PATH = "kb_summary_cache.json"
+STORE_PATH = "kb_store.bin"           # 二進位切塊檔（offset 索引 + 記憶體映射）
+LEGACY_STORE_PATH = "kb_store.jsonl"  # 舊版 JSONL 切塊檔，僅供讀取
+LEXICAL_PATH = "kb_lexical.npz"      # BM25 倒排索引（行程內關鍵字檢索，不需 embedding）
+MANIFEST_PATH = "kb_manifest.json"  # 增量 build 用：每個檔案的內容 hash 與 chunk id
+VECTORS_PATH = "kb_vectors.f32"     # 量化索引（fp16 / sq8 / pq）另存的全精度向量，搜尋時記憶體映射、重新評分
+VECTOR_IDS_PATH = "kb_vector_ids.npy"
+VERSION_PATH = "kb.version"        # build 完成後最後寫入，作為索引版本標記
+# 每次 build 的所有檔案寫入各自的版本目錄 BUILDS_DIR/<版本>，CURRENT_PATH 符號連結指向目前版本；
+# 頂層的 kb.index 等路徑為指向 CURRENT_PATH/<檔名> 的符號連結（舊版 build 則為一般檔案）
+BUILDS_DIR = "kb.builds"
+CURRENT_PATH = "kb.current"
+BUILD_FILES = (INDEX_PATH, STORE_PATH, VECTORS_PATH, VECTOR_IDS_PATH, LEXICAL_PATH, MANIFEST_PATH, VERSION_PATH)
+KEEP_BUILDS = int(os.getenv("KB_KEEP_BUILDS", "2"))   # 保留的版本目錄數（含目前版本）
+RELOAD_CHECK_INTERVAL = 2.0        # 檢查磁碟上是否有新版索引的最短間隔（秒）
+# prefork 多 worker 部署（見 gunicorn.conf.py）：索引與關鍵字索引以唯讀記憶體映射開啟，所有 worker 共用 page cache
+INDEX_MMAP = os.getenv("KB_INDEX_MMAP", "0") == "1"
+WARM_KBS = os.getenv("KB_WARM_KBS", "")   # 啟動時一併預熱的知識庫 id（逗號分隔），其餘於第一次查詢時載入
+WARM_READ_BYTES = 1 << 20               # 預熱時每次讀入的位元組數
+WARM_RETRY_SECONDS = float(os.getenv("KB_WARM_RETRY_SECONDS", "10"))   # 預熱失敗後，readiness 檢查重新預熱的最短間隔（秒）
+# 多知識庫：每個 kb id 對應 KB_ROOT/<kb id>/ 下的一組索引檔（以 build --kb <id> 建立）
+KB_ROOT = os.getenv("KB_ROOT", "kbs")
+KB_OPEN_MAX = int(os.getenv("KB_OPEN_MAX", "8"))                                     # 同時開啟的知識庫數上限
+KB_OPEN_MAX_BYTES = int(os.getenv("KB_OPEN_MAX_BYTES", str(4 * 1024 ** 3)))         # 已開啟知識庫的索引檔總大小上限
+CONTEXT_TOKEN_BUDGET = int(os.getenv("KB_CONTEXT_TOKENS", "6000"))   # 檢索內容放入提示詞的 token 上限
+CONTEXT_DEDUP_THRESHOLD = 0.9         # 與已選片段的詞彙 Jaccard 相似度達此值視為近似重複
+CONTEXT_MIN_TRUNCATE_TOKENS = 64      # 剩餘預算少於此值時不再截斷放入最後一個片段
+SEARCH_MODE = os.getenv("KB_SEARCH_MODE", "vector")   # vector | lexical | hybrid（RRF 融合，score 為 RRF 分數）
+SEARCH_MODES = ("vector", "lexical", "hybrid")
+HYBRID_CANDIDATES = 3                 # hybrid 模式各檢索路徑取 k 的幾倍候選再融合
+# 自適應 top-k（環境變數未設定時不啟用，行為與固定 TOP_K 相同）
+SEARCH_MIN_SCORE = os.getenv("KB_SEARCH_MIN_SCORE", "")  # 向量相似度下限（cosine）
+SEARCH_MAX_GAP = os.getenv("KB_SEARCH_MAX_GAP", "")      # 與第一名分數的最大相對落差，例如 0.2
+SEARCH_MAX_K = os.getenv("KB_SEARCH_MAX_K", "")          # 回傳片段數上限（取代 TOP_K）
+SEARCH_MAX_K_LIMIT = int(os.getenv("KB_SEARCH_MAX_K_LIMIT", "100"))   # API 可指定的 max_k 上限（候選數為其數倍）
+MMR_LAMBDA = os.getenv("KB_MMR_LAMBDA", "")              # MMR 相關性權重（0~1，越小越重視多樣性）
+MMR_CANDIDATES = 4                    # MMR 從 k 的幾倍候選中重新挑選
+QUERY_EMBED_BATCH = int(os.getenv("KB_QUERY_EMBED_BATCH", "256"))    # search_many 每個 embeddings 請求最多的查詢數
+QUERY_CACHE_SIZE = int(os.getenv("KB_QUERY_CACHE_SIZE", "4096"))     # 查詢向量 LRU 容量（0 停用）
+QUERY_CACHE_TTL = float(os.getenv("KB_QUERY_CACHE_TTL", "3600"))      # 查詢向量存活秒數（0 不過期）
+ANSWER_CACHE_SIZE = int(os.getenv("KB_ANSWER_CACHE_SIZE", "1024"))        # 語意答案快取容量（0 停用）
+ANSWER_CACHE_TTL = float(os.getenv("KB_ANSWER_CACHE_TTL", "86400"))       # 答案存活秒數（0 不過期）
+ANSWER_CACHE_THRESHOLD = float(os.getenv("KB_ANSWER_CACHE_THRESHOLD", "0.95"))  # 查詢向量相似度門檻
+ANSWER_REPLAY_CHARS = 24                                                  # 快取答案以串流重播時每段字數
+SUMMARY_CACHE_PATH = "kb_summary_cache.jsonl"   # append-only 日誌，key 為內容 hash
+EMBED_CACHE_PATH = os.getenv("KB_EMBED_CACHE", "kb_embed_cache.sqlite")   # 設為空字串可停用
+EMBED_CACHE_MAX_BYTES = int(os.getenv("KB_EMBED_CACHE_MAX_BYTES", str(2 * 1024 ** 3)))
 
 # 摘要相關參數
 SUMMARY_MAX_TOKENS = 150          # 目標摘要長度（粗估 token，會由模型自行截斷）
-SUMMARY_HEAD = "【文件摘要】"      # 放進每個 chunk 的前言標題
+SUMMARY_HEAD = "【文件摘要】"      # 嵌入時放在 chunk 前的摘要標題；提示詞中每個來源的摘要標題
 SUMMARY_SEPARATOR = "\n--- 以上為文件摘要 ---\n"
+SUMMARY_CONCURRENCY = int(os.getenv("KB_SUMMARY_CONCURRENCY", "4"))   # 摘要同時進行中的 LLM 請求上限
+# 分段摘要：每段的 token 上限由摘要模型的 context window 扣除提示詞、推理與輸出保留量決定
+SUMMARY_CONTEXT_TOKENS = int(os.getenv("KB_SUMMARY_CONTEXT_TOKENS", "131072"))   # CHAT_MODEL 的 context window
+SUMMARY_RESERVED_TOKENS = int(os.getenv("KB_SUMMARY_RESERVED_TOKENS", "8192"))   # 提示詞 + 推理 + 輸出保留量
+SUMMARY_SEGMENT_BREAKS = ("\n\n", "。", "！", "？", "!", "?", "\n")   # 分段切點優先順序（段落 > 句尾 > 換行）
 SUMMARY_PROMPT = (
     "你是嚴謹的技術文件摘要助手。請以繁體中文撰寫一段可供檢索前言使用的文件摘要，"
     "要求：\n"
@@ -42,169 +137,246 @@ SUMMARY_PROMPT = (
     "3) 不要使用條列符號，以短段落輸出\n"
 )
 
-# === 資料結構 ===============================================
-@dataclass
-class DocChunk:
-    id: int
-    text: str
-    source: str
-
 # === 工具：檔案與切塊 =======================================
 def read_text_files(folder: str) -> List[Tuple[str, str]]:
-    paths = glob.glob(os.path.join(folder, "**/*.txt"), recursive=True) + \
-            glob.glob(os.path.join(folder, "**/*.md"), recursive=True)
-    docs = []
-    for p in paths:
-        try:
-            with open(p, "r", encoding="utf-8") as f:
-                txt = f.read()
-                if txt.strip():
-                    docs.append((p, txt))
-        except Exception as e:
-            print(f"[WARN] 無法讀取 {p}: {e}")
-    return docs
+    """一次讀入所有 .txt/.md 的內容（build 改用 kb_ingest.iter_source_files 逐檔延遲讀取）"""
+    return [(f.path, f.read_text()) for f in iter_source_files(folder)]
 
-def chunk_text(text: str, size=CHUNK_SIZE, overlap=CHUNK_OVERLAP) -> List[str]:
-    """
-    使用 --- 符號作為分段依據來切分文本
-    確保資料完整性：
-    - 如果一個區塊就大於指定大小，則至少要保持一個區塊完整（可以超過指定大小）
-    - 若至少有一個區塊，則就剛好小於指定大小即可
-    """
-    text = text.strip().replace("\r\n", "\n")
-    
-    # 使用 --- 符號分割文本
-    sections = text.split("---")
-    chunks = []
-    current_chunk = ""
-    
-    for i, section in enumerate(sections):
-        section = section.strip()
-        if not section:
-            continue
-            
-        # 如果當前 chunk 加上新 section 會超過大小限制
-        if current_chunk and len(current_chunk) + len(section) + 5 > size:  # +5 for "\n---\n"
-            # 保存當前 chunk
-            chunks.append(current_chunk.strip())
-            current_chunk = section
-        else:
-            # 將 section 加入當前 chunk
-            if current_chunk:
-                current_chunk += "\n---\n" + section
-            else:
-                current_chunk = section
-    
-    # 處理最後一個 chunk
-    if current_chunk:
-        chunks.append(current_chunk.strip())
-    
-    # 處理過大的 chunk，確保資料完整性
-    final_chunks = []
-    for chunk in chunks:
-        if len(chunk) <= size:
-            # 小於等於指定大小，直接加入
-            final_chunks.append(chunk)
-        else:
-            # 檢查是否只有一個區塊（沒有 --- 分隔符）
-            if "---" not in chunk:
-                # 單一區塊超過大小，保持完整（允許超過指定大小）
-                final_chunks.append(chunk)
-            else:
-                # 多個區塊的 chunk 超過大小，嘗試重新分割
-                # 先嘗試按 --- 重新分割，確保每個區塊完整
-                sub_sections = chunk.split("---")
-                temp_chunk = ""
-                
-                for j, sub_section in enumerate(sub_sections):
-                    sub_section = sub_section.strip()
-                    if not sub_section:
-                        continue
-                    
-                    # 如果當前 temp_chunk 加上新 sub_section 會超過大小限制
-                    if temp_chunk and len(temp_chunk) + len(sub_section) + 5 > size:
-                        # 保存當前 temp_chunk
-                        final_chunks.append(temp_chunk.strip())
-                        temp_chunk = sub_section
-                    else:
-                        # 將 sub_section 加入當前 temp_chunk
-                        if temp_chunk:
-                            temp_chunk += "\n---\n" + sub_section
-                        else:
-                            temp_chunk = sub_section
-                
-                # 處理最後一個 temp_chunk
-                if temp_chunk:
-                    if len(temp_chunk) <= size:
-                        final_chunks.append(temp_chunk.strip())
-                    else:
-                        # 如果仍然太大，使用滑動窗口方式切分（保持重疊）
-                        start = 0
-                        while start < len(temp_chunk):
-                            end = min(start + size, len(temp_chunk))
-                            final_chunks.append(temp_chunk[start:end])
-                            if end == len(temp_chunk):
-                                break
-                            start = end - overlap
-                            if start < 0:
-                                start = 0
-    
-    return final_chunks
+def summary_text_loader(f: SourceFile) -> Union[SourceFile, Callable[[], str]]:
+    """回傳讀取摘要用文字的函式：摘要 worker 開始處理時才讀檔；
+    串流處理的大型檔案直接回傳 SourceFile，由 summarize_document 以緩衝區逐段讀取並分段摘要"""
+    if f.streamed:
+        return f
+    return f.read_text
+
+def file_chunks(f: SourceFile) -> Iterable[str]:
+    """單檔切塊；大型檔案以緩衝區串流解析 --- 分段，逐塊產出、不整份讀入"""
+    if f.streamed:
+        return pack_sections(iter_sections(f.path))
+    return chunk_text(f.read_text())
 
 # === 工具：Embedding ========================================
-def embed_texts(texts: List[str]) -> np.ndarray:
-    resp = client.embeddings.create(model=EMBEDDING_MODEL, input=texts)
+_embed_cache: Optional[EmbeddingCache] = None
+_embed_cache_lock = threading.Lock()
+
+def get_embedding_cache() -> Optional[EmbeddingCache]:
+    global _embed_cache
+    if not EMBED_CACHE_PATH:
+        return None
+    if _embed_cache is None:
+        with _embed_cache_lock:
+            if _embed_cache is None:
+                _embed_cache = EmbeddingCache(EMBED_CACHE_PATH, EMBED_CACHE_MAX_BYTES)
+    return _embed_cache
+
+def _embed_remote(texts: List[str]) -> np.ndarray:
+    resp = _client().embeddings.create(model=EMBEDDING_MODEL, input=texts)
     vecs = [d.embedding for d in resp.data]
     return np.array(vecs, dtype="float32")
 
+def embed_texts(texts: List[str]) -> np.ndarray:
+    """取得文字向量；先查 embedding 快取，只有未命中的文字才呼叫遠端"""
+    cache = get_embedding_cache()
+    if cache is None:
+        return _embed_remote(texts)
+
+    cached = cache.get_many(EMBEDDING_MODEL, texts)
+    missing = list(dict.fromkeys(t for t, v in zip(texts, cached) if v is None))
+    if missing:
+        fresh = _embed_remote(missing)
+        cache.put_many(EMBEDDING_MODEL, missing, fresh)
+        by_text = dict(zip(missing, fresh))
+        cached = [v if v is not None else by_text[t] for t, v in zip(texts, cached)]
+    # 回傳可寫入的副本（呼叫端會就地 normalize_L2）
+    return np.array(cached, dtype="float32")
+
+# === 工具：查詢正規化與查詢向量快取 ==========================
+# /api/search 會在查詢後附加 " #Today: YYYY-MM-DD"，只影響 LLM 對日期的判斷，不參與嵌入
+_DATE_SUFFIX_RE = re.compile(r"\s*#\s*today\s*:\s*\d{4}-\d{1,2}-\d{1,2}\s*$", re.IGNORECASE)
+_WHITESPACE_RE = re.compile(r"\s+")
+
+def split_date_suffix(query: str) -> Tuple[str, str]:
+    """拆出查詢結尾的 #Today 日期標記，回傳 (查詢本文, 日期標記)"""
+    m = _DATE_SUFFIX_RE.search(query)
+    if not m:
+        return query, ""
+    return query[:m.start()], m.group(0).strip()
+
+def normalize_query(query: str) -> str:
+    """查詢正規化：去除日期標記、全形轉半形（NFKC）、合併空白"""
+    base, _ = split_date_suffix(query)
+    base = unicodedata.normalize("NFKC", base)
+    return _WHITESPACE_RE.sub(" ", base).strip()
+
+# 答案快取的精確比對部分：工單號碼、版本號、數字、英文名稱等英數詞
+_ANSWER_KEY_TOKEN_RE = re.compile(r"[0-9a-z]+(?:[._/-][0-9a-z]+)*")
+
+def answer_cache_key(query: str) -> str:
+    """答案快取除了向量相似外還須完全相同的部分：查詢中的英數詞與 #Today 日期
+
+    e5 之類的模型對「CUBE-1234 誰負責」與「CUBE-1235 誰負責」的相似度可能高於門檻，
+    日期不同時「今天 / 本週」的答案也不同，這些情況都不可共用快取答案。
+    """
+    base, date = split_date_suffix(query)
+    tokens = sorted(set(_ANSWER_KEY_TOKEN_RE.findall(unicodedata.normalize("NFKC", base).lower())))
+    return " ".join(tokens) + "|" + re.sub(r"[^0-9-]", "", date)
+
+_query_cache = LRUCache(QUERY_CACHE_SIZE, QUERY_CACHE_TTL)
+
+def embed_query(query: str) -> np.ndarray:
+    """取得查詢向量（1 x dim，未正規化）；相同的正規化查詢在 TTL 內直接命中行程內快取"""
+    text = normalize_query(query) or query.strip()
+    key = (EMBEDDING_MODEL, text)
+    vec = _query_cache.get(key)
+    if vec is None:
+        vec = embed_texts([text])[0]
+        vec.setflags(write=False)
+        _query_cache.put(key, vec)
+    return vec.reshape(1, -1).copy()
+
+def embed_queries(queries: List[str]) -> np.ndarray:
+    """批次取得查詢向量（n x dim，未正規化）
+
+    正規化後相同的查詢只嵌入一次；未命中查詢快取的部分合併成
+    embeddings 請求（每個請求最多 QUERY_EMBED_BATCH 筆），而非逐筆呼叫。
+    """
+    texts = [normalize_query(q) or q.strip() for q in queries]
+    found: Dict[str, np.ndarray] = {}
+    for t in texts:
+        if t not in found:
+            vec = _query_cache.get((EMBEDDING_MODEL, t))
+            if vec is not None:
+                found[t] = vec
+    missing = [t for t in dict.fromkeys(texts) if t not in found]
+    for start in range(0, len(missing), QUERY_EMBED_BATCH):
+        batch = missing[start:start + QUERY_EMBED_BATCH]
+        for t, vec in zip(batch, embed_texts(batch)):
+            vec.setflags(write=False)
+            _query_cache.put((EMBEDDING_MODEL, t), vec)
+            found[t] = vec
+    return np.array([found[t] for t in texts], dtype="float32")
+
+def _query_vector(query: str) -> np.ndarray:
+    qv = embed_query(query)
+    faiss.normalize_L2(qv)
+    return qv
+
+def _try_query_vector(query: str, lexical: Optional[LexicalIndex]) -> Optional[np.ndarray]:
+    """問答用：embedding 失敗且有關鍵字索引時回傳 None，改走關鍵字檢索"""
+    try:
+        return _query_vector(query)
+    except Exception as e:
+        if lexical is None:
+            raise
+        print(f"[WARN] 查詢 embedding 失敗，改用關鍵字檢索：{e}")
+        return None
+
 # === 工具：摘要（含快取） ===================================
-def load_summary_cache() -> Dict[str, str]:
-    if os.path.exists(SUMMARY_CACHE_PATH):
-        try:
-            with open(SUMMARY_CACHE_PATH, "r", encoding="utf-8") as f:
-                return json.load(f)
-        except Exception:
-            return {}
-    return {}
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
 
-def save_summary_cache(cache: Dict[str, str]):
-    with open(SUMMARY_CACHE_PATH, "w", encoding="utf-8") as f:
-        json.dump(cache, f, ensure_ascii=False, indent=2)
+def load_summary_cache() -> SummaryCache:
+    return SummaryCache(SUMMARY_CACHE_PATH)
 
 def safe_head(text: str, max_chars: int) -> str:
     return text.strip().replace("\r\n", " ").replace("\n", " ")[:max_chars]
 
-def chunk_text_for_summary(text: str, chunk_size: int = 50000) -> List[str]:
+def summary_segment_tokens() -> int:
+    return max(1024, SUMMARY_CONTEXT_TOKENS - SUMMARY_RESERVED_TOKENS)
+
+def _segment_break(text: str, lo: int, hi: int) -> int:
+    """在 text[lo:hi] 內找最後一個切點（回傳切點後的位置）；依 SUMMARY_SEGMENT_BREAKS 的優先順序，找不到回傳 hi"""
+    for mark in SUMMARY_SEGMENT_BREAKS:
+        i = text.rfind(mark, lo, hi)
+        if i >= 0:
+            return i + len(mark)
+    return hi
+
+def chunk_text_for_summary(text: str, max_tokens: Optional[int] = None) -> List[str]:
+    """
+    將文件切分為分段摘要用的段落：每段不超過 max_tokens（預設依摘要模型 context window 計算），
+    盡量切在段落或句尾（只在每段後半搜尋切點，避免切出過短的段落）
     """
-    將文件切分為指定大小的段落，用於分段摘要
+    return list(iter_summary_segments([text.strip().replace("\r\n", "\n")], max_tokens))
+
+def iter_summary_segments(blocks: Iterable[str], max_tokens: Optional[int] = None) -> Iterator[str]:
+    """chunk_text_for_summary 的串流版本：逐塊讀入文字、逐段產出，只保留不到兩段的緩衝
+
+    每段的長度上限為 max_tokens * 4 個字元（見 chars_within_tokens），緩衝區超過這個長度時
+    切點已確定，因此切出的段落與整份讀入後切分的結果相同。
     """
-    text = text.strip().replace("\r\n", "\n")
-    chunks = []
+    max_tokens = summary_segment_tokens() if max_tokens is None else max_tokens
+    window = max_tokens * 4
+    text = ""
+    start = 0
+    for block in blocks:
+        text = text[start:] + block if text else block.lstrip()
+        start = 0
+        while len(text) - start > window:
+            end = start + chars_within_tokens(text, start, max_tokens)
+            end = _segment_break(text, start + (end - start) // 2, end)
+            chunk = text[start:end].strip()
+            if chunk:
+                yield chunk
+            start = end
+    text = text[start:].rstrip()
     start = 0
-    
     while start < len(text):
-        end = min(start + chunk_size, len(text))
-        
-        # 嘗試在句號、換行符或段落邊界切分，避免切斷句子
+        end = start + chars_within_tokens(text, start, max_tokens)
         if end < len(text):
-            # 尋找合適的切分點
-            for i in range(end, max(start + chunk_size - 1000, start), -1):
-                if text[i] in ['。', '\n', '\n\n']:
-                    end = i + 1
-                    break
-        
+            end = _segment_break(text, start + (end - start) // 2, end)
         chunk = text[start:end].strip()
         if chunk:
-            chunks.append(chunk)
-        
+            yield chunk
         start = end
-    
-    return chunks
 
-def summarize_chunk(chunk_text: str, chunk_index: int, total_chunks: int) -> str:
+# 所有摘要請求共用的同時請求上限（文件層與段落層的平行都受此限制）
+_summary_slots = threading.BoundedSemaphore(SUMMARY_CONCURRENCY)
+
+def set_summary_concurrency(n: int):
+    """調整摘要同時進行中的 LLM 請求上限"""
+    global SUMMARY_CONCURRENCY, _summary_slots
+    SUMMARY_CONCURRENCY = max(1, int(n))
+    _summary_slots = threading.BoundedSemaphore(SUMMARY_CONCURRENCY)
+
+class _StagedSummaryCache:
+    """暫存單一文件的快取寫入，由呼叫端依文件順序 flush，讓平行摘要時日誌寫入順序仍固定"""
+
+    def __init__(self, base: SummaryCache):
+        self.base = base
+        self.pending: List[Tuple[str, str]] = []
+        self._local: Dict[str, str] = {}
+
+    def get(self, key: str) -> Optional[str]:
+        return self._local.get(key) or self.base.get(key)
+
+    def put(self, key: str, value: str):
+        self._local[key] = value
+        self.pending.append((key, value))
+
+    def flush(self):
+        for key, value in self.pending:
+            self.base.put(key, value)
+        self.pending = []
+
+def summarize_chunk(chunk_text: str, chunk_index: int, total_chunks: int,
+                    cache: Optional[SummaryCache] = None) -> str:
     """
-    對單個文件段落進行摘要
+    對單個文件段落進行摘要；以段落內容 hash 快取，文件只改一段時其他段落直接沿用
     """
+    key, summary, fresh = _summarize_segment(chunk_text, chunk_index, total_chunks, cache)
+    if fresh and cache is not None:
+        cache.put(key, summary)
+    return summary
+
+def _summarize_segment(chunk_text: str, chunk_index: int, total_chunks: int,
+                       cache=None) -> Tuple[str, str, bool]:
+    """回傳 (快取 key, 摘要, 是否為新產生且可寫入快取)；本身不寫快取"""
+    key = f"seg:{content_hash(chunk_text)}:{chunk_index}"
+    if cache is not None:
+        cached = cache.get(key)
+        if cached:
+            return key, cached, False
     try:
         messages = [
             {"role": "system", "content": "你是專業的技術與產品文件摘要助手。"},
@@ -221,42 +393,85 @@ def summarize_chunk(chunk_text: str, chunk_index: int, total_chunks: int) -> str
                 )
             }
         ]
-        resp = client.chat.completions.create(
-            model=CHAT_MODEL,
-            messages=messages,
-            temperature=0.2
-        )
+        with _summary_slots:
+            resp = _client().chat.completions.create(
+                model=CHAT_MODEL,
+                messages=messages,
+                temperature=0.2
+            )
         summary = resp.choices[0].message.content.strip()
         summary = summary.replace("\n\n", "\n").strip()
         if not summary:
             raise ValueError("空摘要")
-        return summary
+        return key, summary, True
     except Exception as e:
+        # 失敗時的截斷摘要不寫入快取，下次 build 會重試
         print(f"[WARN] 段落 {chunk_index + 1} 摘要失敗: {e}")
-        return f"段落 {chunk_index + 1} 重點（自動截斷）：{safe_head(chunk_text, 200)}"
+        return key, f"段落 {chunk_index + 1} 重點（自動截斷）：{safe_head(chunk_text, 200)}", False
+
+def _summarize_segments(segments: Iterable[str], total: int, cache) -> List[str]:
+    """平行摘要各段落（同時請求數受 SUMMARY_CONCURRENCY 限制），依段落順序寫入快取
+
+    段落逐一送出，進行中的段落不超過併發數的兩倍：串流讀入的段落不會同時全部留在記憶體。
+    """
+    workers = max(1, min(SUMMARY_CONCURRENCY, total))
+    summaries = []
+    pending = deque()
+
+    def collect():
+        key, summary, fresh = pending.popleft().result()
+        if fresh:
+            cache.put(key, summary)
+        summaries.append(summary)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for i, segment in enumerate(segments):
+            pending.append(pool.submit(_summarize_segment, segment, i, total, cache))
+            if len(pending) >= 2 * workers:
+                collect()
+        while pending:
+            collect()
+    return summaries
 
-def summarize_document(doc_text: str, source_path: str, cache: Dict[str, str]) -> str:
-    # 以 source_path 當 key（若內容常變動，可改成內容 hash）
-    if source_path in cache and cache[source_path].strip():
-        return cache[source_path]
+def _combine_summaries(summaries: List[str]) -> str:
+    return "\n\n".join([f"段落 {i+1}: {summary}" for i, summary in enumerate(summaries)])
+
+def summarize_document(doc_text: Union[str, SourceFile], source_path: str, cache) -> str:
+    """分段摘要後匯整為文件摘要
+
+    doc_text 也可傳入 SourceFile（串流處理的大型檔案）：以緩衝區逐段讀取，整份內容都納入摘要，
+    但不整份讀入記憶體。
+    """
+    # 以內容 hash 當 key：內容變更會重新摘要，改名/搬移則直接沿用（SourceFile.hash 與 content_hash 相同）
+    streamed = isinstance(doc_text, SourceFile)
+    doc_key = f"doc:{doc_text.hash if streamed else content_hash(doc_text)}"
+    cached = cache.get(doc_key)
+    if cached and cached.strip():
+        return cached
 
     print(f"[INFO] 開始分段摘要處理：{source_path}")
     
-    # 將文件切分為50000字的段落
-    text_chunks = chunk_text_for_summary(doc_text, 50000)
-    print(f"[INFO] 文件切分為 {len(text_chunks)} 個段落")
-    
-    # 對每個段落進行摘要
-    chunk_summaries = []
-    for i, chunk in enumerate(text_chunks):
-        print(f"[INFO] 處理段落 {i + 1}/{len(text_chunks)}")
-        chunk_summary = summarize_chunk(chunk, i, len(text_chunks))
-        chunk_summaries.append(chunk_summary)
-    
+    # 依摘要模型的 context window 切分段落（一般文件只有一段）
+    if streamed:
+        # 先掃過一次取得段落數（提示詞標示「第 i/n 段」），摘要時再逐段讀取
+        total = sum(1 for _ in iter_summary_segments(read_blocks(doc_text.path)))
+        text_chunks = iter_summary_segments(read_blocks(doc_text.path))
+    else:
+        text_chunks = chunk_text_for_summary(doc_text)
+        total = len(text_chunks)
+    print(f"[INFO] 文件切分為 {total} 個段落")
+    chunk_summaries = _summarize_segments(text_chunks, total, cache)
+
+    # 段落很多（大型檔案）時，段落摘要串接後可能超出一次請求的上限：先分組摘要，直到放得進一次匯整
+    combined_summaries = _combine_summaries(chunk_summaries)
+    while len(chunk_summaries) > 1 and estimate_tokens(combined_summaries) > summary_segment_tokens():
+        groups = chunk_text_for_summary(combined_summaries)
+        print(f"[INFO] 段落摘要過長，先分為 {len(groups)} 組匯整")
+        chunk_summaries = _summarize_segments(groups, len(groups), cache)
+        combined_summaries = _combine_summaries(chunk_summaries)
+
     # 將所有段落摘要匯整為完整文件摘要
     try:
-        combined_summaries = "\n\n".join([f"段落 {i+1}: {summary}" for i, summary in enumerate(chunk_summaries)])
-        
         messages = [
             {"role": "system", "content": "你是專業的技術與產品文件摘要助手。"},
             {
@@ -272,182 +487,1460 @@ def summarize_document(doc_text: str, source_path: str, cache: Dict[str, str]) -
                 )
             }
         ]
-        resp = client.chat.completions.create(
-            model=CHAT_MODEL,
-            messages=messages,
-            temperature=0.2
-        )
+        with _summary_slots:
+            resp = _client().chat.completions.create(
+                model=CHAT_MODEL,
+                messages=messages,
+                temperature=0.2
+            )
         final_summary = resp.choices[0].message.content.strip()
         final_summary = final_summary.replace("\n\n", "\n").strip()
         if not final_summary:
             raise ValueError("空摘要")
+        cache.put(doc_key, final_summary)
     except Exception as e:
         print(f"[WARN] 最終摘要匯整失敗，使用段落摘要串接: {e}")
         final_summary = "文件摘要（段落摘要串接）：\n" + "\n".join(chunk_summaries)
 
-    cache[source_path] = final_summary
-    save_summary_cache(cache)
     print(f"[INFO] 完成文件摘要：{final_summary[:100]}...")
     return final_summary
 
+def embedding_input(chunk: DocChunk) -> str:
+    """嵌入用文字：摘要前言 + chunk（與檢索品質有關，仍保留摘要前綴）"""
+    if chunk.summary:
+        return attach_summary_prefix(chunk.summary, chunk.text)
+    return chunk.text
+
+def summarize_documents(docs: List[Tuple[str, Union[str, SourceFile, Callable[[], str]]]], cache: SummaryCache):
+    """平行摘要多份文件，依輸入順序逐一產出 (source, summary)
+
+    每份文件的快取寫入先暫存，輪到該文件產出時才依序寫入日誌，
+    因此輸出順序與快取內容不受完成先後影響。
+    文件內容也可傳入讀取函式：worker 開始處理時才讀入，同時在記憶體中的文件數不超過摘要併發數。
+    串流處理的大型檔案傳入 SourceFile，由 summarize_document 逐段讀取。
+    """
+    def work(doc):
+        src, txt = doc
+        staged = _StagedSummaryCache(cache)
+        print(f"[INFO] 摘要：{src}")
+        return staged, summarize_document(txt() if callable(txt) else txt, src, staged)
+
+    with ThreadPoolExecutor(max_workers=SUMMARY_CONCURRENCY) as pool:
+        for (src, _), (staged, summary) in zip(docs, pool.map(work, docs)):
+            staged.flush()
+            yield src, summary
+
 def attach_summary_prefix(summary: str, chunk_text: str) -> str:
-    # 將摘要作為前言，灌入每個 chunk
+    # 將摘要作為前言接在 chunk 前（僅用於嵌入；store 中的 chunk 不重複存摘要）
     prefix = f"{SUMMARY_HEAD}\n{summary}\n{SUMMARY_SEPARATOR}"
     return prefix + chunk_text
 
 # === 建庫流程 ===============================================
-def build_index(corpus_folder: str):
+def load_manifest() -> Dict:
+    if os.path.exists(MANIFEST_PATH):
+        try:
+            with open(MANIFEST_PATH, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except Exception as e:
+            print(f"[WARN] 無法讀取 {MANIFEST_PATH}，改為完整重建：{e}")
+    return {}
+
+def save_manifest(manifest: Dict, path: str):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False)
+
+def new_id_index(dim: int) -> faiss.Index:
+    # 內積 + L2 normalize（對 bge 系列友善）；外層 IDMap2 讓向量帶穩定 id，可增刪
+    return faiss.IndexIDMap2(faiss.IndexFlatIP(dim))
+
+def _load_incremental_base(manifest: Dict, spec: IndexSpec):
+    """讀取上一版可增量更新的索引與切塊；條件不符時回傳 None（改為完整重建）"""
+    if not manifest.get("files"):
+        return None
+    if manifest.get("embedding_model") != EMBEDDING_MODEL:
+        print(f"[INFO] Embedding 模型已變更（{manifest.get('embedding_model')} → {EMBEDDING_MODEL}），完整重建")
+        return None
+    if manifest.get("index_spec", kb_ann.DEFAULT_INDEX_SPEC) != str(spec):
+        print(f"[INFO] 索引類型已變更（{manifest.get('index_spec', kb_ann.DEFAULT_INDEX_SPEC)} → {spec}），完整重建")
+        return None
+    store_path = resolve_store_path(STORE_PATH)
+    if not (os.path.exists(INDEX_PATH) and os.path.exists(store_path)):
+        return None
+    if spec.quantized and kb_ann.RESCORE and not (os.path.exists(VECTORS_PATH) and os.path.exists(VECTOR_IDS_PATH)):
+        print("[INFO] 找不到上一版的全精度向量檔，完整重建")
+        return None
+    index = faiss.read_index(INDEX_PATH)
+    if not kb_ann.supports_stable_ids(index):
+        print("[INFO] 既有索引不支援穩定 id（舊版格式），完整重建")
+        return None
+    return index, open_store(store_path)
+
+def _diff_files(current: Dict[str, SourceFile], old_files: Dict[str, Dict]):
+    """回傳 (需處理的新增/變更檔, 需刪除向量的移除/變更檔)"""
+    todo = [f for src, f in current.items() if old_files.get(src, {}).get("hash") != f.hash]
+    stale = [src for src in old_files if src not in current or old_files[src]["hash"] != current[src].hash]
+    return todo, stale
+
+_DONE = object()   # 管線階段結束的哨兵
+
+def _qput(q: "queue.Queue", item, stop: threading.Event):
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.2)
+            return
+        except queue.Full:
+            continue
+
+def _qget(q: "queue.Queue", stop: threading.Event):
+    while not stop.is_set():
+        try:
+            return q.get(timeout=0.2)
+        except queue.Empty:
+            continue
+    return _DONE
+
+def _run_build_pipeline(todo: List[SourceFile], summary_cache: SummaryCache,
+                        next_id: int, index: Optional[faiss.Index], spec: IndexSpec,
+                        store_writer: BinaryStoreWriter, lexical: LexicalIndexBuilder,
+                        keep_vectors: bool = False, holdout_queries: int = 0,
+                        vector_writer: Optional[kb_ann.FullVectorWriter] = None):
+    """串流式 build 管線，各階段以有界佇列相連、同時運作
+
+    摘要（平行）→ 切塊 → 嵌入（EMBED_WORKERS 個 worker）→ 寫入索引（呼叫端執行緒）。
+    一份文件的摘要一完成，它的 chunk 就開始嵌入，不必等所有文件摘要完畢；
+    chunk id 依文件順序配發，結果與逐階段執行相同。
+    文件內容在摘要與切塊時才從磁碟讀入，處理完即釋放，不會整個語料同時留在記憶體中；
+    切塊一產生就寫入 store_writer（切塊檔）並加入 lexical（關鍵字索引），管線只保留 id，
+    記憶體中的切塊文字只有佇列裡等待嵌入的批次。
+    需要訓練的索引（IVF/PQ）會先累積訓練樣本，訓練完成後再串流寫入。
+    keep_vectors=True 時一併回傳本次嵌入的 (ids, 向量, 保留查詢位置)，供 recall/latency 報告使用；
+    保留作評估的 holdout_queries 筆向量不參與訓練。
+    vector_writer 指定時，寫入索引的每批向量同時以全精度附加寫入向量檔（量化索引重新評分用）。
+    """
+    doc_q: "queue.Queue" = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    batch_q: "queue.Queue" = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    vec_q: "queue.Queue" = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    stop = threading.Event()
+    errors: List[BaseException] = []
+    entries: Dict[str, Dict] = {}
+    state = {"next_id": next_id, "chunks": 0}
+
+    def stage(fn, out_q: "queue.Queue", n_done: int = 1):
+        def run():
+            try:
+                fn()
+            except BaseException as e:
+                errors.append(e)
+                stop.set()
+            finally:
+                for _ in range(n_done):
+                    _qput(out_q, _DONE, stop)
+        return run
+
+    def summarize_stage():
+        docs = [(f.path, summary_text_loader(f)) for f in todo]
+        for f, (_, doc_summary) in zip(todo, summarize_documents(docs, summary_cache)):
+            if stop.is_set():
+                return
+            print(f"[INFO] 摘要：{doc_summary}")
+            _qput(doc_q, (f, doc_summary), stop)
+
+    def chunk_stage():
+        pending: List[DocChunk] = []
+        while True:
+            item = _qget(doc_q, stop)
+            if item is _DONE:
+                break
+            f, doc_summary = item
+            src = f.path
+            ids = []
+            for ch in file_chunks(f):
+                c = DocChunk(id=state["next_id"], text=ch, source=src, summary=doc_summary)
+                state["next_id"] += 1
+                state["chunks"] += 1
+                store_writer.add(c)
+                lexical.add(c.id, c.text)
+                ids.append(c.id)
+                pending.append(c)
+                if len(pending) >= EMBED_BATCH:
+                    _qput(batch_q, pending, stop)
+                    pending = []
+            entries[src] = {"hash": f.hash, "chunk_ids": ids}
+        if pending:
+            _qput(batch_q, pending, stop)
+
+    def embed_stage():
+        while True:
+            part = _qget(batch_q, stop)
+            if part is _DONE:
+                return
+            vecs = embed_texts([embedding_input(c) for c in part])
+            faiss.normalize_L2(vecs)
+            _qput(vec_q, (np.array([c.id for c in part], dtype="int64"), vecs), stop)
+
+    workers = max(1, EMBED_WORKERS)
+    threads = [threading.Thread(target=stage(summarize_stage, doc_q), name="kb-build-summarize", daemon=True),
+               threading.Thread(target=stage(chunk_stage, batch_q, workers), name="kb-build-chunk", daemon=True)]
+    threads += [threading.Thread(target=stage(embed_stage, vec_q), name=f"kb-build-embed-{i}", daemon=True)
+                for i in range(workers)]
+    for t in threads:
+        t.start()
+
+    # 寫入階段：收到的向量批次直接加入索引
+    kept_ids: List[np.ndarray] = []
+    kept_vecs: List[np.ndarray] = []
+    train_ids: List[np.ndarray] = []
+    train_vecs: List[np.ndarray] = []
+    n_train = 0
+    added = 0
+    holdout: Optional[np.ndarray] = None
+
+    def add(ids: np.ndarray, vecs: np.ndarray):
+        nonlocal added
+        index.add_with_ids(vecs, ids)
+        if vector_writer is not None:
+            vector_writer.append(ids, vecs)
+        added += len(ids)
+        print(f"  - 已嵌入並寫入 {added} 片段")
+
+    def train_and_flush():
+        nonlocal index, train_ids, train_vecs, holdout
+        vecs = np.vstack(train_vecs)
+        if keep_vectors and holdout_queries:
+            # 訓練樣本即為已收集向量的前段，保留查詢的位置兩者一致
+            holdout = kb_ann.pick_queries(len(vecs), holdout_queries)
+        sample = kb_ann.train_sample(vecs, exclude=holdout)
+        index = kb_ann.create_index(spec, vecs.shape[1], n_train=len(sample))
+        print(f"[INFO] 以 {len(sample)} 筆向量訓練 {spec} 索引…")
+        index.train(sample)
+        add(np.concatenate(train_ids), vecs)
+        train_ids, train_vecs = [], []
+
+    done = 0
+    while done < workers:
+        item = _qget(vec_q, stop)
+        if item is _DONE:
+            done += 1
+            continue
+        ids, vecs = item
+        if keep_vectors:
+            kept_ids.append(ids)
+            kept_vecs.append(vecs)
+        if index is None and spec.needs_training:
+            train_ids.append(ids)
+            train_vecs.append(vecs)
+            n_train += len(ids)
+            if n_train >= kb_ann.TRAIN_SAMPLE_MAX:
+                train_and_flush()
+            continue
+        if index is None:
+            print(f"[INFO] 向量維度：{vecs.shape[1]}")
+            index = kb_ann.create_index(spec, vecs.shape[1])
+        add(ids, vecs)
+    if train_vecs and not errors:
+        train_and_flush()
+
+    stop.set()
+    for t in threads:
+        t.join()
+    if errors:
+        raise errors[0]
+    vectors = None
+    if keep_vectors and kept_ids:
+        vecs = np.vstack(kept_vecs)
+        if holdout is None:
+            holdout = kb_ann.pick_queries(len(vecs), holdout_queries)
+        vectors = (np.concatenate(kept_ids), vecs, holdout)
+    return state["chunks"], entries, state["next_id"], index, vectors
+
+def build_index(corpus_folder: str, incremental: bool = False,
+                summary_concurrency: Optional[int] = None,
+                index_spec: str = kb_ann.DEFAULT_INDEX_SPEC,
+                search_params: Optional[Dict[str, int]] = None,
+                report: bool = False, report_queries: int = 200):
+    if summary_concurrency:
+        set_summary_concurrency(summary_concurrency)
+    spec = parse_index_spec(index_spec)
     print(f"[INFO] 掃描資料夾：{corpus_folder}")
-    files = read_text_files(corpus_folder)
-    if not files:
+    # 只保留每個檔案的 hash 與大小，內容於管線處理時才讀入
+    current = {f.path: f for f in iter_source_files(corpus_folder)}
+    if not current:
         print("[ERROR] 找不到任何 .txt/.md 檔案")
         return
 
     summary_cache = load_summary_cache()
 
-    chunks: List[DocChunk] = []
-    idx = 0
+    manifest = load_manifest() if incremental else {}
+    base = _load_incremental_base(manifest, spec) if incremental else None
 
-    # 逐檔：先摘要，再切塊，最後把摘要前言附加到每個 chunk
-    for src, txt in files:
-        print(f"[INFO] 摘要：{src}")
-        doc_summary = summarize_document(txt, src, summary_cache)
-        print(f"[INFO] 摘要：{doc_summary}")
-        for ch in chunk_text(txt):
-            combined = attach_summary_prefix(doc_summary, ch)
-            chunks.append(DocChunk(id=idx, text=combined, source=src))
-            idx += 1
-
-    print(f"[INFO] 完成切塊（含摘要前綴），共 {len(chunks)} 片段。開始嵌入…（{EMBEDDING_MODEL}）")
-    # 批次嵌入
-    batch = 64
-    all_vecs = []
-    for i in range(0, len(chunks), batch):
-        batch_texts = [c.text for c in chunks[i:i+batch]]
-        vecs = embed_texts(batch_texts)
-        all_vecs.append(vecs)
-        print(f"  - 嵌入 {i} ~ {min(i+batch-1, len(chunks)-1)}")
-
-    embs = np.vstack(all_vecs)
-    dim = embs.shape[1]
-    print(f"[INFO] 向量維度：{dim}")
-
-    # 內積 + L2 normalize（對 bge 系列友善）
-    faiss.normalize_L2(embs)
-    index = faiss.IndexFlatIP(dim)
-    index.add(embs)
-
-    faiss.write_index(index, INDEX_PATH)
-    save_store(chunks, STORE_PATH)
-    print(f"[OK] 已建立索引：{INDEX_PATH}，儲存切塊對應：{STORE_PATH}")
+    # 比對內容 hash：只處理新增或變更的檔案，刪除已移除/變更檔案的向量
+    todo, stale = _diff_files(current, manifest.get("files", {}) if base else {})
+    if base is not None and stale and not spec.supports_remove:
+        print(f"[INFO] {spec} 索引不支援刪除向量，有 {len(stale)} 檔移除/變更，完整重建")
+        base = None
+        todo, stale = _diff_files(current, {})
+    if base is None:
+        manifest = {}
+        index, old_store = None, None
+    else:
+        index, old_store = base
+    old_files: Dict[str, Dict] = manifest.get("files", {})
+    next_id = int(manifest.get("next_id", 0))
+    if base is not None:
+        print(f"[INFO] 增量 build：新增/變更 {len(todo)} 檔，移除/變更 {len(stale)} 檔，"
+              f"沿用 {len(current) - len(todo)} 檔")
+        if not todo and not stale:
+            print("[OK] 內容無變更，索引維持不變")
+            return
+
+    stale_ids = [cid for src in stale for cid in old_files[src]["chunk_ids"]]
+    if stale_ids:
+        index.remove_ids(np.array(stale_ids, dtype="int64"))
+    stale_set = set(stale_ids)
+    files_manifest = {src: entry for src, entry in old_files.items() if src not in stale}
+
+    # 量化索引：全精度向量另存一份（沿用的 chunk 從上一版向量檔複製），與索引一起發佈；停用重新評分時不另存
+    vector_writer = None
+    if spec.quantized and kb_ann.RESCORE:
+        vector_writer = kb_ann.FullVectorWriter(VECTORS_PATH + ".tmp", VECTOR_IDS_PATH + ".tmp")
+    # 切塊檔與關鍵字索引邊產生邊寫入：沿用的切塊從上一版切塊檔逐筆複製，新切塊由管線寫入
+    store_writer = BinaryStoreWriter(STORE_PATH + ".tmp")
+    lexical = LexicalIndexBuilder()
+    print(f"[INFO] 開始 build 管線：摘要 → 切塊 → 嵌入（含摘要前綴）（{EMBEDDING_MODEL}）→ 寫入索引（{spec}）")
+    try:
+        kept_ids: List[int] = []
+        if old_store is not None:
+            for c in old_store:
+                if c.id not in stale_set:
+                    store_writer.add(c)
+                    lexical.add(c.id, c.text)
+                    kept_ids.append(c.id)
+            old_store = None
+        if vector_writer is not None and kept_ids:
+            old = kb_ann.FullVectors.open(VECTORS_PATH, VECTOR_IDS_PATH, index.d)
+            vector_writer.copy_from(old, np.array(kept_ids, dtype="int64"))
+            del old
+        n_chunks, entries, next_id, index, vectors = _run_build_pipeline(
+            todo, summary_cache, next_id, index, spec, store_writer, lexical,
+            keep_vectors=report and base is None, holdout_queries=report_queries,
+            vector_writer=vector_writer)
+    except BaseException:
+        store_writer.abort()
+        if vector_writer is not None:
+            vector_writer.abort()
+        raise
+    files_manifest.update(entries)
+    print(f"[INFO] 完成切塊與嵌入，共 {n_chunks} 片段")
+
+    if index is None:
+        store_writer.abort()
+        if vector_writer is not None:
+            vector_writer.abort()
+        print("[ERROR] 沒有任何可索引的片段")
+        return
+    store_writer.close()
+    if vector_writer is not None:
+        vector_writer.close()
+
+    params = dict(manifest.get("search_params", {}))
+    params.update(search_params or {})
+    kb_ann.set_search_params(index, params)
+    if report:
+        if vectors is None:
+            print("[REPORT] 增量 build 只嵌入變更的片段，略過 recall/latency 報告（請以完整 build 產生報告）")
+        else:
+            ids, vecs, query_pos = vectors
+            result = kb_ann.evaluate_index(index, vecs, ids, query_pos, k=TOP_K, fixed_params=search_params,
+                                           rescore_factor=kb_ann.RESCORE_FACTOR if vector_writer is not None else None)
+            kb_ann.print_report(spec, result)
+    params = kb_ann.get_search_params(index)
+
+    manifest = {
+        "embedding_model": EMBEDDING_MODEL,
+        "index_spec": str(spec),
+        "search_params": params,
+        "next_id": next_id,
+        "files": files_manifest,
+    }
+    lexical_index = lexical.build()
+    print(f"[INFO] 關鍵字索引完成，共 {len(lexical_index.vocab)} 個詞")
+    publish_index(index, None, manifest, search_params=params, lexical=lexical_index,
+                  full_vectors=vector_writer is not None)
+    print(f"[OK] 已建立索引：{INDEX_PATH}（{spec}，{index.ntotal} 向量{'，' + str(params) if params else ''}），"
+          f"儲存切塊對應：{STORE_PATH}")
+    if vector_writer is not None:
+        print(f"[OK] 全精度向量（重新評分用）：{VECTORS_PATH}")
     print(f"[OK] 摘要快取：{SUMMARY_CACHE_PATH}")
 
 # === 檢索 + 生成 ===========================================
 def load_store(path: str) -> List[DocChunk]:
-    chunks = []
-    with open(path, "r", encoding="utf-8") as f:
-        for line in f:
-            obj = json.loads(line)
-            chunks.append(DocChunk(id=obj["id"], text=obj["text"], source=obj["source"]))
-    return chunks
+    """讀出所有切塊（二進位或舊版 JSONL 皆可）"""
+    return read_all_chunks(path)
 
 def save_store(chunks: List[DocChunk], path: str):
-    with open(path, "w", encoding="utf-8") as f:
-        for c in chunks:
-            f.write(json.dumps({"id": c.id, "text": c.text, "source": c.source}, ensure_ascii=False) + "\n")
+    write_binary_store(chunks, path)
 
-def load_index() -> Tuple[faiss.Index, List[DocChunk]]:
-    if not (os.path.exists(INDEX_PATH) and os.path.exists(STORE_PATH)):
-        raise FileNotFoundError("請先執行 build 建立知識庫索引（kb.index / kb_store.jsonl）。")
-    index = faiss.read_index(INDEX_PATH)
-    chunks = load_store(STORE_PATH)
-    return index, chunks
+def publish_index(index: faiss.Index, chunks: Optional[List[DocChunk]], manifest: Optional[Dict] = None,
+                  search_params: Optional[Dict[str, int]] = None,
+                  lexical: Optional[LexicalIndex] = None, full_vectors: bool = False) -> str:
+    """以原子方式發佈新版索引
 
-def search(index: faiss.Index, query: str, k=TOP_K) -> List[Tuple[DocChunk, float]]:
-    qv = embed_texts([query])
-    faiss.normalize_L2(qv)
-    scores, idxs = index.search(qv, k)
-    idxs = idxs[0]
-    scores = scores[0]
-    store = load_store(STORE_PATH)
+    索引、切塊檔、全精度向量、關鍵字索引、manifest 與版本檔都寫入新的版本目錄 BUILDS_DIR/<版本>，
+    寫完後以一次 os.replace 把 CURRENT_PATH 連結指向新目錄；服務端從同一個版本目錄載入整份快照，
+    不會把新版的 kb.index 與舊版的切塊檔、向量檔或關鍵字索引混在一起。
+    chunks=None 表示 build 已以 BinaryStoreWriter 寫好切塊暫存檔（STORE_PATH.tmp）。
+    full_vectors=True 表示 build 已寫好全精度向量暫存檔（FullVectorWriter），一併發佈並記錄於版本檔。
+    """
+    version = f"{int(time.time())}-{uuid.uuid4().hex[:8]}"
+    build_dir = os.path.join(BUILDS_DIR, version)
+    os.makedirs(build_dir)
+    faiss.write_index(index, os.path.join(build_dir, INDEX_PATH))
+    if chunks is not None:
+        save_store(chunks, os.path.join(build_dir, STORE_PATH))
+    else:
+        os.replace(STORE_PATH + ".tmp", os.path.join(build_dir, STORE_PATH))
+    if full_vectors:
+        os.replace(VECTORS_PATH + ".tmp", os.path.join(build_dir, VECTORS_PATH))
+        os.replace(VECTOR_IDS_PATH + ".tmp", os.path.join(build_dir, VECTOR_IDS_PATH))
+    if lexical is not None:
+        with open(os.path.join(build_dir, LEXICAL_PATH), "wb") as f:
+            lexical.save(f)
+    if manifest is not None:
+        save_manifest(manifest, os.path.join(build_dir, MANIFEST_PATH))
+    with open(os.path.join(build_dir, VERSION_PATH), "w", encoding="utf-8") as f:
+        json.dump({"version": version, "built_at": time.time(),
+                   "search_params": search_params or {}, "full_vectors": full_vectors}, f)
+    _replace_symlink(build_dir, CURRENT_PATH)
+    # 頂層路徑改為指向目前版本的連結（第一次發佈時建立、取代舊版 build 的一般檔案；版本檔最後）
+    for name in BUILD_FILES:
+        target = os.path.join(CURRENT_PATH, name)
+        if not (os.path.islink(name) and os.readlink(name) == target):
+            _replace_symlink(target, name)
+    _prune_builds(build_dir)
+    return version
+
+def _replace_symlink(target: str, path: str):
+    tmp = path + ".link"
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    os.symlink(target, tmp)
+    os.replace(tmp, path)
+
+def _prune_builds(keep: str):
+    """刪除較舊的版本目錄，只保留最近 KEEP_BUILDS 份
+
+    已載入舊版的行程不受影響（已開啟、映射的檔案在刪除後仍可讀取，直到快照釋放）。
+    """
+    builds = sorted((os.path.join(BUILDS_DIR, d) for d in os.listdir(BUILDS_DIR)),
+                    key=os.path.getmtime, reverse=True)
+    for path in builds[max(1, KEEP_BUILDS):]:
+        if path != keep:
+            shutil.rmtree(path, ignore_errors=True)
+
+def _read_version(path: str) -> Dict:
+    with open(path, "r", encoding="utf-8") as f:
+        info = json.load(f)
+    info["version"] = str(info["version"])
+    return info
+
+# 行程內共用的切塊資料（每個檔案只開啟一次，search/ask/ask_stream 與 Flask 共用）
+_store_lock = threading.Lock()
+_store_cache: Dict[str, Tuple[Tuple[float, int], Union[ChunkStore, MappedChunkStore]]] = {}
+
+def resolve_store_path(path: str = STORE_PATH) -> str:
+    """二進位切塊檔不存在時，退回讀取舊版 build 的 kb_store.jsonl"""
+    if not os.path.exists(path) and path == STORE_PATH and os.path.exists(LEGACY_STORE_PATH):
+        return LEGACY_STORE_PATH
+    return path
+
+def get_store(path: str = STORE_PATH) -> Union[ChunkStore, MappedChunkStore]:
+    """取得行程內共用的切塊資料（MappedChunkStore；舊版 JSONL 則為 ChunkStore）
+
+    第一次呼叫時開啟（二進位檔只映射、不解碼文字），之後直接回傳同一份；
+    僅在檔案路徑、修改時間或大小改變（重新 build）時才重新開啟。
+    """
+    path = resolve_store_path(path)
+    st = os.stat(path)
+    name, key = os.path.abspath(path), (st.st_mtime, st.st_size)
+    cached = _store_cache.get(name)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    with _store_lock:
+        cached = _store_cache.get(name)
+        if cached is None or cached[0] != key:
+            cached = (key, open_store(path))
+            _store_cache[name] = cached
+        return cached[1]
+
+def release_store(path: str):
+    """不再共用某個切塊檔（知識庫被淘汰時呼叫；仍持有快照的請求可照常使用）"""
+    with _store_lock:
+        _store_cache.pop(os.path.abspath(resolve_store_path(path)), None)
+
+# === 索引管理：不可變快照 + 熱更新 ==========================
+@dataclass(frozen=True)
+class KBSnapshot:
+    index: faiss.Index
+    store: Union[ChunkStore, MappedChunkStore]
+    version: str
+    lexical: Optional[LexicalIndex] = None   # 舊版 build 沒有關鍵字索引時為 None
+    files: Tuple[str, ...] = ()              # 快照載入的檔案（版本目錄中的實際路徑）
+
+class IndexManager:
+    """持有一份「索引 + 切塊」的不可變快照
+
+    - 第一次取用時同步載入；之後每個請求只拿目前快照的參考，不再讀磁碟
+    - 偵測到版本檔改變時於背景執行緒載入新版，完成後整份快照原子替換；
+      進行中的請求持有舊快照參考，可照常完成
+    - 快照的所有檔案都從 current_path 連結所指的同一個版本目錄開啟（見 publish_index）
+    """
+
+    def __init__(self, index_path: str = INDEX_PATH, store_path: str = STORE_PATH,
+                 version_path: str = VERSION_PATH, check_interval: float = RELOAD_CHECK_INTERVAL,
+                 lexical_path: str = LEXICAL_PATH, vectors_path: str = VECTORS_PATH,
+                 vector_ids_path: str = VECTOR_IDS_PATH, current_path: str = CURRENT_PATH):
+        self.current_path = current_path
+        self.index_path = index_path
+        self.lexical_path = lexical_path
+        self.vectors_path = vectors_path
+        self.vector_ids_path = vector_ids_path
+        self.store_path = store_path
+        self.version_path = version_path
+        self.check_interval = check_interval
+        self._snapshot: Optional[KBSnapshot] = None
+        self._lock = threading.Lock()
+        self._reloading = False
+        self._last_check = 0.0
+
+    def version_info(self) -> Dict:
+        """讀取磁碟上的版本檔；舊版 build 沒有版本檔時退回以檔案 mtime/大小判斷"""
+        try:
+            return _read_version(self.version_path)
+        except (OSError, ValueError, KeyError):
+            st = os.stat(self.index_path)
+            return {"version": f"mtime-{st.st_mtime_ns}-{st.st_size}"}
+
+    def disk_version(self) -> str:
+        return self.version_info()["version"]
+
+    def build_dir(self) -> Optional[str]:
+        """目前的版本目錄；舊版 build（頂層為一般檔案）時為 None"""
+        try:
+            target = os.readlink(self.current_path)
+        except OSError:
+            return None
+        return os.path.join(os.path.dirname(self.current_path), target)
+
+    def _load(self) -> KBSnapshot:
+        if not (os.path.exists(self.index_path) and os.path.exists(resolve_store_path(self.store_path))):
+            raise FileNotFoundError("請先執行 build 建立知識庫索引（kb.index / kb_store.bin）。")
+        while True:
+            build_dir = self.build_dir()
+            if build_dir is None:
+                info = self.version_info()
+                snap = self._open(info, self.index_path, get_store(self.store_path), self.lexical_path,
+                                  self.vectors_path, self.vector_ids_path)
+                # 舊版 build 的檔案逐一替換：載入期間若又有新版發佈，重新讀一次，避免 index 與 store 版本不一致
+                if self.disk_version() == info["version"]:
+                    return snap
+                continue
+            def at(path: str) -> str:
+                return os.path.join(build_dir, os.path.basename(path))
+            try:
+                snap = self._open(_read_version(at(self.version_path)), at(self.index_path),
+                                  open_store(at(self.store_path)), at(self.lexical_path),
+                                  at(self.vectors_path), at(self.vector_ids_path))
+            except Exception:
+                if os.path.isdir(build_dir):
+                    raise
+                continue
+            # 載入期間有新版發佈且這個版本目錄已被清除（部分檔案可能沒開到）：改載入新版
+            if os.path.isdir(build_dir):
+                return snap
+
+    def _open(self, info: Dict, index_path: str, store: Union[ChunkStore, MappedChunkStore],
+              lexical_path: str, vectors_path: str, vector_ids_path: str) -> KBSnapshot:
+        index = kb_ann.read_index(index_path, mmap=INDEX_MMAP)
+        # 套用 build 時調整好的 nprobe/efSearch（faiss 不一定會寫入索引檔）
+        kb_ann.set_search_params(index, info.get("search_params", {}))
+        kb_ann.enable_reconstruct(index)   # MMR 需依 id 取回候選向量
+        files = [index_path, store.path if isinstance(store, MappedChunkStore) else resolve_store_path(self.store_path)]
+        if info.get("full_vectors") and kb_ann.RESCORE:
+            # 量化索引：候選以記憶體映射的全精度向量重新評分
+            vectors = kb_ann.FullVectors.open(vectors_path, vector_ids_path, index.d)
+            index = kb_ann.RescoringIndex(index, vectors)
+            files += [vectors_path, vector_ids_path]
+        lexical = None
+        if os.path.exists(lexical_path):
+            lexical = LexicalIndex.load(lexical_path, mmap=INDEX_MMAP)
+            files.append(lexical_path)
+        return KBSnapshot(index=index, store=store, version=info["version"], lexical=lexical, files=tuple(files))
+
+    def current(self) -> KBSnapshot:
+        snap = self._snapshot
+        if snap is None:
+            with self._lock:
+                if self._snapshot is None:
+                    self._snapshot = self._load()
+                    self._last_check = time.monotonic()
+                return self._snapshot
+        self._maybe_reload(snap)
+        return snap
+
+    def _maybe_reload(self, snap: KBSnapshot):
+        now = time.monotonic()
+        if now - self._last_check < self.check_interval:
+            return
+        self._last_check = now
+        try:
+            if self.disk_version() == snap.version:
+                return
+        except OSError:
+            return
+        with self._lock:
+            if self._reloading:
+                return
+            self._reloading = True
+        threading.Thread(target=self._reload_worker, name="kb-index-reload", daemon=True).start()
+
+    def _reload_worker(self):
+        try:
+            new_snap = self._load()
+            if INDEX_MMAP:
+                self._warm(new_snap)   # 預熱完才切換，新版映射不會讓第一批查詢承擔 page fault
+            self._snapshot = new_snap
+            print(f"[INFO] 已切換至新版索引：{new_snap.version}")
+        except Exception as e:
+            print(f"[WARN] 背景載入新版索引失敗，繼續使用舊版：{e}")
+        finally:
+            with self._lock:
+                self._reloading = False
+
+    def reload(self) -> KBSnapshot:
+        """同步重新載入並替換快照"""
+        new_snap = self._load()
+        self._snapshot = new_snap
+        return new_snap
+
+    def snapshot_files(self, snap: KBSnapshot) -> List[str]:
+        return [p for p in snap.files if os.path.exists(p)]
+
+    def _warm(self, snap: KBSnapshot) -> int:
+        """把快照的檔案讀進 page cache，並以一次查詢讓本行程的映射區建立頁表；回傳讀入的位元組數"""
+        n = sum(_read_through(p) for p in self.snapshot_files(snap))
+        if snap.index.ntotal:
+            snap.index.search(np.zeros((1, snap.index.d), dtype="float32"), 1)
+        return n
+
+    def warm(self) -> KBSnapshot:
+        """載入（若尚未載入）並預熱目前的快照"""
+        t0 = time.perf_counter()
+        snap = self.current()
+        n = self._warm(snap)
+        print(f"[OK] 已預熱索引 {self.index_path}（版本 {snap.version}，{n / 1024 ** 2:.1f} MB，"
+              f"{time.perf_counter() - t0:.2f}s{'，記憶體映射' if INDEX_MMAP else ''}）")
+        return snap
+
+def _read_through(path: str) -> int:
+    """循序讀過整個檔案，讓內容進入作業系統 page cache（同機器上的其他行程直接共用）"""
+    n = 0
+    buf = bytearray(WARM_READ_BYTES)
+    with open(path, "rb", buffering=0) as f:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+        while True:
+            k = f.readinto(buf)
+            if not k:
+                return n
+            n += k
+
+_manager: Optional[IndexManager] = None
+_manager_lock = threading.Lock()
+
+def get_index_manager() -> IndexManager:
+    global _manager
+    if _manager is None:
+        with _manager_lock:
+            if _manager is None:
+                _manager = IndexManager()
+    return _manager
+
+def load_index() -> Tuple[faiss.Index, Union[ChunkStore, MappedChunkStore]]:
+    snap = get_index_manager().current()
+    return snap.index, snap.store
+
+# === 多知識庫：延遲載入 + LRU =================================
+_KB_ID_RE = re.compile(r"^[A-Za-z0-9][A-Za-z0-9_.-]{0,63}$")
+
+class KBNotFoundError(LookupError):
+    pass
+
+class KBRegistry:
+    """依 kb id 管理多個知識庫（每個都是一個 IndexManager）
+
+    - 第一次查詢某個知識庫時才載入它的索引與切塊
+    - 已開啟的知識庫以 LRU 保留；開啟數超過 max_open、或索引檔總大小超過 max_bytes 時，
+      淘汰最久未使用者（進行中的請求持有快照參考，可照常完成）
+    """
+
+    def __init__(self, root: str = KB_ROOT, max_open: int = KB_OPEN_MAX, max_bytes: int = KB_OPEN_MAX_BYTES):
+        self.root = root
+        self.max_open = max_open
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._open: "OrderedDict[str, IndexManager]" = OrderedDict()
+        self._sizes: Dict[str, int] = {}
+        self._sized: Dict[str, str] = {}        # kb id -> 目前大小所依據的快照版本
+
+    def kb_dir(self, kb_id: str) -> str:
+        if not isinstance(kb_id, str) or not _KB_ID_RE.match(kb_id):
+            raise ValueError(f"不合法的知識庫 id：{kb_id}")
+        return os.path.join(self.root, kb_id)
+
+    def available(self) -> List[str]:
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(d for d in os.listdir(self.root)
+                      if _KB_ID_RE.match(d) and os.path.exists(os.path.join(self.root, d, INDEX_PATH)))
+
+    def manager(self, kb_id: str) -> IndexManager:
+        kb_dir = self.kb_dir(kb_id)
+        with self._lock:
+            mgr = self._open.get(kb_id)
+            if mgr is not None:
+                self._open.move_to_end(kb_id)
+                return mgr
+        if not os.path.exists(os.path.join(kb_dir, INDEX_PATH)):
+            raise KBNotFoundError(f"找不到知識庫：{kb_id}")
+        mgr = IndexManager(index_path=os.path.join(kb_dir, INDEX_PATH),
+                           store_path=os.path.join(kb_dir, STORE_PATH),
+                           version_path=os.path.join(kb_dir, VERSION_PATH),
+                           current_path=os.path.join(kb_dir, CURRENT_PATH),
+                           lexical_path=os.path.join(kb_dir, LEXICAL_PATH),
+                           vectors_path=os.path.join(kb_dir, VECTORS_PATH),
+                           vector_ids_path=os.path.join(kb_dir, VECTOR_IDS_PATH))
+        with self._lock:
+            mgr = self._open.setdefault(kb_id, mgr)
+            self._open.move_to_end(kb_id)
+        return mgr
+
+    def current(self, kb_id: str) -> KBSnapshot:
+        mgr = self.manager(kb_id)
+        snap = mgr.current()
+        if self._sized.get(kb_id) != snap.version:
+            # 以索引檔大小估算常駐記憶體（切塊檔與重新評分用的全精度向量檔為記憶體映射，同樣計入）；
+            # 熱重載切換到新版快照後重新計算
+            size = sum(os.path.getsize(p) for p in mgr.snapshot_files(snap))
+            with self._lock:
+                if kb_id in self._open:
+                    self._sizes[kb_id] = size
+                    self._sized[kb_id] = snap.version
+                self._evict(keep=kb_id)
+        return snap
+
+    def _evict(self, keep: str):
+        for victim in list(self._open):
+            if len(self._open) <= 1:
+                return
+            if len(self._open) <= self.max_open and sum(self._sizes.values()) <= self.max_bytes:
+                return
+            if victim == keep:
+                continue
+            mgr = self._open.pop(victim)
+            self._sizes.pop(victim, None)
+            self._sized.pop(victim, None)
+            release_store(mgr.store_path)
+            print(f"[INFO] 已釋放知識庫：{victim}")
+
+    def evict(self, kb_id: str):
+        with self._lock:
+            mgr = self._open.pop(kb_id, None)
+            self._sizes.pop(kb_id, None)
+            self._sized.pop(kb_id, None)
+        if mgr is not None:
+            release_store(mgr.store_path)
+
+    def stats(self) -> List[Dict]:
+        """目前開啟中的知識庫（由舊到新）與估計大小"""
+        with self._lock:
+            return [{"kb": kb_id, "bytes": self._sizes.get(kb_id, 0)} for kb_id in self._open]
+
+_registry: Optional[KBRegistry] = None
+
+def get_kb_registry() -> KBRegistry:
+    global _registry
+    if _registry is None:
+        with _manager_lock:
+            if _registry is None:
+                _registry = KBRegistry()
+    return _registry
+
+# === 預熱與 readiness =======================================
+class WarmUp:
+    """啟動時預熱索引（預設知識庫與 WARM_KBS），完成後才回報 ready
+
+    prefork 部署時每個 worker 各自執行一次；檔案內容在 page cache 中只有一份，
+    先完成的 worker 讀入後，其餘 worker 只需建立自己的頁表。
+    只有多知識庫（KB_ROOT 下已有知識庫）而沒有預設索引時同樣視為 ready，其餘知識庫於第一次查詢時載入。
+    預熱失敗（例如索引尚未 build）後，間隔 WARM_RETRY_SECONDS 以上的 start() 會重新預熱。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._failed_at = 0.0
+        self._state: Dict = {"ready": False, "error": None, "kbs": []}
+
+    def run(self, kb_ids: Optional[List[str]] = None) -> Dict:
+        if kb_ids is None:
+            kb_ids = [k.strip() for k in WARM_KBS.split(",") if k.strip()]
+        try:
+            mgr = get_index_manager()
+            warmed = []
+            if os.path.exists(mgr.index_path):
+                mgr.warm()
+                warmed.append(None)
+            for kb_id in kb_ids:
+                get_kb_registry().manager(kb_id).warm()
+                get_kb_registry().current(kb_id)   # 計入 LRU 與大小統計
+                warmed.append(kb_id)
+            if not warmed and not get_kb_registry().available():
+                raise FileNotFoundError("請先執行 build 建立知識庫索引（kb.index / kb_store.bin）。")
+            self._state = {"ready": True, "error": None, "kbs": warmed}
+        except Exception as e:
+            print(f"[ERROR] 索引預熱失敗：{e}")
+            self._failed_at = time.monotonic()
+            self._state = {"ready": False, "error": str(e), "kbs": []}
+        return self.status()
+
+    def start(self, kb_ids: Optional[List[str]] = None) -> threading.Thread:
+        """於背景執行緒預熱（執行中或已 ready 時不重複執行；上次失敗且超過重試間隔才重新執行）"""
+        with self._lock:
+            if self._thread is None or (not self._thread.is_alive() and not self._state["ready"]
+                                        and time.monotonic() - self._failed_at >= WARM_RETRY_SECONDS):
+                self._thread = threading.Thread(target=self.run, args=(kb_ids,), name="kb-warm-up", daemon=True)
+                self._thread.start()
+            return self._thread
+
+    def status(self) -> Dict:
+        state = dict(self._state)
+        state["pid"] = os.getpid()
+        state["mmap"] = INDEX_MMAP
+        return state
+
+_warm_up = WarmUp()
+
+def warm_up(kb_ids: Optional[List[str]] = None) -> Dict:
+    """同步預熱（單行程啟動時使用）"""
+    return _warm_up.run(kb_ids)
+
+def start_warm_up(kb_ids: Optional[List[str]] = None) -> threading.Thread:
+    return _warm_up.start(kb_ids)
+
+def readiness() -> Dict:
+    """目前行程的 readiness：{"ready", "error", "kbs", "pid", "mmap"}"""
+    return _warm_up.status()
+
+def get_snapshot(kb_id: Optional[str] = None) -> KBSnapshot:
+    """取得知識庫快照；未指定 kb id 時為預設（工作目錄下的 kb.index）"""
+    if kb_id:
+        return get_kb_registry().current(kb_id)
+    return get_index_manager().current()
+
+@dataclass(frozen=True)
+class SearchOptions:
+    """檢索結果的篩選與多樣化設定（None 表示不啟用）
+
+    - min_score：向量相似度低於此值的候選直接捨棄
+    - max_gap：只保留分數 ≥ 第一名 × (1 - max_gap) 的候選
+      （min_score / max_gap 作用於向量候選；lexical 模式只套用 max_gap 於 BM25 分數）
+    - max_k：回傳數上限，取代呼叫端的 k
+    - mmr_lambda：以 MMR 從候選中重新挑選，兼顧相關性與彼此差異（需要查詢向量；
+      lexical 模式與 embedding 失敗退回關鍵字檢索時不套用，API 明確指定 mode=lexical 與 mmr 時回傳 400）
+    """
+    min_score: Optional[float] = None
+    max_gap: Optional[float] = None
+    max_k: Optional[int] = None
+    mmr_lambda: Optional[float] = None
+
+    def __post_init__(self):
+        if self.max_gap is not None and not 0.0 <= self.max_gap <= 1.0:
+            raise ValueError("max_gap 必須介於 0 與 1 之間")
+        if self.mmr_lambda is not None and not 0.0 <= self.mmr_lambda <= 1.0:
+            raise ValueError("mmr 權重必須介於 0 與 1 之間")
+        if self.max_k is not None and not 1 <= self.max_k <= SEARCH_MAX_K_LIMIT:
+            raise ValueError(f"max_k 必須介於 1 與 {SEARCH_MAX_K_LIMIT} 之間")
+
+    def capped(self, max_k: int) -> "SearchOptions":
+        """max_k 不超過上限的設定（max_k 會取代呼叫端的 k，呼叫端對 k 的上限也要套用在這裡）"""
+        if self.max_k is not None and self.max_k > max_k:
+            return replace(self, max_k=max_k)
+        return self
+
+    @classmethod
+    def from_dict(cls, data: Dict, base: Optional["SearchOptions"] = None) -> "SearchOptions":
+        """由 API 參數（min_score / max_gap / max_k / mmr）建立，未提供的欄位沿用 base
+
+        請求的檢索模式（data 的 mode，未提供時為 SEARCH_MODE）為 lexical 又指定 mmr 時視為錯誤：
+        關鍵字檢索沒有查詢向量，MMR 無從套用。
+        """
+        base = base or DEFAULT_SEARCH_OPTIONS
+        if data.get("mmr") not in (None, "") and str(data.get("mode") or SEARCH_MODE).lower() == "lexical":
+            raise ValueError("lexical 模式不支援 mmr（MMR 需要查詢向量）")
+
+        def pick(key: str, current, cast):
+            value = data.get(key)
+            if value is None or value == "":
+                return current
+            try:
+                return cast(value)
+            except (TypeError, ValueError):
+                raise ValueError(f"參數 {key} 格式錯誤：{value}")
+
+        return cls(min_score=pick("min_score", base.min_score, float),
+                   max_gap=pick("max_gap", base.max_gap, float),
+                   max_k=pick("max_k", base.max_k, int),
+                   mmr_lambda=pick("mmr", base.mmr_lambda, float))
+
+DEFAULT_SEARCH_OPTIONS = SearchOptions(
+    min_score=float(SEARCH_MIN_SCORE) if SEARCH_MIN_SCORE else None,
+    max_gap=float(SEARCH_MAX_GAP) if SEARCH_MAX_GAP else None,
+    max_k=int(SEARCH_MAX_K) if SEARCH_MAX_K else None,
+    mmr_lambda=float(MMR_LAMBDA) if MMR_LAMBDA else None,
+)
+
+def _apply_cutoffs(hits: List[Tuple[DocChunk, float]], opts: SearchOptions,
+                   absolute: bool = True) -> List[Tuple[DocChunk, float]]:
+    if absolute and opts.min_score is not None:
+        hits = [h for h in hits if h[1] >= opts.min_score]
+    if opts.max_gap is not None and hits:
+        top = hits[0][1]
+        floor = top - opts.max_gap * abs(top)
+        hits = [h for h in hits if h[1] >= floor]
+    return hits
+
+def mmr_order(rel: np.ndarray, sim: np.ndarray, k: int, lam: float) -> List[int]:
+    """Maximal Marginal Relevance：逐步挑選 lam * 相關性 - (1 - lam) * 與已選者最大相似度 最高者
+
+    rel 為候選與查詢的相似度（n），sim 為候選兩兩相似度（n x n）；回傳挑選順序的索引。
+    每一步只需以向量運算更新「與已選者的最大相似度」，總成本 O(k * n)。
+    """
+    n = len(rel)
+    k = min(k, n)
+    order: List[int] = []
+    max_sim = np.full(n, -np.inf, dtype="float32")
+    available = np.ones(n, dtype=bool)
+    for step in range(k):
+        penalty = np.zeros(n, dtype="float32") if step == 0 else max_sim
+        score = lam * rel - (1.0 - lam) * penalty
+        score[~available] = -np.inf
+        pick = int(np.argmax(score))
+        order.append(pick)
+        available[pick] = False
+        max_sim = np.maximum(max_sim, sim[:, pick])
+    return order
+
+def mmr_select(index: faiss.Index, qv: np.ndarray, hits: List[Tuple[DocChunk, float]], k: int,
+               lam: float) -> List[Tuple[DocChunk, float]]:
+    """以候選的向量做 MMR 重新挑選；分數保留原本的檢索分數"""
+    if len(hits) <= 1:
+        return hits[:k]
+    ids = np.array([c.id for c, _ in hits], dtype="int64")
+    try:
+        vecs = index.reconstruct_batch(ids)
+    except RuntimeError as e:
+        print(f"[WARN] 索引無法取回候選向量，略過 MMR：{e}")
+        return hits[:k]
+    vecs = np.ascontiguousarray(vecs, dtype="float32")
+    faiss.normalize_L2(vecs)
+    rel = vecs @ qv.reshape(-1)
+    sim = vecs @ vecs.T
+    return [hits[i] for i in mmr_order(rel, sim, k, lam)]
+
+def _pool_size(k: int, opts: SearchOptions) -> int:
+    return k * MMR_CANDIDATES if opts.mmr_lambda is not None else k
+
+def _select_hits(index: faiss.Index, qv: np.ndarray, query: str, vec_hits: List[Tuple[DocChunk, float]],
+                 lexical: Optional[LexicalIndex], store, k: int, opts: SearchOptions,
+                 mode: str) -> List[Tuple[DocChunk, float]]:
+    """向量候選 → 分數門檻 →（hybrid 融合）→（MMR）→ 取前 k 個"""
+    hits = _apply_cutoffs(vec_hits, opts)
+    if mode == "hybrid":
+        hits = _fuse_hits(hits, lexical, query, _pool_size(k, opts), store)
+    if opts.mmr_lambda is not None:
+        return mmr_select(index, qv, hits, k, opts.mmr_lambda)
+    return hits[:k]
+
+def _resolve_mode(mode: Optional[str], lexical: Optional[LexicalIndex]) -> str:
+    mode = (mode or SEARCH_MODE).lower()
+    if mode not in SEARCH_MODES:
+        raise ValueError(f"不支援的檢索模式：{mode}（可用 {' / '.join(SEARCH_MODES)}）")
+    # 沒有關鍵字索引（舊版 build）時只能用向量檢索
+    return "vector" if lexical is None else mode
+
+def search(index: faiss.Index, query: str, k=TOP_K,
+           store: Optional[Union[ChunkStore, MappedChunkStore]] = None,
+           lexical: Optional[LexicalIndex] = None, mode: Optional[str] = None,
+           qv: Optional[np.ndarray] = None, opts: Optional[SearchOptions] = None) -> List[Tuple[DocChunk, float]]:
+    """檢索最相關的 k 個切塊
+
+    mode：
+      vector   只用向量檢索
+      lexical  只用 BM25 關鍵字檢索（行程內完成，不呼叫 embedding）
+      hybrid   兩者各取候選後以 RRF 融合；embedding 失敗時退回關鍵字結果
+    沒有關鍵字索引（lexical=None）時一律使用向量檢索。
+    qv 為已 normalize 的查詢向量，可由呼叫端預先算好傳入。
+    opts 控制分數門檻、回傳數上限與 MMR（預設依環境變數，見 SearchOptions）。
+    """
+    mode = _resolve_mode(mode, lexical)
+    opts = opts or DEFAULT_SEARCH_OPTIONS
+    k = opts.max_k or k
+    if store is None:
+        store = get_store(STORE_PATH)
+    if mode == "lexical":
+        return _search_lexical_only(lexical, query, k, store, opts)
+
+    if qv is None:
+        try:
+            qv = _query_vector(query)
+        except Exception as e:
+            if mode != "hybrid":
+                raise
+            print(f"[WARN] 查詢 embedding 失敗，改用關鍵字檢索：{e}")
+            return _search_lexical_only(lexical, query, k, store, opts)
+    n = _pool_size(k, opts) * (HYBRID_CANDIDATES if mode == "hybrid" else 1)
+    vec_hits = search_vector(index, qv, k=n, store=store)
+    return _select_hits(index, qv, query, vec_hits, lexical, store, k, opts, mode)
+
+def _search_lexical_only(lexical: LexicalIndex, query: str, k: int, store,
+                         opts: SearchOptions) -> List[Tuple[DocChunk, float]]:
+    return _apply_cutoffs(search_lexical(lexical, query, k=k, store=store), opts, absolute=False)
+
+def _fuse_hits(vec_hits: List[Tuple[DocChunk, float]], lexical: LexicalIndex, query: str, k: int,
+               store: Union[ChunkStore, MappedChunkStore]) -> List[Tuple[DocChunk, float]]:
+    """hybrid：向量候選與關鍵字候選以 RRF 融合，分數為 RRF 分數"""
+    vec_ids = [c.id for c, _ in vec_hits]
+    lex_ids = [cid for cid, _ in lexical.search(normalize_query(query), k * HYBRID_CANDIDATES)]
+    return [(store[cid], score) for cid, score in rrf_fuse([vec_ids, lex_ids], k)]
+
+def search_many(index: faiss.Index, queries: List[str], k=TOP_K,
+                store: Optional[Union[ChunkStore, MappedChunkStore]] = None,
+                lexical: Optional[LexicalIndex] = None, mode: Optional[str] = None,
+                opts: Optional[SearchOptions] = None) -> List[List[Tuple[DocChunk, float]]]:
+    """一次檢索多個查詢，回傳與 queries 同順序的結果
+
+    查詢向量以批次 embeddings 請求取得，FAISS 對整個查詢矩陣只呼叫一次 index.search；
+    模式、退回規則與 opts 同 search()。
+    """
+    mode = _resolve_mode(mode, lexical)
+    opts = opts or DEFAULT_SEARCH_OPTIONS
+    k = opts.max_k or k
+    if store is None:
+        store = get_store(STORE_PATH)
+    if not queries:
+        return []
+    if mode == "lexical":
+        return [_search_lexical_only(lexical, q, k, store, opts) for q in queries]
+
+    try:
+        qvs = embed_queries(queries)
+    except Exception as e:
+        if mode != "hybrid":
+            raise
+        print(f"[WARN] 查詢 embedding 失敗，改用關鍵字檢索：{e}")
+        return [_search_lexical_only(lexical, q, k, store, opts) for q in queries]
+    faiss.normalize_L2(qvs)
+    n = _pool_size(k, opts) * (HYBRID_CANDIDATES if mode == "hybrid" else 1)
+    vec_hits = search_vectors(index, qvs, k=n, store=store)
+    return [_select_hits(index, qv, q, hits, lexical, store, k, opts, mode)
+            for qv, q, hits in zip(qvs, queries, vec_hits)]
+
+def search_lexical(lexical: LexicalIndex, query: str, k=TOP_K,
+                   store: Optional[Union[ChunkStore, MappedChunkStore]] = None) -> List[Tuple[DocChunk, float]]:
+    """BM25 關鍵字檢索，分數為 BM25 分數"""
+    if store is None:
+        store = get_store(STORE_PATH)
+    return [(store[cid], score) for cid, score in lexical.search(normalize_query(query), k)]
+
+def search_vector(index: faiss.Index, qv: np.ndarray, k=TOP_K,
+                  store: Optional[Union[ChunkStore, MappedChunkStore]] = None) -> List[Tuple[DocChunk, float]]:
+    """以已正規化的查詢向量（1 x dim）檢索"""
+    return search_vectors(index, qv, k=k, store=store)[0]
+
+def search_vectors(index: faiss.Index, qvs: np.ndarray, k=TOP_K,
+                   store: Optional[Union[ChunkStore, MappedChunkStore]] = None) -> List[List[Tuple[DocChunk, float]]]:
+    """以已正規化的查詢矩陣（n x dim）檢索，整批只呼叫一次 index.search"""
+    scores, idxs = index.search(qvs, k)
+    if store is None:
+        store = get_store(STORE_PATH)
+    batch = []
+    for row_idxs, row_scores in zip(idxs, scores):
+        results = []
+        for i, s in zip(row_idxs, row_scores):
+            if i == -1:  # faiss 若無結果會回 -1
+                continue
+            results.append((store[i], float(s)))
+        batch.append(results)
+    return batch
+
+def hits_to_results(hits: List[Tuple[DocChunk, float]]) -> List[Dict]:
+    """檢索結果轉為 API 回傳格式（Flask 與 ASGI 服務共用）"""
     results = []
-    for i, s in zip(idxs, scores):
-        if i == -1:  # faiss 若無結果會回 -1
-            continue
-        results.append((store[i], float(s)))
+    for rank, (chunk, score) in enumerate(hits, 1):
+        results.append({
+            'rank': rank,
+            'score': float(score),
+            'source': chunk.source,
+            'text': chunk.text,
+            'summary': chunk.summary,
+            'chunk_id': f"chunk_{rank}"  # 添加唯一 ID
+        })
     return results
 
-def format_context(results: List[Tuple[DocChunk, float]]) -> str:
-    blocks = []
-    for rank, (c, s) in enumerate(results, 1):
-        blocks.append(f"[{rank}] (score={s:.4f}) source={c.source}\n{c.text}")
-    return "\n\n---\n\n".join(blocks)
+@dataclass
+class PackedContext:
+    text: str
+    tokens: int                                   # 估算的 token 數（見 kb_tokens.estimate_tokens）
+    hits: List[Tuple[int, DocChunk, float]]       # 實際放入的 (排名, 切塊, 分數)
+    duplicates: int = 0                           # 因完全/近似重複而略過的片段數
+    truncated: bool = False                       # 最後一個片段是否被截斷
+    dropped: int = 0                              # 因預算不足而未放入的片段數
+
+def _dedup_key(text: str) -> str:
+    return _WHITESPACE_RE.sub(" ", unicodedata.normalize("NFKC", text)).strip().lower()
 
-def ask(query: str) -> str:
-    index, _ = load_index()
-    hits = search(index, query, k=TOP_K)
-    context = format_context(hits)
+def _is_near_duplicate(terms: set, seen: List[set]) -> bool:
+    for other in seen:
+        union = len(terms | other)
+        if union and len(terms & other) / union >= CONTEXT_DEDUP_THRESHOLD:
+            return True
+    return False
 
-    system = (
-        "你是嚴謹的技術助理。"
-        "只根據提供的『檢索內容』回答；若無法從內容中找到答案，請明確說不知道並提出需要的資訊。"
-        "回覆使用繁體中文，並在結尾列出引用片段的 [編號] 與 source 路徑。"
-    )
+def _render_context(items: List[Tuple[int, DocChunk, float]]) -> str:
+    """依來源分組輸出；來源依其最佳排名排序，每個來源的文件摘要只出現一次"""
+    groups: Dict[str, List[Tuple[int, DocChunk, float]]] = {}
+    for rank, c, s in items:
+        groups.setdefault(c.source, []).append((rank, c, s))
+
+    sections = []
+    for source, group in groups.items():
+        lines = [f"=== source={source} ==="]
+        summary = group[0][1].summary
+        if summary:
+            lines.append(f"{SUMMARY_HEAD}\n{summary}{SUMMARY_SEPARATOR}")
+        blocks = [f"[{rank}] (score={s:.4f}) source={c.source}\n{c.text}" for rank, c, s in group]
+        lines.append("\n\n---\n\n".join(blocks))
+        sections.append("\n".join(lines))
+    return "\n\n".join(sections)
+
+def pack_context(results: List[Tuple[DocChunk, float]], budget: Optional[int] = None) -> PackedContext:
+    """在 token 預算內組合檢索內容
+
+    - 依排名（分數由高到低）貪婪放入片段，來源第一次出現時一併計入文件摘要的成本
+    - 內容完全相同或詞彙高度重疊的片段只保留排名較前者
+    - 放不下的片段在剩餘預算內截斷到句尾後放入，之後不再放入其他片段
+    budget 為 None 時使用 CONTEXT_TOKEN_BUDGET；0 或負數表示不限制。
+    """
+    budget = CONTEXT_TOKEN_BUDGET if budget is None else budget
+    sep_cost = estimate_tokens("\n\n---\n\n")
+    chosen: List[Tuple[int, DocChunk, float]] = []
+    seen_keys = set()
+    seen_terms: List[set] = []
+    sources = set()
+    used = 0
+    duplicates = 0
+    truncated = False
+    for pos, (c, s) in enumerate(results):
+        rank = pos + 1
+        key = _dedup_key(c.text)
+        terms = set(tokenize(c.text))
+        if key in seen_keys or _is_near_duplicate(terms, seen_terms):
+            duplicates += 1
+            continue
+
+        header_cost = 0
+        if c.source not in sources:
+            header_cost = estimate_tokens(f"=== source={c.source} ===\n") + sep_cost
+            if c.summary:
+                header_cost += estimate_tokens(f"{SUMMARY_HEAD}\n{c.summary}{SUMMARY_SEPARATOR}")
+        head = f"[{rank}] (score={s:.4f}) source={c.source}\n"
+        cost = header_cost + estimate_tokens(head) + estimate_tokens(c.text) + sep_cost
+        if budget > 0 and used + cost > budget:
+            room = budget - used - header_cost - estimate_tokens(head) - sep_cost
+            text = truncate_to_tokens(c.text, room) if room >= CONTEXT_MIN_TRUNCATE_TOKENS else None
+            if text is not None:
+                chosen.append((rank, DocChunk(id=c.id, text=text, source=c.source, summary=c.summary), s))
+                truncated = True
+            break
+
+        chosen.append((rank, c, s))
+        seen_keys.add(key)
+        seen_terms.append(terms)
+        sources.add(c.source)
+        used += cost
+
+    text = _render_context(chosen)
+    dropped = len(results) - len(chosen) - duplicates
+    return PackedContext(text=text, tokens=estimate_tokens(text), hits=chosen,
+                         duplicates=duplicates, truncated=truncated, dropped=dropped)
+
+def format_context(results: List[Tuple[DocChunk, float]], budget: Optional[int] = None) -> str:
+    """組合檢索內容：依來源分組，每個來源的文件摘要只出現一次，其後列出該來源的片段
+
+    來源依其最佳排名排序；片段保留原本的排名編號 [n]，供回答時引用。
+    總長度受 token 預算限制，詳見 pack_context。
+    """
+    return pack_context(results, budget).text
+
+SYSTEM_PROMPT = (
+    "你是嚴謹的技術助理。"
+    "只根據提供的『檢索內容』回答；若無法從內容中找到答案，請明確說不知道並提出需要的資訊。"
+    "回覆使用繁體中文，並在結尾列出引用片段的 [編號] 與 source 路徑。"
+)
+
+def build_messages(query: str, context: str) -> List[Dict[str, str]]:
     user = (
         f"查詢：{query}\n\n"
-        f"檢索內容（依相關度排序；每段已含該文件摘要前言）：\n{context}\n\n"
+        f"檢索內容（依來源分組，每個來源先列文件摘要，再列其片段；片段編號依相關度排序）：\n{context}\n\n"
         "請根據以上內容回答。若多處出現相同事實，優先以排名較前者為準。"
     )
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": user}
+    ]
 
-    resp = client.chat.completions.create(
+# === 語意答案快取 ============================================
+_answer_cache = AnswerCache(ANSWER_CACHE_SIZE, ANSWER_CACHE_TTL, ANSWER_CACHE_THRESHOLD)
+
+def lookup_cached_answer(query: str, kb_id: Optional[str] = None) -> Optional[str]:
+    """查詢語意相近、英數詞與日期相同，且由目前索引版本產生的快取答案；沒有時回傳 None"""
+    snap = get_snapshot(kb_id)
+    try:
+        qv = _query_vector(query)
+    except Exception as e:
+        print(f"[WARN] 查詢 embedding 失敗，略過答案快取：{e}")
+        return None
+    return _answer_cache.lookup(snap.version, qv, answer_cache_key(query), kb=kb_id or "")
+
+@dataclass(frozen=True)
+class PreparedQuestion:
+    """問答的前置結果：快照、查詢向量（embedding 失敗改走關鍵字檢索時為 None）、快取 key 與命中的快取答案
+
+    API 先以 prepare_question 得知是否命中答案快取（回應開頭要標示 cached），
+    再把結果傳給 ask / ask_stream，查詢只嵌入與比對快取一次。
+    """
+    snap: KBSnapshot
+    qv: Optional[np.ndarray]
+    key: str
+    kb: str
+    cached: Optional[str]
+
+def _prepared(snap: KBSnapshot, qv: Optional[np.ndarray], query: str, kb_id: Optional[str]) -> PreparedQuestion:
+    key = answer_cache_key(query)
+    cached = _answer_cache.lookup(snap.version, qv, key, kb=kb_id or "") if qv is not None else None
+    return PreparedQuestion(snap=snap, qv=qv, key=key, kb=kb_id or "", cached=cached)
+
+def prepare_question(query: str, kb_id: Optional[str] = None) -> PreparedQuestion:
+    snap = get_snapshot(kb_id)
+    return _prepared(snap, _try_query_vector(query, snap.lexical), query, kb_id)
+
+def replay_answer(answer: str, piece: int = ANSWER_REPLAY_CHARS):
+    """將快取答案切段產出，格式與 ask_stream 的增量文字相同"""
+    for i in range(0, len(answer), piece):
+        yield answer[i:i + piece]
+
+def ask(query: str, kb_id: Optional[str] = None, prepared: Optional[PreparedQuestion] = None) -> str:
+    """問答；prepared 為同一問題的 prepare_question 結果（已嵌入並比對過答案快取）"""
+    p = prepared or prepare_question(query, kb_id)
+    if p.cached is not None:
+        return p.cached
+    snap, qv = p.snap, p.qv
+
+    hits = search(snap.index, query, k=TOP_K, store=snap.store, lexical=snap.lexical,
+                  mode="lexical" if qv is None else None, qv=qv)
+    context = format_context(hits)
+
+    resp = _client().chat.completions.create(
         model=CHAT_MODEL,
-        messages=[
-            {"role": "system", "content": system},
-            {"role": "user", "content": user}
-        ],
+        messages=build_messages(query, context),
         temperature=0.2
     )
-    return resp.choices[0].message.content
+    answer = resp.choices[0].message.content
+    if answer and qv is not None:
+        _answer_cache.put(snap.version, qv, query, answer, p.key, kb=p.kb)
+    return answer
 
-def ask_stream(query: str):
+def ask_stream(query: str, kb_id: Optional[str] = None, prepared: Optional[PreparedQuestion] = None):
     """串流問答：先檢索再以 Chat Completions stream 回傳增量內容。
 
+    命中語意答案快取時直接重播快取答案；完整串流結束後才寫入快取
+    （中途中斷的回答不會被快取）。prepared 同 ask。
+
     Yields:
         str: 回覆的增量文字（delta content）
     """
-    index, _ = load_index()
-    hits = search(index, query, k=TOP_K)
+    p = prepared or prepare_question(query, kb_id)
+    if p.cached is not None:
+        yield from replay_answer(p.cached)
+        return
+    snap, qv = p.snap, p.qv
+
+    hits = search(snap.index, query, k=TOP_K, store=snap.store, lexical=snap.lexical,
+                  mode="lexical" if qv is None else None, qv=qv)
     context = format_context(hits)
 
-    system = (
-        "你是嚴謹的技術助理。"
-        "只根據提供的『檢索內容』回答；若無法從內容中找到答案，請明確說不知道並提出需要的資訊。"
-        "回覆使用繁體中文，並在結尾列出引用片段的 [編號] 與 source 路徑。"
+    stream = _client().chat.completions.create(
+        model=CHAT_MODEL,
+        messages=build_messages(query, context),
+        temperature=0.2,
+        stream=True
     )
-    user = (
-        f"查詢：{query}\n\n"
-        f"檢索內容（依相關度排序；每段已含該文件摘要前言）：\n{context}\n\n"
-        "請根據以上內容回答。若多處出現相同事實，優先以排名較前者為準。"
+
+    parts = []
+    for chunk in stream:
+        try:
+            # openai>=1.0 ChatCompletionChunk
+            delta = chunk.choices[0].delta.content or ""
+        except Exception:
+            delta = ""
+        if delta:
+            parts.append(delta)
+            yield delta
+    if parts and qv is not None:
+        _answer_cache.put(snap.version, qv, query, "".join(parts), p.key, kb=p.kb)
+
+# === 非同步版本（ASGI 服務使用） ============================
+# 遠端 embedding / LLM 呼叫改用 AsyncOpenAI，等待回應時不占用執行緒；
+# 本機的 SQLite 快取與 FAISS 搜尋仍是同步程式，以 asyncio.to_thread 執行，避免卡住 event loop。
+async def _aembed_remote(texts: List[str]) -> np.ndarray:
+    resp = await _aclient().embeddings.create(model=EMBEDDING_MODEL, input=texts)
+    vecs = [d.embedding for d in resp.data]
+    return np.array(vecs, dtype="float32")
+
+async def aembed_texts(texts: List[str]) -> np.ndarray:
+    """embed_texts 的非同步版本"""
+    cache = get_embedding_cache()
+    if cache is None:
+        return await _aembed_remote(texts)
+
+    cached = await asyncio.to_thread(cache.get_many, EMBEDDING_MODEL, texts)
+    missing = list(dict.fromkeys(t for t, v in zip(texts, cached) if v is None))
+    if missing:
+        fresh = await _aembed_remote(missing)
+        await asyncio.to_thread(cache.put_many, EMBEDDING_MODEL, missing, fresh)
+        by_text = dict(zip(missing, fresh))
+        cached = [v if v is not None else by_text[t] for t, v in zip(texts, cached)]
+    return np.array(cached, dtype="float32")
+
+async def aembed_query(query: str) -> np.ndarray:
+    """embed_query 的非同步版本，與同步版共用查詢向量快取"""
+    text = normalize_query(query) or query.strip()
+    key = (EMBEDDING_MODEL, text)
+    vec = _query_cache.get(key)
+    if vec is None:
+        vec = (await aembed_texts([text]))[0]
+        vec.setflags(write=False)
+        _query_cache.put(key, vec)
+    return vec.reshape(1, -1).copy()
+
+async def _aquery_vector(query: str) -> np.ndarray:
+    qv = await aembed_query(query)
+    faiss.normalize_L2(qv)
+    return qv
+
+async def _atry_query_vector(query: str, lexical: Optional[LexicalIndex]) -> Optional[np.ndarray]:
+    try:
+        return await _aquery_vector(query)
+    except Exception as e:
+        if lexical is None:
+            raise
+        print(f"[WARN] 查詢 embedding 失敗，改用關鍵字檢索：{e}")
+        return None
+
+async def asearch(index: faiss.Index, query: str, k=TOP_K,
+                  store: Optional[Union[ChunkStore, MappedChunkStore]] = None,
+                  lexical: Optional[LexicalIndex] = None, mode: Optional[str] = None,
+                  qv: Optional[np.ndarray] = None, opts: Optional[SearchOptions] = None) -> List[Tuple[DocChunk, float]]:
+    """search 的非同步版本：先以非同步方式取得查詢向量，再於執行緒中檢索"""
+    mode = _resolve_mode(mode, lexical)
+    if mode != "lexical" and qv is None:
+        try:
+            qv = await _aquery_vector(query)
+        except Exception as e:
+            if mode != "hybrid":
+                raise
+            print(f"[WARN] 查詢 embedding 失敗，改用關鍵字檢索：{e}")
+            mode = "lexical"
+    return await asyncio.to_thread(search, index, query, k, store, lexical, mode, qv, opts)
+
+async def asearch_many(index: faiss.Index, queries: List[str], k=TOP_K,
+                       store: Optional[Union[ChunkStore, MappedChunkStore]] = None,
+                       lexical: Optional[LexicalIndex] = None, mode: Optional[str] = None,
+                       opts: Optional[SearchOptions] = None) -> List[List[Tuple[DocChunk, float]]]:
+    """search_many 的非同步版本（批次檢索為 CPU 與本機 I/O 為主，整段於執行緒中執行）"""
+    return await asyncio.to_thread(search_many, index, queries, k, store, lexical, mode, opts)
+
+async def aget_snapshot(kb_id: Optional[str] = None) -> KBSnapshot:
+    """取得目前索引快照；第一次載入需讀檔，於執行緒中進行"""
+    return await asyncio.to_thread(get_snapshot, kb_id)
+
+async def aprepare_question(query: str, kb_id: Optional[str] = None) -> PreparedQuestion:
+    """prepare_question 的非同步版本"""
+    snap = await aget_snapshot(kb_id)
+    return _prepared(snap, await _atry_query_vector(query, snap.lexical), query, kb_id)
+
+async def aask(query: str, kb_id: Optional[str] = None, prepared: Optional[PreparedQuestion] = None) -> str:
+    """ask 的非同步版本"""
+    p = prepared or await aprepare_question(query, kb_id)
+    if p.cached is not None:
+        return p.cached
+    snap, qv = p.snap, p.qv
+
+    hits = await asearch(snap.index, query, k=TOP_K, store=snap.store, lexical=snap.lexical,
+                         mode="lexical" if qv is None else None, qv=qv)
+    context = format_context(hits)
+
+    resp = await _aclient().chat.completions.create(
+        model=CHAT_MODEL,
+        messages=build_messages(query, context),
+        temperature=0.2
     )
+    answer = resp.choices[0].message.content
+    if answer and qv is not None:
+        _answer_cache.put(snap.version, qv, query, answer, p.key, kb=p.kb)
+    return answer
+
+async def aask_stream(query: str, kb_id: Optional[str] = None, prepared: Optional[PreparedQuestion] = None):
+    """ask_stream 的非同步版本（async generator），產出相同的增量文字"""
+    p = prepared or await aprepare_question(query, kb_id)
+    if p.cached is not None:
+        for piece in replay_answer(p.cached):
+            yield piece
+        return
+    snap, qv = p.snap, p.qv
 
-    stream = client.chat.completions.create(
+    hits = await asearch(snap.index, query, k=TOP_K, store=snap.store, lexical=snap.lexical,
+                         mode="lexical" if qv is None else None, qv=qv)
+    context = format_context(hits)
+
+    stream = await _aclient().chat.completions.create(
         model=CHAT_MODEL,
-        messages=[
-            {"role": "system", "content": system},
-            {"role": "user", "content": user}
-        ],
+        messages=build_messages(query, context),
         temperature=0.2,
         stream=True
     )
 
-    for chunk in stream:
+    parts = []
+    async for chunk in stream:
         try:
-            # openai>=1.0 ChatCompletionChunk
             delta = chunk.choices[0].delta.content or ""
         except Exception:
             delta = ""
         if delta:
+            parts.append(delta)
             yield delta
+    if parts and qv is not None:
+        _answer_cache.put(snap.version, qv, query, "".join(parts), p.key, kb=p.kb)
 
 # === CLI ==============================================
 def main():
@@ -456,16 +1949,47 @@ def main():
 
     p_build = sub.add_parser("build", help="建立/覆蓋索引（含文件摘要前綴）")
     p_build.add_argument("--folder", required=True, help="知識庫資料夾（掃描 .txt/.md）")
+    p_build.add_argument("--incremental", action="store_true",
+                         help="依 kb_manifest.json 的內容 hash 只處理新增/變更/刪除的檔案")
+    p_build.add_argument("--summary-concurrency", type=int, default=None,
+                         help=f"摘要同時進行中的 LLM 請求上限（預設 {SUMMARY_CONCURRENCY}）")
+    p_build.add_argument("--index-spec", default=kb_ann.DEFAULT_INDEX_SPEC,
+                         help="索引類型：flat / ivf<nlist> / hnsw<M> / ivf<nlist>,pq<m>，前三者可加 ,fp16 或 ,sq8 "
+                              "量化儲存（例如 hnsw32、ivf1024,pq64、flat,sq8）")
+    p_build.add_argument("--nprobe", type=int, default=None, help="IVF 搜尋的 nprobe（未指定時由 --report 自動調整）")
+    p_build.add_argument("--ef-search", type=int, default=None, help="HNSW 搜尋的 efSearch（未指定時由 --report 自動調整）")
+    p_build.add_argument("--report", action="store_true",
+                         help="以保留的查詢比較 flat 索引，輸出 recall@k 與查詢延遲報告並自動調整搜尋參數")
+    p_build.add_argument("--report-queries", type=int, default=200, help="報告使用的保留查詢數")
+    p_build.add_argument("--kb", default=None,
+                         help=f"知識庫 id：索引與快取寫入 {KB_ROOT}/<id>/（服務端以 kb 參數指定查詢的知識庫）")
 
     p_ask = sub.add_parser("ask", help="提出問題（需先 build）")
     p_ask.add_argument("--q", required=True, help="問題內容")
+    p_ask.add_argument("--kb", default=None, help="知識庫 id（未指定時使用工作目錄下的索引）")
 
     args = parser.parse_args()
 
     if args.cmd == "build":
-        build_index(args.folder)
+        params = {}
+        if args.nprobe:
+            params["nprobe"] = args.nprobe
+        if args.ef_search:
+            params["efSearch"] = args.ef_search
+        folder = args.folder
+        if args.kb:
+            # 索引檔路徑皆相對於工作目錄：切換到知識庫目錄再 build
+            folder = os.path.abspath(folder)
+            kb_dir = get_kb_registry().kb_dir(args.kb)
+            os.makedirs(kb_dir, exist_ok=True)
+            os.chdir(kb_dir)
+            print(f"[INFO] 知識庫：{args.kb}（{kb_dir}）")
+        build_index(folder, incremental=args.incremental,
+                    summary_concurrency=args.summary_concurrency,
+                    index_spec=args.index_spec, search_params=params,
+                    report=args.report, report_queries=args.report_queries)
     elif args.cmd == "ask":
-        ans = ask(args.q)
+        ans = ask(args.q, kb_id=args.kb)
         print("\n===== 答案 =====\n")
         print(ans)
 
@@ -0,0 +1,212 @@
+from __future__ import annotations
+
+import os
+import json
+import mmap
+import shutil
+import struct
+from array import array
+from dataclasses import dataclass
+from typing import Dict, Iterator, List, Union
+
+from kb_lazy import lazy_import
+
+np = lazy_import("numpy")
+
+# === 資料結構 ===============================================
+@dataclass
+class DocChunk:
+    id: int
+    text: str
+    source: str
+    summary: str = ""   # 所屬文件的摘要；每份文件只存一次，chunk 以來源編號參照
+
+class ChunkStore:
+    """以 chunk id 查詢的切塊集合（全部常駐記憶體）
+
+    FAISS 索引使用穩定 id（IndexIDMap2），id 不再等於在 store 中的位置，
+    因此檢索時以 id 取回切塊；迭代時依 id 排序。
+    """
+
+    def __init__(self, chunks: List[DocChunk]):
+        self.chunks = sorted(chunks, key=lambda c: c.id)
+        self._by_id = {c.id: c for c in self.chunks}
+
+    def __getitem__(self, chunk_id: int) -> DocChunk:
+        return self._by_id[int(chunk_id)]
+
+    def __contains__(self, chunk_id: int) -> bool:
+        return int(chunk_id) in self._by_id
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+    def __len__(self) -> int:
+        return len(self.chunks)
+
+# === 二進位切塊檔（offset 索引 + 記憶體映射） ================
+# 檔案格式（little-endian）：
+#   magic "KBSTORE1"                                     8 bytes
+#   count, header_len, offsets_at, text_at               uint64 x 4
+#   header JSON（來源檔路徑表 sources、對應的文件摘要表 summaries）
+#                                                        header_len bytes，補齊至 8 的倍數
+#   offsets int64[count, 4]：id, text_start, text_end, source_idx（依 id 排序）
+#   文件摘要每份只存一次，chunk 經由 source_idx 參照，文字區不再重複摘要
+#   text blob：所有切塊文字的 UTF-8 連續串接
+STORE_MAGIC = b"KBSTORE1"
+_PREFIX = struct.Struct("<QQQQ")
+_COLS = 4
+
+def _align8(n: int) -> int:
+    return (n + 7) & ~7
+
+class BinaryStoreWriter:
+    """逐筆寫入二進位切塊檔（build 管線邊切塊邊寫入，不必把所有切塊文字留在記憶體中）
+
+    文字依加入順序附加到暫存的文字檔，記憶體中只保留每個切塊的 offset 列與來源/摘要表；
+    close() 時依 id 排序 offset，寫出 header 與 offset 陣列後再把文字檔串接到最後。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._text_path = path + ".text"
+        self._text = open(self._text_path, "wb")
+        self._rows = array("q")          # 每個切塊 4 欄：id, text_start, text_end, source_idx
+        self._pos = 0
+        self.sources: List[str] = []
+        self.summaries: List[str] = []
+        self._source_idx: Dict[str, int] = {}
+
+    def add(self, chunk: DocChunk):
+        src = self._source_idx.get(chunk.source)
+        if src is None:
+            src = self._source_idx[chunk.source] = len(self.sources)
+            self.sources.append(chunk.source)
+            self.summaries.append(chunk.summary)
+        data = chunk.text.encode("utf-8")
+        self._text.write(data)
+        self._rows.extend((chunk.id, self._pos, self._pos + len(data), src))
+        self._pos += len(data)
+
+    def __len__(self) -> int:
+        return len(self._rows) // _COLS
+
+    def close(self):
+        self._text.close()
+        offsets = np.frombuffer(self._rows, dtype="<i8").reshape(-1, _COLS)
+        offsets = offsets[np.argsort(offsets[:, 0], kind="stable")]
+        header = json.dumps({"sources": self.sources, "summaries": self.summaries},
+                            ensure_ascii=False).encode("utf-8")
+        header_at = len(STORE_MAGIC) + _PREFIX.size
+        offsets_at = _align8(header_at + len(header))
+        text_at = offsets_at + offsets.nbytes
+        with open(self.path, "wb") as f:
+            f.write(STORE_MAGIC)
+            f.write(_PREFIX.pack(len(offsets), len(header), offsets_at, text_at))
+            f.write(header)
+            f.write(b"\0" * (offsets_at - header_at - len(header)))
+            f.write(offsets.tobytes())
+            with open(self._text_path, "rb") as text:
+                shutil.copyfileobj(text, f, 1 << 20)
+        os.remove(self._text_path)
+
+    def abort(self):
+        self._text.close()
+        for p in (self._text_path, self.path):
+            if os.path.exists(p):
+                os.remove(p)
+
+def write_binary_store(chunks: List[DocChunk], path: str):
+    writer = BinaryStoreWriter(path)
+    try:
+        for c in sorted(chunks, key=lambda c: c.id):
+            writer.add(c)
+    except BaseException:
+        writer.abort()
+        raise
+    writer.close()
+
+def is_binary_store(path: str) -> bool:
+    with open(path, "rb") as f:
+        return f.read(len(STORE_MAGIC)) == STORE_MAGIC
+
+class MappedChunkStore:
+    """記憶體映射的切塊檔
+
+    開啟時只讀 header 與 offset 陣列（也是映射，不複製）；
+    查詢時以 id 二分搜尋 offset，只解碼 top-k 命中的文字。
+    常駐記憶體約為 offset 陣列大小，文字由作業系統 page cache 依需要載入。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mm[:len(STORE_MAGIC)] != STORE_MAGIC:
+            raise ValueError(f"{path} 不是二進位切塊檔")
+        count, header_len, offsets_at, text_at = _PREFIX.unpack_from(self._mm, len(STORE_MAGIC))
+        start = len(STORE_MAGIC) + _PREFIX.size
+        header = json.loads(self._mm[start:start + header_len].decode("utf-8"))
+        self.count = count
+        self.sources: List[str] = header["sources"]
+        self.summaries: List[str] = header.get("summaries") or [""] * len(self.sources)
+        self._text_at = text_at
+        self._offsets = np.frombuffer(self._mm, dtype="<i8", count=count * _COLS,
+                                      offset=offsets_at).reshape(count, _COLS)
+        self._ids = self._offsets[:, 0]
+
+    def _row(self, chunk_id: int) -> int:
+        row = int(np.searchsorted(self._ids, chunk_id))
+        if row >= self.count or self._ids[row] != chunk_id:
+            raise KeyError(chunk_id)
+        return row
+
+    def _chunk_at(self, row: int) -> DocChunk:
+        cid, start, end, src = (int(x) for x in self._offsets[row])
+        text = self._mm[self._text_at + start:self._text_at + end].decode("utf-8")
+        return DocChunk(id=cid, text=text, source=self.sources[src], summary=self.summaries[src])
+
+    def __getitem__(self, chunk_id: int) -> DocChunk:
+        return self._chunk_at(self._row(int(chunk_id)))
+
+    def __contains__(self, chunk_id: int) -> bool:
+        try:
+            self._row(int(chunk_id))
+            return True
+        except KeyError:
+            return False
+
+    def __iter__(self) -> Iterator[DocChunk]:
+        for row in range(self.count):
+            yield self._chunk_at(row)
+
+    def __len__(self) -> int:
+        return self.count
+
+    def ids(self) -> np.ndarray:
+        return self._ids
+
+    def text_bytes(self) -> int:
+        return len(self._mm) - self._text_at
+
+# === JSONL 切塊檔（舊版格式，仍可讀取） ======================
+def read_jsonl_store(path: str) -> List[DocChunk]:
+    chunks = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            obj = json.loads(line)
+            # 舊版格式的 text 已內含摘要前言
+            chunks.append(DocChunk(id=obj["id"], text=obj["text"], source=obj["source"]))
+    return chunks
+
+def open_store(path: str) -> Union[MappedChunkStore, ChunkStore]:
+    """依檔案格式開啟切塊檔：二進位檔以記憶體映射開啟，舊版 JSONL 則整份載入"""
+    if is_binary_store(path):
+        return MappedChunkStore(path)
+    return ChunkStore(read_jsonl_store(path))
+
+def read_all_chunks(path: str) -> List[DocChunk]:
+    """讀出所有切塊（build 時使用），支援兩種格式"""
+    if os.path.exists(path) and is_binary_store(path):
+        return list(MappedChunkStore(path))
+    return read_jsonl_store(path)
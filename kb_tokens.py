@@ -0,0 +1,80 @@
+import re
+from typing import Optional
+
+# === token 估算 =============================================
+# 有安裝 tiktoken 時以 o200k_base 編碼精確計算；否則粗估：
+# 中日韓字元約 1 字 1 token，其餘文字約 4 個字元 1 token（估算值偏高，較安全）
+TOKEN_ENCODING = "o200k_base"
+
+_CJK_RE = re.compile(r"[㐀-䶿一-鿿豈-﫿぀-ヿ가-힯　-〿＀-￯]")
+# 句尾：中文句號/問號/驚嘆號/分號、英文句尾標點後接空白、換行
+_SENTENCE_END_RE = re.compile(r"[。！？；!?]+[」』）)]*|[.;:](?=\s)|\n")
+
+_encoding = None
+_encoding_loaded = False
+
+
+def _get_encoding():
+    global _encoding, _encoding_loaded
+    if not _encoding_loaded:
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding(TOKEN_ENCODING)
+        except Exception:
+            _encoding = None
+        _encoding_loaded = True
+    return _encoding
+
+
+def estimate_tokens(text: str) -> int:
+    if not text:
+        return 0
+    enc = _get_encoding()
+    if enc is not None:
+        return len(enc.encode(text, disallowed_special=()))
+    cjk = len(_CJK_RE.findall(text))
+    rest = len(text) - cjk
+    return cjk + (rest + 3) // 4
+
+
+def chars_within_tokens(text: str, start: int, max_tokens: int) -> int:
+    """text[start:] 開頭放得進 max_tokens 的字元數（至少 1 個字元）
+
+    先以每 token 4 字元的上限猜長度，再依實際估算的 token 數等比例縮小，
+    通常兩三次估算即收斂（結果不一定是最長前綴，但不超過上限且接近上限）。
+    """
+    remaining = len(text) - start
+    n = min(remaining, max_tokens * 4)
+    while n > 1:
+        tokens = estimate_tokens(text[start:start + n])
+        if tokens <= max_tokens:
+            break
+        n = min(n - 1, int(n * max_tokens / tokens * 0.98))
+    return max(1, n)
+
+
+def truncate_to_tokens(text: str, max_tokens: int, suffix: str = "…") -> Optional[str]:
+    """截斷到 max_tokens 內，優先切在句尾
+
+    回傳截斷後的文字（未超出時原樣回傳）；連一個句子都放不下時回傳 None。
+    """
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    limit = max_tokens - estimate_tokens(suffix)
+    if limit <= 0:
+        return None
+    # 二分搜尋放得下的最長前綴（token 數隨長度單調遞增）
+    lo, hi = 0, len(text)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if estimate_tokens(text[:mid]) <= limit:
+            lo = mid
+        else:
+            hi = mid - 1
+    prefix = text[:lo]
+    cut = 0
+    for m in _SENTENCE_END_RE.finditer(prefix):
+        cut = m.end()
+    if cut == 0:
+        return None
+    return prefix[:cut].rstrip() + suffix
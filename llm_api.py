@@ -10,6 +10,8 @@ import json
 import time
 from typing import Dict, List, Optional
 
+from llm_client import get_session, requests_timeout
+
 
 class LLMAPI:
     """LLM API 呼叫類別"""
@@ -29,6 +31,24 @@ class LLMAPI:
             "Authorization": f"Bearer {api_key}",
             "ngrok-skip-browser-warning": "true"
         }
+        # 共用 keep-alive 連線池（含逾時與 Retry-After 重試設定，見 llm_client.py）
+        self.session = get_session()
+        self._warmed = False
+    
+    def warmup(self):
+        """預熱：喚醒 ngrok 服務並建立 keep-alive 連線"""
+        print("🔄 ngrok 預熱中...")
+        try:
+            warmup_response = self.session.get(
+                self.base_url,
+                headers={"ngrok-skip-browser-warning": "true"},
+                timeout=requests_timeout()
+            )
+            print(f"   預熱 GET 請求狀態碼: {warmup_response.status_code}")
+            time.sleep(0.5)  # 稍微等待一下讓連線穩定
+        except Exception as e:
+            print(f"   預熱請求失敗 (可忽略): {e}")
+        self._warmed = True
     
     def chat_completion(
         self,
@@ -63,25 +83,16 @@ class LLMAPI:
             print(f"請求標頭: {json.dumps(dict(self.headers), ensure_ascii=False, indent=2)}")
             print(f"請求內容: {json.dumps(payload, ensure_ascii=False, indent=2)}")
             
-            # ngrok 預熱機制：先發送 GET 請求來喚醒服務
-            print("🔄 ngrok 預熱中...")
-            try:
-                warmup_response = requests.get(
-                    self.base_url,
-                    headers={"ngrok-skip-browser-warning": "true"},
-                    timeout=5
-                )
-                print(f"   預熱 GET 請求狀態碼: {warmup_response.status_code}")
-                time.sleep(0.5)  # 稍微等待一下讓連線穩定
-            except Exception as e:
-                print(f"   預熱請求失敗 (可忽略): {e}")
+            # ngrok 預熱機制：第一次請求前先發送 GET 喚醒服務，連線之後由 keep-alive 重用
+            if not self._warmed:
+                self.warmup()
             
             print("📤 發送主要 POST 請求...")
-            response = requests.post(
+            response = self.session.post(
                 url,
                 headers=self.headers,
                 json=payload,
-                timeout=30
+                timeout=requests_timeout()
             )
             
             print(f"回應狀態碼: {response.status_code}")
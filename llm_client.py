@@ -0,0 +1,190 @@
+"""
+LiteLLM Proxy 共用 HTTP 客戶端
+
+kb_rag、code_analyzer 與 llm_api 都經由這裡取得連線：
+- 連線池依服務併發量設定，keep-alive 重用連線，避免每個請求重新 TLS 握手
+- 連線逾時與讀取逾時分開設定（預設不再是無上限的等待）
+- 429 / 5xx / 連線錯誤自動重試：指數退避加隨機抖動，並遵守伺服器的 Retry-After
+- 啟用 HTTP/2（requirements 的 httpx[http2] 提供 h2 套件；Proxy 不支援時會自動以 HTTP/1.1 協商）
+- 啟動時可預先建立連線（prewarm），讓第一批請求不必承擔握手延遲
+- openai / requests 在第一次建立客戶端時才匯入，匯入本模組幾乎沒有成本
+"""
+
+from __future__ import annotations
+
+import os
+import threading
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Dict, Optional, Tuple
+
+from kb_lazy import lazy_import
+
+asyncio = lazy_import("asyncio")
+
+if TYPE_CHECKING:
+    import requests
+    from openai import OpenAI, AsyncOpenAI, Timeout
+    from urllib3.util.retry import Retry
+
+# === 參數 ===================================================
+BASE_URL = os.getenv("LITELLM_BASE", "https://llm.cubeapp945566.work")
+API_KEY = os.getenv("LITELLM_API_KEY", "sk-GhYWCOAf9uCrYTioB_mohQ")
+
+HTTP_POOL_SIZE = int(os.getenv("KB_HTTP_POOL_SIZE", "64"))            # 每個客戶端最多同時連線數
+HTTP_KEEPALIVE = int(os.getenv("KB_HTTP_KEEPALIVE", "32"))            # 閒置時保留的 keep-alive 連線數
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("KB_HTTP_KEEPALIVE_EXPIRY", "90"))   # 閒置連線保留秒數
+CONNECT_TIMEOUT = float(os.getenv("KB_HTTP_CONNECT_TIMEOUT", "5"))    # 建立連線（含 TLS）逾時
+READ_TIMEOUT = float(os.getenv("KB_HTTP_READ_TIMEOUT", "120"))        # 等待回應/串流下一段的逾時
+WRITE_TIMEOUT = float(os.getenv("KB_HTTP_WRITE_TIMEOUT", "30"))
+POOL_TIMEOUT = float(os.getenv("KB_HTTP_POOL_TIMEOUT", "10"))         # 等待連線池空出連線的逾時
+MAX_RETRIES = int(os.getenv("KB_HTTP_MAX_RETRIES", "3"))
+BACKOFF_FACTOR = 0.5              # requests 重試退避：0.5, 1, 2, ... 秒
+BACKOFF_JITTER = 0.25             # 每次退避額外加上 0 ~ 0.25 秒隨機抖動
+BACKOFF_MAX = 8.0
+RETRY_STATUSES = (408, 409, 429, 500, 502, 503, 504)
+PREWARM_CONNECTIONS = int(os.getenv("KB_HTTP_PREWARM", "4"))          # 啟動時預先建立的連線數
+# auto：有安裝 h2 才啟用（未安裝時退回 HTTP/1.1，不會啟動失敗）；1/0 強制開關
+HTTP2 = os.getenv("KB_HTTP2", "auto").lower()
+
+
+def http2_enabled() -> bool:
+    if HTTP2 in ("1", "true", "yes"):
+        return True
+    if HTTP2 in ("0", "false", "no"):
+        return False
+    return importlib.util.find_spec("h2") is not None
+
+
+def _timeout() -> Timeout:
+    from openai import Timeout
+    return Timeout(connect=CONNECT_TIMEOUT, read=READ_TIMEOUT, write=WRITE_TIMEOUT, pool=POOL_TIMEOUT)
+
+
+def _limits():
+    import openai
+    # openai 依版本使用不同的 HTTP 套件，連線池設定類別取自 openai 本身，避免綁定特定套件
+    limits_cls = type(openai.DEFAULT_CONNECTION_LIMITS)
+    return limits_cls(max_connections=HTTP_POOL_SIZE, max_keepalive_connections=HTTP_KEEPALIVE,
+                      keepalive_expiry=HTTP_KEEPALIVE_EXPIRY)
+
+
+# === OpenAI SDK 客戶端 ======================================
+# 重試由 SDK 處理：指數退避（0.5 秒起、上限 8 秒）加隨機抖動，並優先遵守 Retry-After
+_clients: Dict[Tuple[str, str, bool], object] = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(base_url: str = BASE_URL, api_key: str = API_KEY) -> OpenAI:
+    """取得共用的同步客戶端（同一組 base_url/api_key 只建立一次，連線池共用）"""
+    key = (base_url, api_key, False)
+    c = _clients.get(key)
+    if c is None:
+        with _clients_lock:
+            c = _clients.get(key)
+            if c is None:
+                from openai import OpenAI, DefaultHttpxClient
+                http_client = DefaultHttpxClient(limits=_limits(), timeout=_timeout(), http2=http2_enabled())
+                c = OpenAI(api_key=api_key, base_url=base_url, timeout=_timeout(),
+                           max_retries=MAX_RETRIES, http_client=http_client)
+                _clients[key] = c
+    return c
+
+
+def get_async_client(base_url: str = BASE_URL, api_key: str = API_KEY) -> AsyncOpenAI:
+    """取得共用的非同步客戶端（ASGI 服務使用）"""
+    key = (base_url, api_key, True)
+    c = _clients.get(key)
+    if c is None:
+        with _clients_lock:
+            c = _clients.get(key)
+            if c is None:
+                from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+                http_client = DefaultAsyncHttpxClient(limits=_limits(), timeout=_timeout(), http2=http2_enabled())
+                c = AsyncOpenAI(api_key=api_key, base_url=base_url, timeout=_timeout(),
+                                max_retries=MAX_RETRIES, http_client=http_client)
+                _clients[key] = c
+    return c
+
+
+# === requests Session（llm_api 使用） =======================
+# requests 不支援 HTTP/2；其餘連線池、逾時與重試設定與 SDK 客戶端一致
+_session: Optional[requests.Session] = None
+_session_lock = threading.Lock()
+
+
+def make_retry() -> Retry:
+    from urllib3.util.retry import Retry
+    return Retry(
+        total=MAX_RETRIES,
+        connect=MAX_RETRIES,
+        read=MAX_RETRIES,
+        status=MAX_RETRIES,
+        status_forcelist=RETRY_STATUSES,
+        allowed_methods=None,                 # LLM 請求為 POST，同樣重試
+        backoff_factor=BACKOFF_FACTOR,
+        backoff_jitter=BACKOFF_JITTER,
+        backoff_max=BACKOFF_MAX,
+        respect_retry_after_header=True,
+        raise_on_status=False,                # 重試用盡時回傳最後的回應，由呼叫端處理錯誤碼
+    )
+
+
+def get_session() -> requests.Session:
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE, max_retries=make_retry())
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                _session = session
+    return _session
+
+
+def requests_timeout() -> Tuple[float, float]:
+    """requests 的 (連線逾時, 讀取逾時)"""
+    return (CONNECT_TIMEOUT, READ_TIMEOUT)
+
+
+# === 連線預熱 ===============================================
+def prewarm(n: int = PREWARM_CONNECTIONS, base_url: str = BASE_URL, api_key: str = API_KEY) -> int:
+    """同時送出 n 個輕量請求（列出模型），讓連線池先建立好 n 條連線；回傳成功數"""
+    if n <= 0:
+        return 0
+    c = get_client(base_url, api_key)
+
+    def touch(_):
+        try:
+            c.with_options(max_retries=0).models.list()
+            return True
+        except Exception as e:
+            print(f"[WARN] 連線預熱失敗：{e}")
+            return False
+
+    with ThreadPoolExecutor(max_workers=n) as pool:
+        ok = sum(pool.map(touch, range(n)))
+    print(f"[INFO] 已預先建立 {ok}/{n} 條 LLM 連線")
+    return ok
+
+
+async def aprewarm(n: int = PREWARM_CONNECTIONS, base_url: str = BASE_URL, api_key: str = API_KEY) -> int:
+    """prewarm 的非同步版本（於 ASGI 啟動時呼叫）"""
+    if n <= 0:
+        return 0
+    c = get_async_client(base_url, api_key).with_options(max_retries=0)
+
+    async def touch():
+        try:
+            await c.models.list()
+            return True
+        except Exception as e:
+            print(f"[WARN] 連線預熱失敗：{e}")
+            return False
+
+    ok = sum(await asyncio.gather(*[touch() for _ in range(n)]))
+    print(f"[INFO] 已預先建立 {ok}/{n} 條 LLM 連線")
+    return ok
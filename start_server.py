@@ -7,22 +7,21 @@
 import os
 import sys
 import subprocess
+import importlib.util
 from pathlib import Path
 
 def check_dependencies():
-    """檢查依賴套件"""
-    try:
-        import flask
+    """檢查依賴套件（只確認套件存在、不實際匯入；伺服器行程啟動時才載入）"""
+    if importlib.util.find_spec("flask") is not None:
         print("✓ Flask 已安裝")
-    except ImportError:
+    else:
         print("✗ Flask 未安裝，正在安裝...")
         subprocess.run([sys.executable, "-m", "pip", "install", "flask>=3.0.0"], check=True)
         print("✓ Flask 安裝完成")
     
-    try:
-        import flask_cors
+    if importlib.util.find_spec("flask_cors") is not None:
         print("✓ Flask-CORS 已安裝")
-    except ImportError:
+    else:
         print("✗ Flask-CORS 未安裝，正在安裝...")
         subprocess.run([sys.executable, "-m", "pip", "install", "flask-cors>=4.0.0"], check=True)
         print("✓ Flask-CORS 安裝完成")
@@ -30,9 +29,10 @@ def check_dependencies():
 def check_knowledge_base():
     """檢查知識庫索引是否存在"""
     index_file = Path("kb.index")
-    store_file = Path("kb_store.jsonl")
+    store_file = Path("kb_store.bin")
+    legacy_store_file = Path("kb_store.jsonl")
     
-    if index_file.exists() and store_file.exists():
+    if index_file.exists() and (store_file.exists() or legacy_store_file.exists()):
         print("✓ 知識庫索引已存在")
         return True
     else:
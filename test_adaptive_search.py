@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+測試自適應 top-k：分數門檻、相對落差、回傳數上限與 MMR 多樣化
+"""
+
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import faiss
+import numpy as np
+
+import kb_ann
+import kb_rag
+from kb_rag import ChunkStore, DocChunk, SearchOptions
+
+
+def _fixture(index=None):
+    vecs = np.array([
+        [1.0, 0.0, 0.0, 0.0],     # 10：最相關
+        [0.99, 0.14, 0.0, 0.0],   # 11：與 10 近似重複
+        [0.7, 0.0, 0.71, 0.0],    # 12：相關但內容不同
+        [0.0, 0.0, 0.0, 1.0],     # 13：不相關
+    ], dtype="float32")
+    faiss.normalize_L2(vecs)
+    ids = np.arange(10, 14, dtype="int64")
+    if index is None:
+        index = kb_rag.new_id_index(4)
+    index.add_with_ids(vecs, ids)
+    store = ChunkStore([DocChunk(id=int(i), text=f"片段{i}", source=f"{i}.md") for i in ids])
+    qv = np.array([[1.0, 0.0, 0.3, 0.0]], dtype="float32")
+    faiss.normalize_L2(qv)
+    return index, store, qv
+
+
+def _ids(index, store, qv, opts, k=4):
+    hits = kb_rag.search(index, "q", k=k, store=store, mode="vector", qv=qv, opts=opts)
+    return [c.id for c, _ in hits]
+
+
+def test_cutoffs_and_max_k():
+    index, store, qv = _fixture()
+    assert _ids(index, store, qv, SearchOptions()) == [10, 11, 12, 13]
+    assert _ids(index, store, qv, SearchOptions(min_score=0.5)) == [10, 11, 12]
+    assert _ids(index, store, qv, SearchOptions(max_gap=0.05)) == [10, 11]
+    assert _ids(index, store, qv, SearchOptions(max_k=1)) == [10]
+
+
+def test_mmr_prefers_diverse_hits():
+    index, store, qv = _fixture()
+    assert _ids(index, store, qv, SearchOptions(mmr_lambda=1.0), k=2) == [10, 11]
+    assert _ids(index, store, qv, SearchOptions(mmr_lambda=0.5), k=2) == [10, 12]
+    # 門檻先套用，再做 MMR
+    assert _ids(index, store, qv, SearchOptions(min_score=0.5, mmr_lambda=0.5)) == [10, 12, 11]
+
+
+def test_mmr_order_vectorized():
+    rel = np.array([0.9, 0.89, 0.5], dtype="float32")
+    sim = np.array([[1.0, 0.99, 0.1], [0.99, 1.0, 0.1], [0.1, 0.1, 1.0]], dtype="float32")
+    assert kb_rag.mmr_order(rel, sim, 3, 0.5) == [0, 2, 1]
+    assert kb_rag.mmr_order(rel, sim, 5, 1.0) == [0, 1, 2]
+
+
+def test_mmr_on_ivf_index():
+    quantizer_index = faiss.index_factory(4, "IVF1,Flat", faiss.METRIC_INNER_PRODUCT)
+    train = np.random.default_rng(0).random((50, 4), dtype="float32")
+    quantizer_index.train(train)
+    index, store, qv = _fixture(quantizer_index)
+    kb_ann.enable_reconstruct(index)
+    assert _ids(index, store, qv, SearchOptions(mmr_lambda=0.5), k=2) == [10, 12]
+
+
+def test_options_from_dict():
+    opts = SearchOptions.from_dict({"min_score": "0.3", "max_k": 5, "mmr": 0.7},
+                                   base=SearchOptions(max_gap=0.2))
+    assert opts == SearchOptions(min_score=0.3, max_gap=0.2, max_k=5, mmr_lambda=0.7)
+    assert SearchOptions.from_dict({"max_k": 50}).capped(10).max_k == 10
+    assert SearchOptions.from_dict({"max_k": 5}).capped(10).max_k == 5
+    for bad in ({"max_gap": 2}, {"max_k": 0}, {"max_k": kb_rag.SEARCH_MAX_K_LIMIT + 1}, {"mmr": "x"},
+                {"mode": "lexical", "mmr": 0.5}):
+        try:
+            SearchOptions.from_dict(bad)
+        except ValueError:
+            continue
+        raise AssertionError(f"應拒絕 {bad}")
+
+
+if __name__ == "__main__":
+    import pytest
+    sys.exit(pytest.main([__file__]))
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""
+測試 ANN 索引類型（flat / IVF / HNSW / IVF-PQ / 純量量化）、全精度重新評分與 recall/latency 報告
+"""
+
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import faiss
+import numpy as np
+
+import kb_ann
+import kb_rag
+from kb_ann import parse_index_spec
+from test_incremental_build import _setup
+
+
+def _vectors(n=2000, dim=32, seed=0):
+    vecs = np.random.default_rng(seed).standard_normal((n, dim)).astype("float32")
+    faiss.normalize_L2(vecs)
+    return vecs
+
+
+def test_parse_index_spec():
+    assert str(parse_index_spec("flat")) == "flat"
+    assert str(parse_index_spec("HNSW")) == "hnsw32"
+    assert str(parse_index_spec("ivf256")) == "ivf256"
+    assert str(parse_index_spec("ivf256,flat")) == "ivf256"
+    assert str(parse_index_spec("ivf256,pq8")) == "ivf256,pq8"
+    assert not parse_index_spec("hnsw16").supports_remove
+    assert str(parse_index_spec("flat,fp16")) == "flat,fp16"
+    assert str(parse_index_spec("int8")) == "flat,sq8"
+    assert str(parse_index_spec("hnsw16_sq8")) == "hnsw16,sq8"
+    assert parse_index_spec("ivf64,sqfp16").factory_string() == "IVF64,SQfp16"
+    assert parse_index_spec("flat,sq8").needs_training and not parse_index_spec("flat,fp16").needs_training
+    assert parse_index_spec("ivf8,pq2").quantized and not parse_index_spec("ivf8").quantized
+    for bad in ("lsh", "ivf8,pq2,sq8"):
+        try:
+            parse_index_spec(bad)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError(f"應拒絕不支援的索引規格：{bad}")
+
+
+def test_each_spec_keeps_ids_and_reports_recall():
+    # PQ 訓練較慢，用較少的向量與子向量數
+    for spec_str, n in [("flat", 2000), ("ivf32", 2000), ("hnsw16", 2000), ("ivf8,pq2", 400)]:
+        vecs = _vectors(n)
+        ids = np.arange(10_000, 10_000 + len(vecs), dtype="int64")
+        query_pos = kb_ann.pick_queries(len(vecs), 50)
+        spec = parse_index_spec(spec_str)
+        index = kb_ann.create_index(spec, vecs.shape[1], n_train=len(vecs))
+        if spec.needs_training:
+            index.train(kb_ann.train_sample(vecs, exclude=query_pos))
+        index.add_with_ids(vecs, ids)
+        report = kb_ann.evaluate_index(index, vecs, ids, query_pos, k=10)
+        _, got = index.search(vecs[:1], 1)
+        assert got[0][0] >= 10_000, spec_str
+        if spec.kind == "flat":
+            assert report["recall"] == 1.0
+            assert report["sweep"] == []
+        elif spec.kind in ("ivf", "hnsw"):
+            # 自動調整後應達到目標 recall
+            assert report["recall"] >= kb_ann.TUNE_TARGET_RECALL, spec_str
+            assert report["params"]
+        else:
+            assert 0.0 < report["recall"] <= 1.0
+
+
+def test_quantized_storage_saves_memory_and_rescoring_restores_recall():
+    vecs = _vectors(2000, dim=64)
+    ids = np.arange(500, 500 + len(vecs), dtype="int64")
+    query_pos = kb_ann.pick_queries(len(vecs), 50)
+    # flat 只有量化誤差，重新評分後應幾乎完全找回；HNSW 另受圖搜尋本身的 recall 限制
+    for spec_str, min_saving, min_recall in [("flat,fp16", 1.8, 0.99), ("flat,sq8", 3.0, 0.99),
+                                             ("hnsw16,sq8", 1.0, kb_ann.TUNE_TARGET_RECALL)]:
+        spec = parse_index_spec(spec_str)
+        index = kb_ann.create_index(spec, vecs.shape[1], n_train=len(vecs))
+        if spec.needs_training:
+            index.train(kb_ann.train_sample(vecs, exclude=query_pos))
+        index.add_with_ids(vecs, ids)
+        report = kb_ann.evaluate_index(index, vecs, ids, query_pos, k=10, rescore_factor=4)
+        assert report["flat_bytes_per_vector"] / report["bytes_per_vector"] >= min_saving, spec_str
+        assert report["rescore"]["recall"] >= report["recall"] - 1e-9, spec_str
+        assert report["rescore"]["recall"] >= min_recall, spec_str
+        # 重新評分時大小計入全精度向量檔
+        assert report["full_bytes_per_vector"] == report["flat_bytes_per_vector"], spec_str
+    assert "full_bytes_per_vector" not in kb_ann.evaluate_index(index, vecs, ids, query_pos, k=10)
+
+
+def test_rescoring_index_returns_exact_scores():
+    vecs = _vectors(500, dim=32)
+    ids = np.arange(1000, 1500, dtype="int64")
+    index = kb_ann.create_index(parse_index_spec("flat,sq8"), vecs.shape[1])
+    index.train(vecs)
+    index.add_with_ids(vecs, ids)
+    rescored = kb_ann.RescoringIndex(index, kb_ann.FullVectors(ids, vecs))
+    scores, got = rescored.search(vecs[:3], 5)
+    assert (got[:, 0] == ids[:3]).all()
+    exact = np.einsum("nkd,nd->nk", vecs[got - 1000], vecs[:3])
+    assert np.allclose(scores, exact, atol=1e-6)
+    assert np.array_equal(rescored.reconstruct_batch(ids[[7, 3]]), vecs[[7, 3]])
+    assert rescored.ntotal == 500
+
+    # 候選不足 k 時以 -1 補齊
+    _, got = rescored.search(vecs[:1], 600)
+    assert (got[0, :500] >= 1000).all() and (got[0, 500:] == -1).all()
+
+
+def test_rescoring_in_blocks_matches_single_block(monkeypatch):
+    vecs = _vectors(400, dim=32)
+    ids = np.arange(400, dtype="int64")
+    index = kb_ann.create_index(parse_index_spec("flat,fp16"), vecs.shape[1])
+    index.train(vecs)
+    index.add_with_ids(vecs, ids)
+    rescored = kb_ann.RescoringIndex(index, kb_ann.FullVectors(ids, vecs))
+    expected = rescored.search(vecs[:50], 10)
+    # 每段只放得下 3 個查詢的候選向量
+    monkeypatch.setattr(kb_ann, "RESCORE_BLOCK_BYTES", 3 * 10 * rescored.factor * 32 * 4)
+    got = rescored.search(vecs[:50], 10)
+    assert np.array_equal(got[1], expected[1]) and np.array_equal(got[0], expected[0])
+
+
+def test_quantized_build_publishes_full_vectors(tmp_path, monkeypatch):
+    docs, embedded = _setup(tmp_path, monkeypatch)
+    for i in range(40):
+        (docs / f"{i}.md").write_text(f"文件{i}", encoding="utf-8")
+    kb_rag.build_index(str(docs), index_spec="flat,sq8")
+
+    snap = kb_rag.IndexManager().current()
+    assert isinstance(snap.index, kb_ann.RescoringIndex)
+    vectors = kb_ann.FullVectors.open(kb_rag.VECTORS_PATH, kb_rag.VECTOR_IDS_PATH, snap.index.d)
+    assert len(vectors) == snap.index.ntotal == 40
+
+    # 多知識庫的記憶體估算計入記憶體映射的全精度向量檔
+    kb_dir = tmp_path / "kbs" / "q"
+    kb_dir.mkdir(parents=True)
+    for name in (kb_rag.INDEX_PATH, kb_rag.STORE_PATH, kb_rag.LEXICAL_PATH, kb_rag.VERSION_PATH,
+                 kb_rag.VECTORS_PATH, kb_rag.VECTOR_IDS_PATH):
+        (kb_dir / name).write_bytes((tmp_path / name).read_bytes())
+    registry = kb_rag.KBRegistry(root=str(tmp_path / "kbs"))
+    registry.current("q")
+    assert registry.stats()[0]["bytes"] >= os.path.getsize(kb_rag.VECTORS_PATH) + os.path.getsize(kb_rag.INDEX_PATH)
+
+    # 搜尋分數為全精度內積
+    qv = vectors.get(np.array([5]))
+    hits = kb_rag.search_vector(snap.index, qv, k=3, store=snap.store)
+    assert hits[0][0].id == 5 and abs(hits[0][1] - 1.0) < 1e-5
+
+    # 增量 build：沿用的向量從上一版複製，刪除的不保留
+    (docs / "0.md").unlink()
+    (docs / "new.md").write_text("新文件", encoding="utf-8")
+    embedded.clear()
+    kb_rag.build_index(str(docs), incremental=True, index_spec="flat,sq8")
+    assert len(embedded) == 1
+    index = faiss.read_index(kb_rag.INDEX_PATH)
+    vectors = kb_ann.FullVectors.open(kb_rag.VECTORS_PATH, kb_rag.VECTOR_IDS_PATH, index.d)
+    assert sorted(vectors._sorted_ids) == sorted(faiss.vector_to_array(index.id_map))
+    assert np.allclose(vectors.get(np.array([5])), qv)
+
+
+def test_search_params_survive_reload(tmp_path, monkeypatch):
+    """build 時調整的 nprobe 經由版本檔於載入時套用"""
+    docs, _ = _setup(tmp_path, monkeypatch)
+    for i in range(60):
+        (docs / f"{i}.md").write_text(f"文件{i}", encoding="utf-8")
+    kb_rag.build_index(str(docs), index_spec="ivf4", search_params={"nprobe": 3})
+
+    snap = kb_rag.IndexManager().current()
+    assert faiss.extract_index_ivf(snap.index).nprobe == 3
+    assert kb_rag.load_manifest()["index_spec"] == "ivf4"
+
+
+def test_quantized_build_without_rescoring_skips_full_vectors(tmp_path, monkeypatch):
+    docs, embedded = _setup(tmp_path, monkeypatch)
+    for i in range(40):
+        (docs / f"{i}.md").write_text(f"文件{i}", encoding="utf-8")
+    monkeypatch.setattr(kb_ann, "RESCORE", False)
+    kb_rag.build_index(str(docs), index_spec="flat,sq8")
+    assert not os.path.exists(kb_rag.VECTORS_PATH) and not os.path.exists(kb_rag.VECTOR_IDS_PATH)
+    snap = kb_rag.IndexManager().current()
+    assert not isinstance(snap.index, kb_ann.RescoringIndex) and snap.index.ntotal == 40
+
+    # 增量 build 不需要上一版的向量檔
+    (docs / "new.md").write_text("新文件", encoding="utf-8")
+    embedded.clear()
+    kb_rag.build_index(str(docs), incremental=True, index_spec="flat,sq8")
+    assert len(embedded) == 1 and faiss.read_index(kb_rag.INDEX_PATH).ntotal == 41
+    assert not os.path.exists(kb_rag.VECTORS_PATH)
+
+
+if __name__ == "__main__":
+    import pytest
+    sys.exit(pytest.main([__file__]))
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+測試語意答案快取（AnswerCache）與問答流程的快取重播
+"""
+
+import sys
+import os
+import time
+from types import SimpleNamespace
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import asyncio
+import json
+
+import faiss
+import numpy as np
+
+import kb_rag
+from kb_cache import AnswerCache, LRUCache
+
+
+def _unit(*xs):
+    v = np.asarray([xs], dtype="float32")
+    faiss.normalize_L2(v)
+    return v
+
+
+def test_similar_query_hits_same_version_only():
+    cache = AnswerCache(8, ttl=60, threshold=0.95)
+    cache.put("v1", _unit(1, 0, 0), "推播誰負責", "小明")
+    assert cache.lookup("v1", _unit(1, 0.05, 0)) == "小明"     # 語意相近
+    assert cache.lookup("v1", _unit(0, 1, 0)) is None          # 不相關
+    assert cache.lookup("v2", _unit(1, 0, 0)) is None          # 索引已更新
+
+
+def test_kbs_do_not_evict_each_other():
+    cache = AnswerCache(8, ttl=60, threshold=0.95)
+    cache.put("v1", _unit(1, 0, 0), "推播誰負責", "甲組答案", kb="team-a")
+    cache.put("d1", _unit(1, 0, 0), "推播誰負責", "預設答案")
+    cache.put("v7", _unit(1, 0, 0), "推播誰負責", "乙組答案", kb="team-b")
+    assert cache.lookup("v1", _unit(1, 0, 0), kb="team-a") == "甲組答案"
+    assert cache.lookup("d1", _unit(1, 0, 0)) == "預設答案"
+    assert cache.lookup("v7", _unit(1, 0, 0), kb="team-b") == "乙組答案"
+    assert cache.lookup("v1", _unit(1, 0, 0), kb="team-b") is None
+
+    cache.put("v2", _unit(0, 1, 0), "會員誰負責", "甲組新答案", kb="team-a")   # team-a 重建：只淘汰 team-a 舊版
+    assert cache.lookup("v1", _unit(1, 0, 0), kb="team-a") is None
+    assert cache.lookup("d1", _unit(1, 0, 0)) == "預設答案"
+    assert cache.lookup("v7", _unit(1, 0, 0), kb="team-b") == "乙組答案"
+    assert len(cache) == 3
+
+
+def test_identifiers_and_date_must_match():
+    cache = AnswerCache(8, ttl=60, threshold=0.95)
+    q1, q2 = "CUBE-1234 誰負責 #Today: 2025-09-30", "CUBE-1235 誰負責 #Today: 2025-09-30"
+    cache.put("v1", _unit(1, 0, 0), q1, "小明", kb_rag.answer_cache_key(q1))
+    assert cache.lookup("v1", _unit(1, 0, 0), kb_rag.answer_cache_key(q2)) is None     # 工單號碼不同
+    assert cache.lookup("v1", _unit(1, 0, 0), kb_rag.answer_cache_key(
+        "CUBE-1234 誰負責 #Today: 2025-10-01")) is None                                   # 日期不同
+    assert cache.lookup("v1", _unit(1, 0.05, 0), kb_rag.answer_cache_key(
+        "ｃｕｂｅ-1234   是誰負責的 #Today: 2025-09-30")) == "小明"                         # 問法不同、對象相同
+    assert kb_rag.answer_cache_key("v2.1 版本何時上線") != kb_rag.answer_cache_key("v2.2 版本何時上線")
+
+
+def test_ttl_and_lru_eviction():
+    cache = AnswerCache(2, ttl=0.05, threshold=0.95)
+    cache.put("v1", _unit(1, 0, 0), "a", "A")
+    cache.put("v1", _unit(0, 1, 0), "b", "B")
+    assert cache.lookup("v1", _unit(1, 0, 0)) == "A"
+    cache.put("v1", _unit(0, 0, 1), "c", "C")                  # b 最久未使用，被淘汰
+    assert cache.lookup("v1", _unit(0, 1, 0)) is None
+    assert cache.lookup("v1", _unit(1, 0, 0)) == "A"
+    assert len(cache) == 2
+    time.sleep(0.06)
+    assert cache.lookup("v1", _unit(1, 0, 0)) is None
+
+
+def test_ask_stream_replays_cached_answer(monkeypatch):
+    snap = kb_rag.KBSnapshot(index=None, store=None, version="v1")
+    monkeypatch.setattr(kb_rag, "get_index_manager", lambda: SimpleNamespace(current=lambda: snap))
+    monkeypatch.setattr(kb_rag, "_answer_cache", AnswerCache(8, ttl=60, threshold=0.95))
+    monkeypatch.setattr(kb_rag, "embed_query", lambda q: np.ones((1, 4), dtype="float32"))
+    monkeypatch.setattr(kb_rag, "search", lambda *a, **kw: [])
+    calls = []
+
+    def fake_create(**kwargs):
+        calls.append(kwargs)
+        return iter([SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=p))])
+                     for p in ["推播由", "小明負責"]])
+
+    monkeypatch.setattr(kb_rag.client.chat.completions, "create", fake_create)
+    first = "".join(kb_rag.ask_stream("推播誰負責 #Today: 2025-09-30"))
+    second = "".join(kb_rag.ask_stream("推播 誰負責 #today: 2025-09-30"))
+    assert first == second == "推播由小明負責"
+    assert len(calls) == 1
+    assert kb_rag.lookup_cached_answer("推播誰負責 #Today: 2025-09-30") == "推播由小明負責"
+    assert kb_rag.lookup_cached_answer("推播誰負責 #Today: 2025-10-01") is None   # 隔天不沿用
+
+
+def test_ask_endpoints_embed_and_look_up_once(monkeypatch):
+    snap = kb_rag.KBSnapshot(index=None, store=None, version="v1")
+    manager = SimpleNamespace(current=lambda: snap)
+    monkeypatch.setattr(kb_rag, "get_index_manager", lambda: manager)
+    monkeypatch.setattr(kb_rag, "_query_cache", LRUCache(0))      # 停用查詢向量快取，每次嵌入都會被計數
+    cache = AnswerCache(8, ttl=60, threshold=0.95)
+    monkeypatch.setattr(kb_rag, "_answer_cache", cache)
+    embeds, lookups = [], []
+    monkeypatch.setattr(kb_rag, "embed_query", lambda q: embeds.append(q) or np.ones((1, 4), dtype="float32"))
+
+    async def aembed_query(q):
+        return kb_rag.embed_query(q)
+
+    monkeypatch.setattr(kb_rag, "aembed_query", aembed_query)
+    lookup = cache.lookup
+    monkeypatch.setattr(cache, "lookup", lambda *a, **kw: lookups.append(a) or lookup(*a, **kw))
+    monkeypatch.setattr(kb_rag, "search", lambda *a, **kw: [])
+    monkeypatch.setattr(kb_rag, "asearch", lambda *a, **kw: asyncio.sleep(0, []))
+
+    def fake_create(**kwargs):
+        if kwargs.get("stream"):
+            return iter([SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content="答案"))])])
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content="答案"))])
+
+    async def afake_create(**kwargs):
+        return FakeStream(["答案"], 0.0) if kwargs.get("stream") else fake_create(**kwargs)
+
+    monkeypatch.setattr(kb_rag.client.chat.completions, "create", fake_create)
+    monkeypatch.setattr(kb_rag.aclient.chat.completions, "create", afake_create)
+
+    import app as flask_app
+    from test_asgi_app import FakeStream, _call
+    monkeypatch.setattr(flask_app, "_manager", manager)
+    client = flask_app.app.test_client()
+    for i, stream in enumerate((False, True)):
+        cache.clear()
+        embeds.clear()
+        lookups.clear()
+        resp = client.post("/api/ask", json={"question": f"問題{i}", "stream": stream})
+        assert resp.status_code == 200 and json.loads(resp.data.splitlines()[0])["cached"] is False
+        assert len(embeds) == 1 and len(lookups) == 1, stream
+
+        cache.clear()
+        embeds.clear()
+        lookups.clear()
+        status, _, body = asyncio.run(_call("POST", "/api/ask", {"question": f"問題{i}", "stream": stream}))
+        assert status == 200 and json.loads(body.splitlines()[0])["cached"] is False
+        assert len(embeds) == 1 and len(lookups) == 1, stream
+
+
+if __name__ == "__main__":
+    import pytest
+    sys.exit(pytest.main([__file__]))
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""
+測試 ASGI 服務（asgi_app）與 kb_rag 的非同步問答
+"""
+
+import sys
+import os
+import json
+import time
+import asyncio
+from types import SimpleNamespace
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import kb_rag
+import asgi_app
+from kb_cache import AnswerCache, LRUCache
+from test_incremental_build import _setup, fake_embed
+
+
+async def _call(method, path, body=None, query_string=b""):
+    """以 ASGI 介面直接呼叫 app，回傳 (status, headers, body)"""
+    payload = json.dumps(body).encode("utf-8") if body is not None else b""
+    sent = []
+    received = False
+
+    async def receive():
+        nonlocal received
+        if received:
+            await asyncio.sleep(3600)
+        received = True
+        return {"type": "http.request", "body": payload, "more_body": False}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {"type": "http", "method": method, "path": path, "query_string": query_string, "headers": []}
+    await asgi_app.app(scope, receive, send)
+    start = sent[0]
+    data = b"".join(m.get("body", b"") for m in sent[1:])
+    return start["status"], dict(start["headers"]), data
+
+
+class FakeStream:
+    def __init__(self, parts, delay):
+        self.parts = parts
+        self.delay = delay
+
+    def __aiter__(self):
+        return self._gen()
+
+    async def _gen(self):
+        for p in self.parts:
+            await asyncio.sleep(self.delay)
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=p))])
+
+
+def _serve(tmp_path, monkeypatch, delay=0.0):
+    docs, _ = _setup(tmp_path, monkeypatch)
+    (docs / "cubeapp上線記錄.md").write_text("CUBE-1234 推播服務上線，負責人王小明", encoding="utf-8")
+    (docs / "b.md").write_text("會員系統架構說明", encoding="utf-8")
+    kb_rag.build_index(str(docs))
+
+    async def fake_aembed(texts):
+        return fake_embed(texts)
+
+    calls = []
+
+    async def fake_create(**kwargs):
+        calls.append(kwargs)
+        if kwargs.get("stream"):
+            return FakeStream(["推播由", "王小明", "負責"], delay)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content="推播由王小明負責"))])
+
+    monkeypatch.setattr(kb_rag, "aembed_texts", fake_aembed)
+    monkeypatch.setattr(kb_rag, "aclient", SimpleNamespace(chat=SimpleNamespace(
+        completions=SimpleNamespace(create=fake_create))))
+    monkeypatch.setattr(kb_rag, "_manager", kb_rag.IndexManager())
+    monkeypatch.setattr(kb_rag, "_query_cache", LRUCache(64, 60))
+    monkeypatch.setattr(kb_rag, "_answer_cache", AnswerCache(0, 0, 0.95))
+    return calls
+
+
+def test_search_and_ask(tmp_path, monkeypatch):
+    calls = _serve(tmp_path, monkeypatch)
+    status, _, body = asyncio.run(_call("POST", "/api/search", {"query": "CUBE-1234", "mode": "hybrid"}))
+    data = json.loads(body)
+    assert status == 200 and data["success"]
+    assert data["results"][0]["source"].endswith("cubeapp上線記錄.md")
+
+    status, _, body = asyncio.run(_call("POST", "/api/ask", {"question": "推播誰負責"}))
+    assert json.loads(body) == {"success": True, "answer": "推播由王小明負責", "question": "推播誰負責", "cached": False}
+
+    status, headers, body = asyncio.run(_call("POST", "/api/ask", {"question": "推播誰負責"}, b"stream=true"))
+    assert headers[b"content-type"].startswith(b"application/x-ndjson")
+    events = [json.loads(line) for line in body.decode("utf-8").splitlines()]
+    assert events[0]["type"] == "start" and events[-1] == {"type": "end"}
+    assert "".join(e["content"] for e in events if e["type"] == "delta") == "推播由王小明負責"
+    assert len(calls) == 2
+
+    assert asyncio.run(_call("POST", "/api/ask", {"question": " "}))[0] == 400
+    assert asyncio.run(_call("POST", "/api/search/batch", {"queries": ["x"], "k": "abc"}))[0] == 400
+    assert asyncio.run(_call("POST", "/api/search/batch", {"queries": ["x"], "k": 0}))[0] == 400
+    monkeypatch.setattr(asgi_app, "MAX_BATCH_K", 1)
+    status, _, body = asyncio.run(_call("POST", "/api/search/batch",
+                                        {"queries": ["推播"], "k": 10 ** 9, "mode": "lexical"}))
+    assert status == 200 and len(json.loads(body)["results"][0]["results"]) == 1
+    status, _, body = asyncio.run(_call("POST", "/api/search/batch",
+                                        {"queries": ["推播"], "max_k": 5, "mode": "vector"}))
+    assert status == 200 and len(json.loads(body)["results"][0]["results"]) == 1
+    assert asyncio.run(_call("POST", "/api/search", {"query": "推播", "mode": "lexical", "mmr": 0.5}))[0] == 400
+    assert asyncio.run(_call("GET", "/api/nothing"))[0] == 404
+    assert asyncio.run(_call("GET", "/api/ask"))[0] == 405
+
+
+def test_concurrent_streams_share_one_thread(tmp_path, monkeypatch):
+    """大量同時串流在同一個 event loop 上交錯進行，總時間接近單一串流"""
+    _serve(tmp_path, monkeypatch, delay=0.1)
+
+    async def many():
+        return await asyncio.gather(*[
+            _call("POST", "/api/ask", {"question": f"問題{i}", "stream": True}) for i in range(30)
+        ])
+
+    t0 = time.perf_counter()
+    results = asyncio.run(many())
+    elapsed = time.perf_counter() - t0
+    assert all(status == 200 and body.endswith(b'{"type": "end"}\n') for status, _, body in results)
+    assert elapsed < 3.0     # 逐一執行需 30 x 0.3 秒
+
+
+if __name__ == "__main__":
+    import pytest
+    sys.exit(pytest.main([__file__]))
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+測試批次檢索（search_many 與 /api/search/batch）
+"""
+
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import kb_rag
+from kb_cache import LRUCache
+from test_incremental_build import _setup
+
+
+class CountingIndex:
+    """記錄 index.search 呼叫次數的包裝"""
+
+    def __init__(self, index):
+        self.index = index
+        self.calls = 0
+
+    def search(self, qvs, k):
+        self.calls += 1
+        return self.index.search(qvs, k)
+
+
+def _build(tmp_path, monkeypatch):
+    docs, embedded = _setup(tmp_path, monkeypatch)
+    for i in range(6):
+        (docs / f"{i}.md").write_text(f"文件{i} 編號 T-{i}", encoding="utf-8")
+    kb_rag.build_index(str(docs))
+    monkeypatch.setattr(kb_rag, "_query_cache", LRUCache(64, 60))
+    return kb_rag.IndexManager().current(), embedded
+
+
+def test_search_many_matches_single_search(tmp_path, monkeypatch):
+    snap, embedded = _build(tmp_path, monkeypatch)
+    queries = ["T-1", "文件 2", "T-1 #Today: 2025-09-30", "T-5"]
+    calls = []
+    embed = kb_rag.embed_texts
+    monkeypatch.setattr(kb_rag, "embed_texts", lambda texts: calls.append(list(texts)) or embed(texts))
+    index = CountingIndex(snap.index)
+
+    for mode in ("vector", "hybrid"):
+        calls.clear()
+        kb_rag._query_cache.clear()
+        batch = kb_rag.search_many(index, queries, k=3, store=snap.store, lexical=snap.lexical, mode=mode)
+        # 相同查詢（去除日期標記後）只嵌入一次，且整批一個 embeddings 請求
+        assert calls == [["T-1", "文件 2", "T-5"]]
+        for q, hits in zip(queries, batch):
+            single = kb_rag.search(snap.index, q, k=3, store=snap.store, lexical=snap.lexical, mode=mode)
+            assert [(c.id, round(s, 5)) for c, s in hits] == [(c.id, round(s, 5)) for c, s in single]
+    assert index.calls == 2
+
+
+def test_batch_endpoint(tmp_path, monkeypatch):
+    snap, _ = _build(tmp_path, monkeypatch)
+    import app as webapp
+    monkeypatch.setattr(webapp, "_manager", kb_rag.IndexManager())
+    client = webapp.app.test_client()
+
+    resp = client.post("/api/search/batch", json={"queries": ["T-3", "T-4"], "k": 2, "mode": "lexical"})
+    data = resp.get_json()
+    assert data["success"] and data["total_queries"] == 2
+    assert data["results"][0]["results"][0]["source"].endswith("3.md")
+    assert data["results"][1]["results"][0]["source"].endswith("4.md")
+
+    assert client.post("/api/search/batch", json={"queries": []}).status_code == 400
+    assert client.post("/api/search/batch", json={"queries": ["x"], "mode": "bad"}).status_code == 400
+    for bad_k in (0, -1, "abc", 2.5, True, None):
+        assert client.post("/api/search/batch", json={"queries": ["x"], "k": bad_k}).status_code == 400, bad_k
+
+    resp = client.post("/api/search/batch", json={"queries": ["x"], "max_k": kb_rag.SEARCH_MAX_K_LIMIT + 1})
+    assert resp.status_code == 400
+
+    # k 過大時以 MAX_BATCH_K 為上限
+    monkeypatch.setattr(webapp, "MAX_BATCH_K", 2)
+    resp = client.post("/api/search/batch", json={"queries": ["文件"], "k": 10 ** 9, "mode": "lexical"})
+    assert resp.status_code == 200 and len(resp.get_json()["results"][0]["results"]) == 2
+    # max_k 取代 k 時同樣以 MAX_BATCH_K 為上限
+    resp = client.post("/api/search/batch", json={"queries": ["文件"], "max_k": 5, "mode": "lexical"})
+    assert resp.status_code == 200 and len(resp.get_json()["results"][0]["results"]) == 2
+
+    # lexical 模式沒有查詢向量，指定 mmr 回傳 400
+    resp = client.post("/api/search/batch", json={"queries": ["文件"], "mode": "lexical", "mmr": 0.5})
+    assert resp.status_code == 400 and "mmr" in resp.get_json()["error"]
+    assert client.post("/api/search", json={"query": "文件", "mode": "lexical", "mmr": 0.5}).status_code == 400
+
+
+if __name__ == "__main__":
+    import pytest
+    sys.exit(pytest.main([__file__]))
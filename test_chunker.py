@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+"""
+測試一次掃描切塊：與舊版 chunk_text 結果一致、切塊位移取出的文字與 chunk_text 一致
+"""
+
+import os
+import sys
+import random
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from kb_chunker import chunk_spans, chunk_text, normalize_text, span_text
+from bench_chunking import legacy_chunk_text
+
+PIECES = ["---", "----", "------", " --- ", "\n---\n", "\r\n", "\n", "  ", "\t", "a---   ---b",
+          "- -", "--", "標題", "內容說明。", "word ", "x" * 50, "中" * 200, "y" * 500]
+
+
+def _random_doc(rng: random.Random, n: int) -> str:
+    return "".join(rng.choice(PIECES) for _ in range(n))
+
+
+def test_matches_legacy_random_docs():
+    rng = random.Random(20240601)
+    for _ in range(500):
+        text = _random_doc(rng, rng.randint(0, 120))
+        size = rng.choice([16, 64, 384])
+        assert chunk_text(text, size) == legacy_chunk_text(text, size), repr(text)
+
+
+def test_matches_legacy_on_knowledge_docs():
+    folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), "knowledge_docs")
+    if not os.path.isdir(folder):
+        return
+    for name in sorted(os.listdir(folder)):
+        if not name.endswith(".md"):
+            continue
+        with open(os.path.join(folder, name), "r", encoding="utf-8") as f:
+            text = f.read()
+        assert chunk_text(text) == legacy_chunk_text(text), name
+
+
+def test_oversized_section_kept_whole():
+    big = "z" * 1000
+    assert chunk_text(f"a\n---\n{big}\n---\nb", 100) == ["a", big, "b"]
+
+
+def test_spans_match_chunk_text():
+    rng = random.Random(7)
+    for _ in range(200):
+        text = _random_doc(rng, rng.randint(0, 300))
+        normalized = normalize_text(text)
+        assert [span_text(normalized, sp) for sp in chunk_spans(text, 64)] == chunk_text(text, 64), repr(text)
+
+
+if __name__ == "__main__":
+    import pytest
+    sys.exit(pytest.main([__file__]))
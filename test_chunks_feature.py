@@ -8,7 +8,8 @@ import sys
 import os
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
-from kb_rag import chunk_text, CHUNK_SIZE
+from kb_rag import chunk_text
+from kb_chunker import CHUNK_SIZE
 
 def test_chunk_splitting():
     """測試 chunk 切分功能"""
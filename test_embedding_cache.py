@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""
+測試 embedding 快取：命中時不呼叫遠端、依大小淘汰最久未使用的向量
+"""
+
+import sys
+import os
+import sqlite3
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import numpy as np
+
+import kb_rag
+from kb_cache import EmbeddingCache
+
+
+def test_embed_texts_uses_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(kb_rag, "EMBED_CACHE_PATH", str(tmp_path / "embed.sqlite"))
+    monkeypatch.setattr(kb_rag, "_embed_cache", None)
+    calls = []
+
+    def fake_remote(texts):
+        calls.append(list(texts))
+        return np.array([[len(t), 1.0, 2.0] for t in texts], dtype="float32")
+
+    monkeypatch.setattr(kb_rag, "_embed_remote", fake_remote)
+
+    first = kb_rag.embed_texts(["甲", "乙乙", "甲"])
+    assert calls == [["甲", "乙乙"]]
+    second = kb_rag.embed_texts(["乙乙", "丙丙丙", "甲"])
+    assert calls[1] == ["丙丙丙"]
+    np.testing.assert_array_equal(first[1], second[0])
+    np.testing.assert_array_equal(first[0], second[2])
+    assert second.flags.writeable
+
+
+def test_evict_by_size(tmp_path):
+    dim = 4
+    row_bytes = dim * 4
+    cache = EmbeddingCache(str(tmp_path / "embed.sqlite"), max_bytes=row_bytes * 3)
+    vecs = np.ones((1, dim), dtype="float32")
+    for t in ["a", "b", "c"]:
+        cache.put_many("m", [t], vecs)
+    # 讀取 a，讓 b 成為最久未使用
+    assert cache.get_many("m", ["a"])[0] is not None
+    cache.put_many("m", ["d"], vecs)
+    assert cache.size_bytes() <= row_bytes * 3
+    hits = cache.get_many("m", ["a", "b", "c", "d"])
+    assert hits[1] is None
+    assert hits[0] is not None and hits[3] is not None
+    # 不同模型視為不同 key
+    assert cache.get_many("other", ["a"]) == [None]
+
+
+def test_hit_atime_written_in_batches(tmp_path, monkeypatch):
+    path = str(tmp_path / "embed.sqlite")
+    cache = EmbeddingCache(path, max_bytes=1 << 20)
+    cache.put_many("m", ["a", "b"], np.ones((2, 4), dtype="float32"))
+
+    def atimes():
+        with sqlite3.connect(path) as conn:
+            return dict(conn.execute("SELECT key, atime FROM vectors"))
+
+    before = atimes()
+    monkeypatch.setattr(EmbeddingCache, "ATIME_FLUSH_KEYS", 2)
+    cache.get_many("m", ["a"])
+    assert atimes() == before                      # 命中只記在記憶體，不寫入 SQLite
+    cache.get_many("m", ["a", "b"])
+    after = atimes()
+    assert all(after[k] > before[k] for k in before)   # 累積到 ATIME_FLUSH_KEYS 筆才寫回
+
+    cache.get_many("m", ["b"])
+    cache.close()
+    assert atimes()[EmbeddingCache.make_key("m", "b")] > after[EmbeddingCache.make_key("m", "b")]
+
+
+if __name__ == "__main__":
+    import pytest
+    sys.exit(pytest.main([__file__]))
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+測試檢索內容組合（format_context）
+"""
+
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from kb_rag import DocChunk, format_context, pack_context, save_store, load_store
+from kb_tokens import estimate_tokens, truncate_to_tokens
+
+
+def test_summary_once_per_source():
+    """同一來源的多個命中只列一次文件摘要，並保留原排名編號"""
+    hits = [
+        (DocChunk(id=1, text="甲片段一", source="a.md", summary="甲文件摘要"), 0.9),
+        (DocChunk(id=7, text="乙片段", source="b.md", summary="乙文件摘要"), 0.8),
+        (DocChunk(id=2, text="甲片段二", source="a.md", summary="甲文件摘要"), 0.7),
+    ]
+    context = format_context(hits)
+    assert context.count("甲文件摘要") == 1
+    assert context.count("乙文件摘要") == 1
+    # 來源依最佳排名排序，同來源片段接在摘要之後
+    assert context.index("甲文件摘要") < context.index("[1]") < context.index("[3]") < context.index("乙文件摘要")
+    assert context.index("乙文件摘要") < context.index("[2]")
+
+
+def test_store_keeps_summary_once(tmp_path):
+    path = str(tmp_path / "kb_store.bin")
+    summary = "這是一段很長的文件摘要" * 20
+    chunks = [DocChunk(id=i, text=f"片段{i}", source="a.md", summary=summary) for i in range(30)]
+    save_store(chunks, path)
+    with open(path, "rb") as f:
+        assert f.read().count(summary.encode("utf-8")) == 1
+    assert load_store(path)[5].summary == summary
+
+
+def test_truncate_at_sentence_boundary():
+    text = "第一句話說明背景。第二句話描述細節！第三句話很長很長很長很長很長很長。"
+    assert truncate_to_tokens(text, 1000) == text
+    cut = truncate_to_tokens(text, 20)
+    assert cut == "第一句話說明背景。第二句話描述細節！…"
+    assert truncate_to_tokens("沒有任何句尾標點的一整段文字", 5) is None
+
+
+def test_pack_context_budget_dedup_and_truncation():
+    big = "。".join(f"第{i}句內容說明" for i in range(400)) + "。"
+    hits = [
+        (DocChunk(id=1, text="推播服務由王小明負責。", source="a.md", summary="甲摘要"), 0.9),
+        (DocChunk(id=2, text="推播服務由王小明負責。", source="b.md"), 0.85),          # 完全重複
+        (DocChunk(id=3, text="推播服務由王小明負責！！", source="c.md"), 0.84),        # 近似重複
+        (DocChunk(id=4, text=big, source="d.md"), 0.8),                                # 超大片段
+        (DocChunk(id=5, text="不會放入", source="e.md"), 0.7),
+    ]
+    packed = pack_context(hits, budget=300)
+    assert packed.tokens <= 300
+    assert packed.duplicates == 2
+    assert packed.truncated and packed.dropped == 1
+    assert [rank for rank, _, _ in packed.hits] == [1, 4]
+    last = packed.hits[-1][1].text
+    assert last.endswith("。…") and len(last) < len(big)
+    assert "不會放入" not in packed.text
+    assert packed.tokens == estimate_tokens(packed.text)
+    # 不限預算時全部放入（仍去除重複）
+    assert "不會放入" in format_context(hits, budget=0)
+
+
+if __name__ == "__main__":
+    import pytest
+    sys.exit(pytest.main([__file__]))
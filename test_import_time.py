@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+"""
+測試匯入成本：匯入 kb_rag / app 不載入 faiss、numpy、openai 等重模組，kb_rag 的匯入時間在預算內
+"""
+
+import sys
+import os
+import json
+import threading
+import subprocess
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from kb_lazy import LazyModule, lazy_import
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+HEAVY_MODULES = ("faiss", "numpy", "openai", "requests", "httpx", "asyncio", "multiprocessing")
+IMPORT_BUDGET_MS = float(os.getenv("KB_IMPORT_BUDGET_MS", "200"))   # 慢速 CI 可調高
+
+
+def _import_in_subprocess(module: str):
+    """在新行程中匯入 module，回傳 (已載入的重模組, 匯入累計時間 ms)"""
+    code = (f"import sys, json, {module}; "
+            f"print(json.dumps(sorted(m for m in {HEAVY_MODULES!r} if m in sys.modules)))")
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=ROOT,
+                          capture_output=True, text=True, check=True)
+    loaded = json.loads(proc.stdout.strip().splitlines()[-1])
+    # -X importtime 每行格式：import time: self [us] | cumulative | 模組名（縮排表示層級）
+    cumulative = [int(line.split("|")[1]) for line in proc.stderr.splitlines()
+                  if line.split("|")[-1].strip() == module and line.split("|")[-1].startswith(" " + module)]
+    return loaded, cumulative[-1] / 1000.0
+
+
+def test_kb_rag_import_is_light():
+    loaded, ms = _import_in_subprocess("kb_rag")
+    assert loaded == [], f"匯入 kb_rag 時載入了 {loaded}"
+    assert ms < IMPORT_BUDGET_MS, f"匯入 kb_rag 花了 {ms:.0f} ms（預算 {IMPORT_BUDGET_MS:.0f} ms）"
+
+
+def test_app_import_does_not_load_heavy_modules():
+    loaded, _ = _import_in_subprocess("app")
+    assert loaded == [], f"匯入 app 時載入了 {loaded}"
+
+
+def test_lazy_module_loads_once_on_first_use():
+    mod = LazyModule("colorsys")
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(mod.rgb_to_hsv(1.0, 0.0, 0.0)))
+               for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert results == [(0.0, 1.0, 1.0)] * 8
+    assert "rgb_to_hsv" in vars(mod)          # 載入後屬性直接放在代理上
+    assert lazy_import("json") is sys.modules["json"]
+
+
+if __name__ == "__main__":
+    import pytest
+    sys.exit(pytest.main([__file__]))
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""
+測試增量 build：只嵌入新增/變更的檔案，並刪除已移除檔案的向量
+"""
+
+import sys
+import os
+import hashlib
+import threading
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import faiss
+import numpy as np
+
+import kb_rag
+
+
+def fake_embed(texts):
+    """以文字 hash 產生固定向量，取代遠端 embedding 呼叫"""
+    vecs = []
+    for t in texts:
+        seed = int(hashlib.md5(t.encode("utf-8")).hexdigest()[:8], 16)
+        vecs.append(np.random.default_rng(seed).random(16, dtype="float32"))
+    return np.array(vecs, dtype="float32")
+
+
+def _setup(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    embedded = []
+
+    def counting_embed(texts):
+        embedded.extend(texts)
+        return fake_embed(texts)
+
+    monkeypatch.setattr(kb_rag, "embed_texts", counting_embed)
+    monkeypatch.setattr(kb_rag, "summarize_document", lambda txt, src, cache: f"{src} 摘要")
+    docs = tmp_path / "docs"
+    docs.mkdir()
+    return docs, embedded
+
+
+def test_incremental_build(tmp_path, monkeypatch):
+    docs, embedded = _setup(tmp_path, monkeypatch)
+    (docs / "a.md").write_text("甲一\n---\n甲二", encoding="utf-8")
+    (docs / "b.md").write_text("乙一", encoding="utf-8")
+    (docs / "c.md").write_text("丙一", encoding="utf-8")
+
+    kb_rag.build_index(str(docs))
+    full_count = len(embedded)
+    index = faiss.read_index(kb_rag.INDEX_PATH)
+    assert isinstance(index, faiss.IndexIDMap2)
+    assert index.ntotal == full_count
+
+    # 無變更：不重新嵌入
+    embedded.clear()
+    kb_rag.build_index(str(docs), incremental=True)
+    assert embedded == []
+
+    # 變更 b、刪除 c、新增 d
+    (docs / "b.md").write_text("乙一（已修改）", encoding="utf-8")
+    (docs / "c.md").unlink()
+    (docs / "d.md").write_text("丁一", encoding="utf-8")
+    kb_rag.build_index(str(docs), incremental=True)
+    assert len(embedded) == 2
+    assert all("甲" not in t for t in embedded)
+
+    store = kb_rag.ChunkStore(kb_rag.load_store(kb_rag.STORE_PATH))
+    index = faiss.read_index(kb_rag.INDEX_PATH)
+    assert index.ntotal == len(store)
+    sources = sorted({os.path.basename(c.source) for c in store})
+    assert sources == ["a.md", "b.md", "d.md"]
+
+    # 每個索引中的 id 都能在 store 取回對應切塊
+    ids = faiss.vector_to_array(index.id_map)
+    for cid in ids:
+        assert cid in store
+    manifest = kb_rag.load_manifest()
+    assert sorted(os.path.basename(p) for p in manifest["files"]) == ["a.md", "b.md", "d.md"]
+    assert manifest["next_id"] > max(ids)
+
+
+def test_pipeline_overlaps_summary_and_embedding(tmp_path, monkeypatch):
+    """第一份文件的 chunk 在其他文件仍在摘要時就開始嵌入"""
+    docs, embedded = _setup(tmp_path, monkeypatch)
+    (docs / "a.md").write_text("甲一", encoding="utf-8")
+    (docs / "b.md").write_text("乙一", encoding="utf-8")
+    embedding_started = threading.Event()
+    overlapped = []
+
+    def fake_embed_signal(texts):
+        embedding_started.set()
+        return fake_embed(texts)
+
+    calls = []
+
+    def slow_summary(txt, src, cache):
+        calls.append(src)
+        if len(calls) == 2:
+            # 第二份文件摘要進行中，等待第一份文件的 chunk 開始嵌入
+            overlapped.append(embedding_started.wait(timeout=5))
+        return f"{src} 摘要"
+
+    monkeypatch.setattr(kb_rag, "embed_texts", fake_embed_signal)
+    monkeypatch.setattr(kb_rag, "summarize_document", slow_summary)
+    monkeypatch.setattr(kb_rag, "EMBED_BATCH", 1)
+    monkeypatch.setattr(kb_rag, "SUMMARY_CONCURRENCY", 1)
+
+    kb_rag.build_index(str(docs))
+    assert overlapped == [True]
+    assert faiss.read_index(kb_rag.INDEX_PATH).ntotal == 2
+
+
+def test_pipeline_propagates_errors(tmp_path, monkeypatch):
+    docs, _ = _setup(tmp_path, monkeypatch)
+    (docs / "a.md").write_text("甲一", encoding="utf-8")
+
+    def broken_embed(texts):
+        raise RuntimeError("embedding 服務無回應")
+
+    monkeypatch.setattr(kb_rag, "embed_texts", broken_embed)
+    try:
+        kb_rag.build_index(str(docs))
+    except RuntimeError as e:
+        assert "embedding" in str(e)
+    else:
+        raise AssertionError("應拋出 embedding 錯誤")
+    assert not os.path.exists(kb_rag.INDEX_PATH)
+
+
+if __name__ == "__main__":
+    import pytest
+    sys.exit(pytest.main([__file__]))
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+測試 IndexManager：不可變快照、版本偵測與原子替換
+"""
+
+import sys
+import os
+import time
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import faiss
+import numpy as np
+
+import kb_ann
+import kb_rag
+from kb_rag import DocChunk, IndexManager, publish_index
+from kb_lexical import LexicalIndex
+
+
+def _make_index(n: int, dim: int = 8) -> faiss.Index:
+    vecs = np.random.default_rng(n).random((n, dim), dtype="float32")
+    faiss.normalize_L2(vecs)
+    index = faiss.IndexFlatIP(dim)
+    index.add(vecs)
+    return index
+
+
+def test_snapshot_swap(tmp_path, monkeypatch):
+    """新版發佈後背景載入並替換；舊快照參考仍可使用"""
+    monkeypatch.chdir(tmp_path)
+    publish_index(_make_index(2), [DocChunk(id=i, text=f"v1-{i}", source="a.md") for i in range(2)])
+
+    manager = IndexManager(check_interval=0.0)
+    old = manager.current()
+    assert old.index.ntotal == 2
+    assert manager.current() is old
+
+    publish_index(_make_index(3), [DocChunk(id=i, text=f"v2-{i}", source="a.md") for i in range(3)])
+
+    deadline = time.time() + 5
+    snap = manager.current()
+    while snap is old and time.time() < deadline:
+        time.sleep(0.05)
+        snap = manager.current()
+
+    assert snap.version != old.version
+    assert snap.index.ntotal == 3
+    assert [c.text for c in snap.store] == ["v2-0", "v2-1", "v2-2"]
+    # 進行中的請求所持有的舊快照不受影響
+    assert old.index.ntotal == 2
+    assert [c.text for c in old.store] == ["v1-0", "v1-1"]
+
+
+def _publish(n: int, tag: str, **kwargs) -> str:
+    chunks = [DocChunk(id=i, text=f"{tag}-{i}", source="a.md") for i in range(n)]
+    return publish_index(_make_index(n), chunks, **kwargs)
+
+
+def _publish_with_lexical(n: int, tag: str) -> str:
+    return _publish(n, tag, lexical=LexicalIndex.build([(i, f"{tag} {i}") for i in range(n)]))
+
+
+def test_snapshot_files_come_from_one_build(tmp_path, monkeypatch):
+    """載入途中有新版發佈：快照的索引與切塊仍來自同一版"""
+    monkeypatch.chdir(tmp_path)
+    v1 = _publish_with_lexical(2, "v1")
+    read_index = kb_ann.read_index
+    published = []
+
+    def racing_read_index(path, mmap=False):
+        index = read_index(path, mmap=mmap)
+        if not published:
+            published.append(_publish_with_lexical(3, "v2"))
+        return index
+
+    monkeypatch.setattr(kb_ann, "read_index", racing_read_index)
+    snap = IndexManager().current()
+    assert snap.version == v1 and snap.index.ntotal == 2 and len(snap.lexical) == 2
+    assert [c.text for c in snap.store] == ["v1-0", "v1-1"]
+
+    # 舊版目錄在載入途中被清除：改載入新版
+    monkeypatch.setattr(kb_rag, "KEEP_BUILDS", 1)
+    published.clear()
+    snap = IndexManager().current()
+    assert snap.version == published[0] and snap.index.ntotal == 3 and len(snap.lexical) == 3
+    assert [c.text for c in snap.store] == ["v2-0", "v2-1", "v2-2"]
+
+
+def test_publish_switches_build_directories(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    _publish(2, "v1", lexical=LexicalIndex.build([(0, "v1")]))
+    assert os.path.islink(kb_rag.INDEX_PATH) and os.path.exists(kb_rag.LEXICAL_PATH)
+    for tag in ("v2", "v3"):
+        last = _publish(3, tag)
+    # 只保留最近 KEEP_BUILDS 份；新版沒有的檔案不會沿用舊版
+    assert len(os.listdir(kb_rag.BUILDS_DIR)) == kb_rag.KEEP_BUILDS
+    assert not os.path.exists(kb_rag.LEXICAL_PATH)
+    snap = IndexManager().current()
+    assert snap.version == last and snap.lexical is None
+    assert all(p.startswith(os.path.join(kb_rag.BUILDS_DIR, last)) for p in snap.files)
+
+
+def test_missing_index(tmp_path, monkeypatch):
+    """尚未 build 時回報 FileNotFoundError"""
+    monkeypatch.chdir(tmp_path)
+    manager = IndexManager()
+    try:
+        manager.current()
+    except FileNotFoundError:
+        pass
+    else:
+        raise AssertionError("應回報 FileNotFoundError")
+
+
+if __name__ == "__main__":
+    import pytest
+    sys.exit(pytest.main([__file__]))
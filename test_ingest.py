@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+測試串流讀取：逐檔延遲讀取、串流解析 --- 分段與單檔大小上限
+"""
+
+import os
+import sys
+import random
+import hashlib
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import numpy as np
+
+import kb_ingest
+import kb_rag
+from kb_chunker import chunk_text, pack_sections
+from kb_ingest import iter_sections, iter_source_files
+
+PIECES = ["---", "----", "-", "--", " --- ", "\r\n", "\r", "\n", "  ", "段落內容。", "text ", "x" * 40]
+
+
+def _write(path, text):
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        f.write(text)
+
+
+def test_streamed_sections_match_chunk_text(tmp_path):
+    rng = random.Random(11)
+    path = str(tmp_path / "doc.md")
+    for _ in range(200):
+        text = "".join(rng.choice(PIECES) for _ in range(rng.randint(0, 80)))
+        _write(path, text)
+        with open(path, "r", encoding="utf-8") as f:
+            expected = chunk_text(f.read(), 32)
+        for buf in (1, 2, 3, 7, 64):
+            assert list(pack_sections(iter_sections(path, buf), 32)) == expected, repr(text)
+
+
+def test_scan_hash_matches_full_read(tmp_path):
+    _write(str(tmp_path / "a.md"), "甲\r\n---\r\n乙" * 1000)
+    _write(str(tmp_path / "blank.txt"), " \n\t\n")
+    files = list(iter_source_files(str(tmp_path)))
+    assert [os.path.basename(f.path) for f in files] == ["a.md"]
+    assert files[0].hash == kb_rag.content_hash(files[0].read_text())
+
+
+def test_size_guard_skips_large_files(tmp_path, capsys):
+    _write(str(tmp_path / "small.md"), "小檔")
+    _write(str(tmp_path / "big.md"), "大" * 2000)
+    files = list(iter_source_files(str(tmp_path), max_bytes=1000))
+    assert [os.path.basename(f.path) for f in files] == ["small.md"]
+    assert "略過" in capsys.readouterr().out
+
+
+def _build_chunks(docs, monkeypatch):
+    def fake_embed(texts):
+        return np.array([np.random.default_rng(int(hashlib.md5(t.encode()).hexdigest()[:8], 16)).random(8)
+                         for t in texts], dtype="float32")
+
+    monkeypatch.setattr(kb_rag, "embed_texts", fake_embed)
+    monkeypatch.setattr(kb_rag, "summarize_document", lambda txt, src, cache: "摘要")
+    kb_rag.build_index(str(docs))
+    return sorted((c.source, c.text) for c in kb_rag.load_store(kb_rag.STORE_PATH))
+
+
+def test_build_with_streamed_files_matches_full_read(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    docs = tmp_path / "docs"
+    docs.mkdir()
+    rng = random.Random(5)
+    for i in range(3):
+        _write(str(docs / f"d{i}.md"), "\n---\n".join("內容" * rng.randint(1, 150) for _ in range(40)))
+
+    full = _build_chunks(docs, monkeypatch)
+    monkeypatch.setattr(kb_ingest, "STREAM_FILE_BYTES", 0)
+    assert _build_chunks(docs, monkeypatch) == full
+
+
+def test_build_writes_chunks_as_they_are_produced(tmp_path, monkeypatch):
+    """切塊一產生就寫入切塊檔與關鍵字索引，不在管線中累積到發佈時才寫"""
+    monkeypatch.chdir(tmp_path)
+    docs = tmp_path / "docs"
+    docs.mkdir()
+    for i in range(4):
+        _write(str(docs / f"d{i}.md"), "\n---\n".join(f"文件{i} 第{j}段 " + "內容" * 150 for j in range(40)))
+    written = []
+
+    class RecordingWriter(kb_rag.BinaryStoreWriter):
+        def add(self, chunk):
+            written.append(chunk.id)
+            super().add(chunk)
+
+    embedded = []
+
+    def fake_embed(texts):
+        embedded.extend(texts)
+        assert len(written) >= len(embedded)     # 送去嵌入的切塊都已寫入切塊檔
+        return np.ones((len(texts), 8), dtype="float32")
+
+    monkeypatch.setattr(kb_rag, "BinaryStoreWriter", RecordingWriter)
+    monkeypatch.setattr(kb_rag, "embed_texts", fake_embed)
+    monkeypatch.setattr(kb_rag, "summarize_document", lambda txt, src, cache: "摘要")
+    kb_rag.build_index(str(docs))
+    snap = kb_rag.IndexManager().current()
+    assert sorted(written) == [int(i) for i in snap.store.ids()] and len(written) > kb_rag.EMBED_BATCH
+    assert snap.lexical.search("文件3 第7段", 1)[0][0] in snap.store
+    assert not os.path.exists(kb_rag.STORE_PATH + ".tmp.text")
+
+
+if __name__ == "__main__":
+    import pytest
+    sys.exit(pytest.main([__file__]))
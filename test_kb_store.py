@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""
+測試切塊資料：二進位記憶體映射格式與行程內共用（get_store）
+"""
+
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import json
+
+import kb_rag
+from kb_rag import DocChunk, save_store, get_store
+from kb_store import MappedChunkStore, open_store, ChunkStore
+
+
+def test_get_store_loads_once(tmp_path, monkeypatch):
+    """同一份 store 只開啟一次，重新 build 後才重新開啟"""
+    path = str(tmp_path / "kb_store.bin")
+    save_store([DocChunk(id=0, text="甲", source="a.md")], path)
+
+    calls = []
+    real_open = kb_rag.open_store
+
+    def counting_open(p):
+        calls.append(p)
+        return real_open(p)
+
+    monkeypatch.setattr(kb_rag, "open_store", counting_open)
+
+    first = get_store(path)
+    second = get_store(path)
+    assert first is second
+    assert len(calls) == 1
+
+    # 模擬重新 build：內容與大小改變
+    save_store([DocChunk(id=0, text="甲", source="a.md"),
+                DocChunk(id=1, text="乙", source="b.md")], path)
+    third = get_store(path)
+    assert len(calls) == 2
+    assert [c.text for c in third] == ["甲", "乙"]
+
+
+def test_mapped_store_roundtrip(tmp_path):
+    """以 id 查詢、只解碼命中的切塊；來源表去重"""
+    path = str(tmp_path / "kb_store.bin")
+    chunks = [DocChunk(id=i * 3, text=f"第{i}段：中文 text", source=f"{i % 2}.md") for i in range(50)]
+    save_store(list(reversed(chunks)), path)
+
+    store = open_store(path)
+    assert isinstance(store, MappedChunkStore)
+    assert len(store) == 50
+    assert store.sources == ["0.md", "1.md"]
+    assert store[21] == chunks[7]
+    assert 21 in store and 22 not in store
+    try:
+        store[22]
+    except KeyError:
+        pass
+    else:
+        raise AssertionError("不存在的 id 應拋出 KeyError")
+    assert list(store) == chunks
+
+
+def test_legacy_jsonl_store(tmp_path):
+    """舊版 build 的 kb_store.jsonl 仍可讀取"""
+    path = str(tmp_path / "kb_store.jsonl")
+    with open(path, "w", encoding="utf-8") as f:
+        for i, t in enumerate(["甲", "乙"]):
+            f.write(json.dumps({"id": i, "text": t, "source": "a.md"}, ensure_ascii=False) + "\n")
+    store = open_store(path)
+    assert isinstance(store, ChunkStore)
+    assert store[1].text == "乙"
+    assert [c.text for c in kb_rag.load_store(path)] == ["甲", "乙"]
+
+
+if __name__ == "__main__":
+    import pytest
+    sys.exit(pytest.main([__file__]))
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+測試 BM25 關鍵字檢索（中日韓 bigram 斷詞）與 vector / lexical / hybrid 檢索模式
+"""
+
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import kb_rag
+from kb_lexical import LexicalIndex, tokenize, rrf_fuse
+from test_incremental_build import _setup
+
+
+def test_tokenize():
+    assert tokenize("ＣＵＢＥ-1234 上線記錄") == ["cube-1234", "cube", "1234", "上線", "線記", "記錄"]
+    assert tokenize("由 王 負責 v2.3") == ["由", "王", "負責", "v2.3", "v2", "3"]
+
+
+def test_bm25_ranking_and_roundtrip(tmp_path):
+    index = LexicalIndex.build([
+        (10, "CUBE-1234 推播服務上線，負責人王小明"),
+        (11, "推播服務架構說明，推播流程與推播設定"),
+        (12, "會員系統上線記錄"),
+    ])
+    assert index.search("CUBE-1234", 3)[0][0] == 10
+    assert [cid for cid, _ in index.search("王小明", 3)] == [10]
+    assert index.search("推播", 3)[0][0] == 11          # 詞頻較高者排前
+    assert index.search("完全無關 xyz", 3) == []
+
+    path = str(tmp_path / "lex.npz")
+    index.save(path)
+    loaded = LexicalIndex.load(path)
+    assert loaded.search("上線", 3) == index.search("上線", 3)
+
+
+def test_rrf_fuse():
+    fused = rrf_fuse([[1, 2, 3], [3, 1]], k=2)
+    assert [cid for cid, _ in fused] == [1, 3]
+
+
+def test_search_modes_without_embedding(tmp_path, monkeypatch):
+    docs, _ = _setup(tmp_path, monkeypatch)
+    (docs / "cubeapp上線記錄.md").write_text("CUBE-1234 推播服務上線，負責人王小明", encoding="utf-8")
+    (docs / "b.md").write_text("會員系統架構說明", encoding="utf-8")
+    kb_rag.build_index(str(docs))
+    snap = kb_rag.IndexManager().current()
+    assert snap.lexical is not None and len(snap.lexical) == len(snap.store)
+
+    def broken_embed(texts):
+        raise RuntimeError("embedding backend down")
+
+    monkeypatch.setattr(kb_rag, "embed_texts", broken_embed)
+    monkeypatch.setattr(kb_rag, "_query_cache", kb_rag.LRUCache(0, 0))
+    for mode in ("lexical", "hybrid"):
+        hits = kb_rag.search(snap.index, "誰負責 CUBE-1234 #Today: 2025-09-30", k=3,
+                             store=snap.store, lexical=snap.lexical, mode=mode)
+        assert hits[0][0].source.endswith("cubeapp上線記錄.md"), mode
+    try:
+        kb_rag.search(snap.index, "CUBE-1234", store=snap.store, lexical=snap.lexical, mode="vector")
+    except RuntimeError:
+        pass
+    else:
+        raise AssertionError("vector 模式不應退回關鍵字檢索")
+
+
+def test_hybrid_fuses_both_rankings(tmp_path, monkeypatch):
+    docs, _ = _setup(tmp_path, monkeypatch)
+    # 摘要不含檔案路徑，嵌入輸入與 tmp_path 無關，向量排名固定
+    monkeypatch.setattr(kb_rag, "summarize_document", lambda txt, src, cache: "編號文件摘要")
+    for i in range(8):
+        (docs / f"{i}.md").write_text(f"文件{i} 編號 T-{i}", encoding="utf-8")
+    kb_rag.build_index(str(docs))
+    snap = kb_rag.IndexManager().current()
+    hits = kb_rag.search(snap.index, "T-5", k=3, store=snap.store, lexical=snap.lexical, mode="hybrid")
+    n = 3 * kb_rag.HYBRID_CANDIDATES
+    vec = kb_rag.search(snap.index, "T-5", k=n, store=snap.store, lexical=snap.lexical, mode="vector")
+    lex = kb_rag.search(snap.index, "T-5", k=n, store=snap.store, lexical=snap.lexical, mode="lexical")
+    assert lex[0][0].source.endswith("5.md")
+    expected = rrf_fuse([[c.id for c, _ in vec], [c.id for c, _ in lex]], 3)
+    assert [(c.id, s) for c, s in hits] == expected
+    assert any(c.source.endswith("5.md") for c, _ in hits)
+
+if __name__ == "__main__":
+    import pytest
+    sys.exit(pytest.main([__file__]))
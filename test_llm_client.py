@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+測試共用 HTTP 客戶端（llm_client）：共用實例、逾時設定、Retry-After 重試與連線預熱
+"""
+
+import sys
+import os
+import json
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import llm_client
+
+
+class FakeProxy(BaseHTTPRequestHandler):
+    """第一次 POST 回 429（Retry-After: 1），之後回正常的 chat completion"""
+    protocol_version = "HTTP/1.1"
+    hits = []
+    ports = set()
+
+    def _reply(self, status, obj, headers=None):
+        body = json.dumps(obj).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        FakeProxy.hits.append(self.path)
+        FakeProxy.ports.add(self.client_address[1])
+        self._reply(200, {"object": "list", "data": []})
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        FakeProxy.hits.append(self.path)
+        if FakeProxy.hits.count(self.path) == 1:
+            return self._reply(429, {"error": "rate limited"}, {"Retry-After": "1"})
+        self._reply(200, {
+            "id": "x", "object": "chat.completion", "created": 0, "model": "m",
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": "ok"}}],
+        })
+
+    def log_message(self, *args):
+        pass
+
+
+def _serve():
+    FakeProxy.hits = []
+    FakeProxy.ports = set()
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeProxy)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+def test_shared_client_settings():
+    a = llm_client.get_client("http://127.0.0.1:1", "k")
+    assert llm_client.get_client("http://127.0.0.1:1", "k") is a
+    assert llm_client.get_client("http://127.0.0.1:2", "k") is not a
+    assert a.max_retries == llm_client.MAX_RETRIES
+    assert a.timeout.connect == llm_client.CONNECT_TIMEOUT
+    assert a.timeout.read == llm_client.READ_TIMEOUT
+    assert llm_client.get_session() is llm_client.get_session()
+
+
+def test_http2_enabled_with_h2_installed():
+    import pytest
+    pytest.importorskip("h2")        # requirements.txt 以 httpx[http2] 安裝
+    assert llm_client.http2_enabled()
+    sync_pool = llm_client.get_client("http://127.0.0.1:3", "k")._client._transport._pool
+    async_pool = llm_client.get_async_client("http://127.0.0.1:3", "k")._client._transport._pool
+    assert sync_pool._http2 and async_pool._http2
+
+
+def test_sdk_retry_honors_retry_after():
+    server, url = _serve()
+    try:
+        c = llm_client.get_client(url, "k")
+        t0 = time.perf_counter()
+        resp = c.chat.completions.create(model="m", messages=[{"role": "user", "content": "hi"}])
+        assert resp.choices[0].message.content == "ok"
+        assert FakeProxy.hits == ["/chat/completions", "/chat/completions"]
+        assert time.perf_counter() - t0 >= 0.9
+    finally:
+        server.shutdown()
+
+
+def test_session_retry_honors_retry_after():
+    server, url = _serve()
+    try:
+        t0 = time.perf_counter()
+        resp = llm_client.get_session().post(f"{url}/chat/completions", json={},
+                                             timeout=llm_client.requests_timeout())
+        assert resp.status_code == 200
+        assert len(FakeProxy.hits) == 2
+        assert time.perf_counter() - t0 >= 0.9
+    finally:
+        server.shutdown()
+
+
+def test_prewarm_opens_connections():
+    server, url = _serve()
+    try:
+        assert llm_client.prewarm(3, base_url=url, api_key="k") == 3
+        assert FakeProxy.hits == ["/models"] * 3
+        # 預熱後的請求重用既有的 keep-alive 連線
+        ports = set(FakeProxy.ports)
+        llm_client.get_client(url, "k").models.list()
+        assert FakeProxy.ports == ports
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    import pytest
+    sys.exit(pytest.main([__file__]))
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""
+測試多知識庫：依 kb id 延遲載入、LRU 淘汰與 API 的 kb 參數
+"""
+
+import sys
+import os
+import asyncio
+from types import SimpleNamespace
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import kb_rag
+from kb_rag import KBRegistry
+from kb_cache import AnswerCache
+from test_incremental_build import _setup
+from test_asgi_app import _call
+
+
+def _build_kbs(tmp_path, monkeypatch):
+    docs, _ = _setup(tmp_path, monkeypatch)
+    for kb_id, text in (("team-a", "甲組 CUBE-100 推播服務"), ("team-b", "乙組 CUBE-200 會員系統")):
+        folder = docs / kb_id
+        folder.mkdir()
+        (folder / f"{kb_id}.md").write_text(text, encoding="utf-8")
+        kb_dir = tmp_path / "kbs" / kb_id
+        kb_dir.mkdir(parents=True)
+        monkeypatch.chdir(kb_dir)
+        kb_rag.build_index(str(folder))
+    monkeypatch.chdir(tmp_path)
+    registry = KBRegistry(root="kbs")
+    monkeypatch.setattr(kb_rag, "_registry", registry)
+    return registry
+
+
+def test_lazy_load_and_lru_eviction(tmp_path, monkeypatch):
+    registry = _build_kbs(tmp_path, monkeypatch)
+    assert registry.available() == ["team-a", "team-b"]
+    assert registry.stats() == []                       # 第一次使用時才載入
+
+    a = registry.current("team-a")
+    assert [c.source for c in a.store][0].endswith("team-a.md")
+    assert registry.current("team-a") is a
+
+    registry.max_open = 1
+    b = registry.current("team-b")
+    assert [s["kb"] for s in registry.stats()] == ["team-b"]
+    assert [c.source for c in b.store][0].endswith("team-b.md")
+    assert next(iter(a.store)).text.startswith("甲組")         # 淘汰後既有快照仍可使用
+
+    registry.max_open = 8
+    registry.max_bytes = 1                               # 總大小超過上限：只保留最近使用的一個
+    registry.current("team-a")
+    assert [s["kb"] for s in registry.stats()] == ["team-a"]
+
+
+def test_sizes_follow_hot_reload(tmp_path, monkeypatch):
+    registry = _build_kbs(tmp_path, monkeypatch)
+    registry.current("team-a")
+    [before] = registry.stats()
+
+    folder = tmp_path / "docs" / "team-a"
+    (folder / "more.md").write_text("甲組 CUBE-101 排程服務\n" * 2000, encoding="utf-8")
+    monkeypatch.chdir(tmp_path / "kbs" / "team-a")
+    kb_rag.build_index(str(folder))
+    monkeypatch.chdir(tmp_path)
+    registry.manager("team-a").reload()
+
+    registry.current("team-a")
+    [after] = registry.stats()
+    assert after["bytes"] > before["bytes"]              # 以新版快照的檔案重新計算
+
+
+def test_invalid_and_unknown_kb(tmp_path, monkeypatch):
+    registry = _build_kbs(tmp_path, monkeypatch)
+    for bad in ("../kbs", "a/b", "", ".hidden"):
+        try:
+            registry.kb_dir(bad)
+            assert False, bad
+        except ValueError:
+            pass
+    try:
+        registry.current("team-c")
+        assert False
+    except kb_rag.KBNotFoundError:
+        pass
+
+
+def test_api_kb_parameter(tmp_path, monkeypatch):
+    _build_kbs(tmp_path, monkeypatch)
+    import app as webapp
+    client = webapp.app.test_client()
+
+    for kb_id in ("team-a", "team-b"):
+        data = client.post("/api/search", json={"query": "CUBE", "mode": "lexical", "kb": kb_id}).get_json()
+        assert data["success"] and data["kb"] == kb_id
+        assert data["results"] and all(r["source"].endswith(f"{kb_id}.md") for r in data["results"])
+    assert client.post("/api/search", json={"query": "x", "kb": "team-c"}).status_code == 404
+    assert client.post("/api/search", json={"query": "x", "kb": "../etc"}).status_code == 400
+    assert client.post("/api/ask", json={"question": "x", "kb": "team-c"}).status_code == 404
+    assert client.get("/api/kbs").get_json()["kbs"] == ["team-a", "team-b"]
+
+    status, _, body = asyncio.run(_call("POST", "/api/search", {"query": "CUBE", "mode": "lexical", "kb": "team-b"}))
+    assert status == 200 and b"team-b.md" in body and b"team-a.md" not in body
+    status, _, _ = asyncio.run(_call("POST", "/api/search", {"query": "CUBE", "kb": "team-c"}))
+    assert status == 404
+
+
+def test_answer_cache_is_scoped_per_kb(tmp_path, monkeypatch):
+    _build_kbs(tmp_path, monkeypatch)
+    kb_rag.build_index(str(tmp_path / "docs"))           # 預設知識庫（工作目錄下的 kb.index）
+    monkeypatch.setattr(kb_rag, "_manager", kb_rag.IndexManager())
+    monkeypatch.setattr(kb_rag, "_answer_cache", AnswerCache(8, ttl=60, threshold=0.95))
+    calls = []
+
+    def fake_create(**kwargs):
+        calls.append(kwargs)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=f"答案{len(calls)}"))])
+
+    fake = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=fake_create)))
+    monkeypatch.setattr(kb_rag, "_client", lambda: fake)
+
+    answers = {kb_id: kb_rag.ask("誰負責推播", kb_id=kb_id) for kb_id in (None, "team-a", "team-b")}
+    assert len(set(answers.values())) == 3
+    # 其他知識庫的答案寫入快取後，各知識庫原本的快取答案仍可命中
+    for kb_id, answer in answers.items():
+        assert kb_rag.lookup_cached_answer("誰負責推播", kb_id) == answer
+        assert kb_rag.ask("誰負責推播", kb_id=kb_id) == answer
+    assert len(calls) == 3
+
+
+if __name__ == "__main__":
+    import pytest
+    sys.exit(pytest.main([__file__]))
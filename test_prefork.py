@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""
+測試 prefork 部署：索引與關鍵字索引以記憶體映射開啟、預熱完成後 /api/ready 才回報 ready
+"""
+
+import sys
+import os
+import asyncio
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import faiss
+import numpy as np
+
+import kb_ann
+import kb_rag
+from kb_lexical import LexicalIndex
+from test_incremental_build import _setup
+from test_asgi_app import _call
+from test_multi_kb import _build_kbs
+
+
+def _vectors(n=300, dim=16, seed=0):
+    vecs = np.random.default_rng(seed).standard_normal((n, dim)).astype("float32")
+    faiss.normalize_L2(vecs)
+    return vecs
+
+
+def test_mmap_index_matches_in_memory(tmp_path):
+    vecs = _vectors()
+    ids = np.arange(100, 100 + len(vecs), dtype="int64")
+    for spec_str in ("flat", "flat,sq8", "ivf4", "hnsw8"):
+        spec = kb_ann.parse_index_spec(spec_str)
+        index = kb_ann.create_index(spec, vecs.shape[1], n_train=len(vecs))
+        if spec.needs_training:
+            index.train(vecs)
+        index.add_with_ids(vecs, ids)
+        path = str(tmp_path / "kb.index")
+        faiss.write_index(index, path)
+
+        mapped = kb_ann.read_index(path, mmap=True)
+        kb_ann.enable_reconstruct(mapped)
+        expected = faiss.read_index(path).search(vecs[:5], 5)
+        got = mapped.search(vecs[:5], 5)
+        assert np.array_equal(got[1], expected[1]), spec_str
+        assert np.allclose(got[0], expected[0]), spec_str
+
+
+def test_lexical_mmap_load(tmp_path):
+    index = LexicalIndex.build([(7, "推播服務 CUBE-100"), (9, "會員系統 CUBE-200"), (11, "")])
+    path = str(tmp_path / "kb_lexical.npz")
+    with open(path, "wb") as f:
+        index.save(f)
+    mapped = LexicalIndex.load(path, mmap=True)
+    assert isinstance(mapped.post_doc, np.memmap)
+    for q in ("CUBE-100", "會員", "沒有這個詞"):
+        assert mapped.search(q, 3) == LexicalIndex.load(path).search(q, 3)
+
+
+def test_readiness_after_warm_up(tmp_path, monkeypatch):
+    docs, _ = _setup(tmp_path, monkeypatch)
+    monkeypatch.setattr(kb_rag, "INDEX_MMAP", True)
+    monkeypatch.setattr(kb_rag, "_manager", kb_rag.IndexManager())
+    monkeypatch.setattr(kb_rag, "_warm_up", kb_rag.WarmUp())
+
+    # 尚未 build：預熱失敗，不回報 ready
+    state = kb_rag.warm_up()
+    assert not state["ready"] and state["error"]
+
+    (docs / "a.md").write_text("推播服務 CUBE-100", encoding="utf-8")
+    kb_rag.build_index(str(docs))
+    monkeypatch.setattr(kb_rag, "_warm_up", kb_rag.WarmUp())
+    assert not kb_rag.readiness()["ready"]
+    state = kb_rag.warm_up()
+    assert state["ready"] and state["mmap"] and state["pid"] == os.getpid()
+    snap = kb_rag.get_index_manager().current()
+    assert isinstance(snap.lexical.post_doc, np.memmap)
+    assert kb_rag.search(snap.index, "CUBE-100", store=snap.store, lexical=snap.lexical,
+                         mode="lexical")[0][0].text == "推播服務 CUBE-100"
+
+
+def test_ready_endpoints(tmp_path, monkeypatch):
+    docs, _ = _setup(tmp_path, monkeypatch)
+    (docs / "a.md").write_text("推播服務", encoding="utf-8")
+    kb_rag.build_index(str(docs))
+    monkeypatch.setattr(kb_rag, "_manager", kb_rag.IndexManager())
+
+    import app as flask_app
+    monkeypatch.setattr(kb_rag, "_warm_up", kb_rag.WarmUp())
+    client = flask_app.app.test_client()
+    kb_rag._warm_up.start().join()            # 第一次檢查即開始預熱；等預熱完成
+    resp = client.get("/api/ready")
+    assert resp.status_code == 200 and resp.get_json()["ready"]
+
+    monkeypatch.setattr(kb_rag, "_warm_up", kb_rag.WarmUp())
+    monkeypatch.setattr(kb_rag._warm_up, "start", lambda kb_ids=None: None)   # 預熱尚未完成
+    resp = client.get("/api/ready")
+    assert resp.status_code == 503 and not resp.get_json()["ready"]
+    status, _, _ = asyncio.run(_call("GET", "/api/ready"))
+    assert status == 503
+
+    kb_rag._warm_up.run()
+    status, _, _ = asyncio.run(_call("GET", "/api/ready"))
+    assert status == 200
+
+
+def test_failed_warm_up_retries_after_build(tmp_path, monkeypatch):
+    docs, _ = _setup(tmp_path, monkeypatch)
+    monkeypatch.setattr(kb_rag, "_manager", kb_rag.IndexManager())
+    monkeypatch.setattr(kb_rag, "_registry", kb_rag.KBRegistry(root=str(tmp_path / "kbs")))
+    monkeypatch.setattr(kb_rag, "_warm_up", kb_rag.WarmUp())
+
+    kb_rag.start_warm_up().join()
+    assert not kb_rag.readiness()["ready"]
+    (docs / "a.md").write_text("推播服務", encoding="utf-8")
+    kb_rag.build_index(str(docs))
+
+    # 未超過重試間隔：不重新預熱
+    first = kb_rag.start_warm_up()
+    assert kb_rag.start_warm_up() is first and not kb_rag.readiness()["ready"]
+
+    monkeypatch.setattr(kb_rag, "WARM_RETRY_SECONDS", 0.0)
+    retry = kb_rag.start_warm_up()
+    retry.join()
+    assert retry is not first and kb_rag.readiness()["ready"]
+    assert kb_rag.start_warm_up() is retry          # 已 ready：不再重複預熱
+
+
+def test_multi_kb_only_deployment_is_ready(tmp_path, monkeypatch):
+    _build_kbs(tmp_path, monkeypatch)
+    assert not os.path.exists(kb_rag.INDEX_PATH)     # 沒有預設知識庫
+    monkeypatch.setattr(kb_rag, "_manager", kb_rag.IndexManager())
+    monkeypatch.setattr(kb_rag, "_warm_up", kb_rag.WarmUp())
+    state = kb_rag.warm_up()
+    assert state["ready"] and state["kbs"] == []
+
+    state = kb_rag.warm_up(["team-b"])
+    assert state["ready"] and state["kbs"] == ["team-b"]
+
+
+if __name__ == "__main__":
+    import pytest
+    sys.exit(pytest.main([__file__]))
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+"""
+測試查詢正規化與查詢向量 LRU 快取
+"""
+
+import sys
+import os
+import time
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import numpy as np
+
+import kb_rag
+from kb_cache import LRUCache
+
+
+def test_normalize_query():
+    assert kb_rag.normalize_query("  ＣＵＢＥａｐｐ　上線 \n 記錄 ") == "CUBEapp 上線 記錄"
+    assert kb_rag.normalize_query("誰負責推播 #Today: 2025-09-30") == "誰負責推播"
+    assert kb_rag.split_date_suffix("誰負責推播 #Today: 2025-09-30") == ("誰負責推播", "#Today: 2025-09-30")
+    assert kb_rag.split_date_suffix("沒有日期") == ("沒有日期", "")
+
+
+def test_embed_query_cached_across_days(monkeypatch):
+    monkeypatch.setattr(kb_rag, "_query_cache", LRUCache(16, 60))
+    calls = []
+
+    def fake_embed(texts):
+        calls.append(list(texts))
+        return np.ones((len(texts), 4), dtype="float32")
+
+    monkeypatch.setattr(kb_rag, "embed_texts", fake_embed)
+    a = kb_rag.embed_query("推播 負責人 #Today: 2025-09-30")
+    b = kb_rag.embed_query("推播　負責人 #Today: 2025-10-01")
+    assert calls == [["推播 負責人"]]
+    assert a.shape == (1, 4)
+    # 呼叫端會就地 normalize，快取內容不可被改動
+    a *= 0
+    np.testing.assert_array_equal(b, np.ones((1, 4), dtype="float32"))
+    np.testing.assert_array_equal(kb_rag.embed_query("推播 負責人"), np.ones((1, 4), dtype="float32"))
+
+
+def test_lru_eviction_and_ttl():
+    cache = LRUCache(2, ttl=0.05)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)          # b 最久未使用，被淘汰
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    time.sleep(0.06)
+    assert cache.get("a") is None
+
+
+if __name__ == "__main__":
+    import pytest
+    sys.exit(pytest.main([__file__]))
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""
+測試摘要快取：內容 hash 為 key、append-only 日誌、段落摘要沿用；分段摘要的 token 上限與切點
+"""
+
+import sys
+import os
+import time
+import threading
+from types import SimpleNamespace
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import kb_rag
+from kb_cache import SummaryCache
+from kb_ingest import iter_source_files, read_blocks
+
+
+class FakeChat:
+    """記錄每次 chat completion 的請求內容，回傳固定摘要"""
+
+    def __init__(self):
+        self.prompts = []
+        self.completions = self
+
+    def create(self, model, messages, temperature=0.2, **kwargs):
+        self.prompts.append(messages[-1]["content"])
+        msg = SimpleNamespace(content=f"摘要{len(self.prompts)}")
+        return SimpleNamespace(choices=[SimpleNamespace(message=msg)])
+
+
+def test_journal_append_and_compact(tmp_path):
+    path = str(tmp_path / "summary.jsonl")
+    cache = SummaryCache(path)
+    cache.put("doc:a", "一")
+    cache.put("doc:a", "二")
+    cache.put("doc:b", "三")
+    cache.close()
+    with open(path, "a", encoding="utf-8") as f:
+        f.write('{"k": "doc:c", "v"')  # 模擬寫到一半中斷
+
+    reloaded = SummaryCache(path)
+    assert reloaded.get("doc:a") == "二"
+    assert reloaded.get("doc:b") == "三"
+    assert "doc:c" not in reloaded
+    reloaded.close()
+    with open(path, encoding="utf-8") as f:
+        assert len(f.readlines()) == 2
+
+
+def test_segment_reuse(tmp_path, monkeypatch):
+    chat = FakeChat()
+    monkeypatch.setattr(kb_rag, "client", SimpleNamespace(chat=chat))
+    cache = SummaryCache(str(tmp_path / "summary.jsonl"))
+
+    seg = "甲" * 60 + "。"
+    doc = "\n".join([seg, seg.replace("甲", "乙"), seg.replace("甲", "丙")])
+    monkeypatch.setattr(kb_rag, "chunk_text_for_summary",
+                        lambda text, size=50000: text.split("\n"))
+
+    first = kb_rag.summarize_document(doc, "a.md", cache)
+    assert len(chat.prompts) == 4  # 3 段 + 1 次匯整
+
+    # 改名：內容相同，直接命中
+    assert kb_rag.summarize_document(doc, "renamed.md", cache) == first
+    assert len(chat.prompts) == 4
+
+    # 只改第二段：只重新摘要該段，再重新匯整
+    edited = doc.replace("乙", "丁")
+    kb_rag.summarize_document(edited, "a.md", cache)
+    assert len(chat.prompts) == 6
+    assert "丁" in chat.prompts[4]
+
+
+def test_concurrent_summaries_bounded_and_ordered(tmp_path, monkeypatch):
+    """平行摘要不超過同時請求上限，輸出與日誌寫入順序固定"""
+    lock = threading.Lock()
+    state = {"inflight": 0, "peak": 0}
+
+    class SlowChat(FakeChat):
+        def create(self, model, messages, temperature=0.2, **kwargs):
+            with lock:
+                state["inflight"] += 1
+                state["peak"] = max(state["peak"], state["inflight"])
+            time.sleep(0.02)
+            with lock:
+                state["inflight"] -= 1
+            content = messages[-1]["content"]
+            msg = SimpleNamespace(content=f"摘要:{content[-8:]}")
+            return SimpleNamespace(choices=[SimpleNamespace(message=msg)])
+
+    chat = SlowChat()
+    monkeypatch.setattr(kb_rag, "client", SimpleNamespace(chat=chat))
+    original = kb_rag.SUMMARY_CONCURRENCY
+    kb_rag.set_summary_concurrency(3)
+    path = str(tmp_path / "summary.jsonl")
+    cache = SummaryCache(path)
+    docs = [(f"{i}.md", f"文件{i}內容") for i in range(8)]
+
+    try:
+        out = list(kb_rag.summarize_documents(docs, cache))
+    finally:
+        kb_rag.set_summary_concurrency(original)
+        cache.close()
+
+    assert [src for src, _ in out] == [src for src, _ in docs]
+    assert 1 < state["peak"] <= 3
+    with open(path, encoding="utf-8") as f:
+        keys = [line.split('"k": "')[1].split('"')[0] for line in f]
+    doc_keys = [k for k in keys if k.startswith("doc:")]
+    assert doc_keys == [f"doc:{kb_rag.content_hash(txt)}" for _, txt in docs]
+
+
+def test_summary_segments_fit_token_budget():
+    para = "甲" * 300 + "。" + "乙" * 300 + "。"
+    doc = "\n\n".join([para] * 40)
+    segments = kb_rag.chunk_text_for_summary(doc, max_tokens=2000)
+    assert len(segments) > 1
+    assert all(kb_rag.estimate_tokens(s) <= 2000 for s in segments)
+    # 優先切在段落（空行）邊界，內容不遺失
+    assert all(s.endswith("。") for s in segments)
+    assert "\n\n".join(segments) == doc
+
+
+def test_summary_segments_sized_to_context_window(monkeypatch):
+    monkeypatch.setattr(kb_rag, "SUMMARY_CONTEXT_TOKENS", 32000)
+    monkeypatch.setattr(kb_rag, "SUMMARY_RESERVED_TOKENS", 2000)
+    doc = ("內容說明。" * 2000 + "\n") * 10        # 約 10 萬字；每段不超過 32000 - 2000 token
+    segments = kb_rag.chunk_text_for_summary(doc)
+    assert len(segments) == 4
+    assert all(kb_rag.estimate_tokens(s) <= 30000 for s in segments)
+    assert all(s.endswith("。") for s in segments)
+
+
+
+def test_streamed_summary_segments_match_full_read(tmp_path):
+    para = "甲" * 300 + "。" + "乙" * 300 + "。"
+    doc = "\n\n".join([para] * 40)
+    path = tmp_path / "big.md"
+    path.write_text("\n" + doc + "\n", encoding="utf-8")
+    streamed = list(kb_rag.iter_summary_segments(read_blocks(str(path), buffer_chars=777), max_tokens=2000))
+    assert streamed == kb_rag.chunk_text_for_summary(doc, max_tokens=2000)
+
+
+def test_streamed_file_summarized_in_full(tmp_path, monkeypatch):
+    """串流處理的大型檔案：每一段都送去摘要（不只開頭），文件快取 key 與整份讀入相同"""
+    chat = FakeChat()
+    monkeypatch.setattr(kb_rag, "client", SimpleNamespace(chat=chat))
+    monkeypatch.setattr(kb_rag, "summary_segment_tokens", lambda: 2000)
+    doc = "\n\n".join(f"第{i}節 " + "內容" * 500 + "。" for i in range(30))
+    (tmp_path / "big.md").write_text(doc, encoding="utf-8")
+    [f] = iter_source_files(str(tmp_path))
+    cache = SummaryCache(str(tmp_path / "summary.jsonl"))
+
+    summary = kb_rag.summarize_document(f, f.path, cache)
+    segments = kb_rag.chunk_text_for_summary(doc)
+    assert len(segments) > 1 and len(chat.prompts) == len(segments) + 1
+    assert "第29節" in "".join(chat.prompts)
+    assert f"第 {len(segments)}/{len(segments)} 段" in "".join(chat.prompts)
+    assert kb_rag.summarize_document(doc, "big.md", cache) == summary
+    assert len(chat.prompts) == len(segments) + 1
+
+
+if __name__ == "__main__":
+    import pytest
+    sys.exit(pytest.main([__file__]))